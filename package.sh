@@ -3,6 +3,15 @@ set -e
 
 . common.sh
 
+# The webhook can evaluate pushes in-process (EVAL_MODE=inline) and needs the eval module alongside it
+cp eval/filter.py webhook/filter.py
+
+# Modules shared by the functions are packaged with each of them
+for function in eval webhook cfresource; do
+    rm -rf ${function}/common
+    cp -r common ${function}/common
+done
+
 sam build
 
 sam package \
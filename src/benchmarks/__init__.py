@@ -0,0 +1,18 @@
+import os
+import time
+
+# The handler modules read their settings at import time
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+os.environ.setdefault('S3_BUCKET', 'bench-bucket')
+os.environ.setdefault('S3_PREFIX', 'bench/prefix')
+os.environ.setdefault('GITHUB_SECRET', 'bench secret')
+os.environ.setdefault('EVAL_FUNCTION_ARN', 'bench.arn')
+
+def timeit(fn, repeat=5):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
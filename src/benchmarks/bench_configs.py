@@ -0,0 +1,49 @@
+# Memory held by loaded configs, the previous raw json.load dicts with a Matches list against
+# PipelineConfig records. The compiled patterns are shared through the pattern cache either way and
+# are loaded before measuring.
+# Run from src: python -m benchmarks.bench_configs
+import json
+import tracemalloc
+import benchmarks  # noqa: F401 sets the handler environment
+from eval import filter
+
+COUNTS = [100, 1000, 5000]
+
+def build_documents(count):
+    return [json.dumps({
+        'GitHubRepo': 'platform-monorepo',
+        'GitHubBranch': 'master',
+        'ChangeMatchExpressions': f'services/svc{i % 200}/.*,libs/lib{i % 20}/.*,^proto/svc{i % 200}\\.proto$',
+        'CodePipelineName': f'platform-monorepo-master-service-{i}-pipeline'
+    }).encode() for i in range(count)]
+
+def previous_load(document):
+    config = json.loads(document)
+    config['Matches'] = filter.build_regex_matches(config['ChangeMatchExpressions'])
+    return config
+
+def record_load(document):
+    return filter.parse_config(json.loads(document))
+
+def traced_kb(load, documents):
+    tracemalloc.start()
+    try:
+        configs = [load(document) for document in documents]
+        current = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    assert len(configs) == len(documents)
+    return current / 1024
+
+def main():
+    print(f'{"configs":>8} {"dicts KB":>10} {"records KB":>11} {"bytes/config":>13} {"saved":>7}')
+    for count in COUNTS:
+        documents = build_documents(count)
+        for document in documents:
+            record_load(document)
+        previous = traced_kb(previous_load, documents)
+        records = traced_kb(record_load, documents)
+        print(f'{count:8} {previous:10.0f} {records:11.0f} {records * 1024 / count:13.0f} {1 - records / previous:7.0%}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+# Compares matching large pushes against glob configs with the same configs written as the regexes
+# people translate them to by hand, and as fnmatch.translate regexes, whose * also crosses /.
+# Run from src: python -m benchmarks.bench_glob
+import contextlib
+import fnmatch
+import io
+import random
+import benchmarks  # noqa: F401 sets the handler environment
+from benchmarks import timeit
+from eval import filter
+
+SERVICES = 200
+PATH_COUNTS = [2000, 10000]
+
+# (glob, equivalent regex) per config
+def build_expressions(i):
+    return [
+        (f'services/svc{i}/**', f'services/svc{i}/.*'),
+        (f'protos/**/svc{i}.proto', f'protos/(.*/)?svc{i}\\.proto$'),
+        (f'infra/svc{i}/**/*.tf', f'infra/svc{i}/(.*/)?[^/]*\\.tf$'),
+        (f'libs/*/src/lib{i}.py', f'libs/[^/]*/src/lib{i}\\.py$'),
+    ]
+
+def build_configs(syntax):
+    configs = []
+    for i in range(SERVICES):
+        globs, regexes = zip(*build_expressions(i))
+        if syntax == 'glob':
+            data = {'ChangeMatchExpressions': ','.join(globs), 'MatchSyntax': 'glob'}
+        elif syntax == 'regex':
+            data = {'ChangeMatchExpressions': ','.join(regexes)}
+        else:
+            data = {'ChangeMatchExpressions': ','.join(fnmatch.translate(glob) for glob in globs)}
+        configs.append(filter.parse_config({'CodePipelineName': f'pipeline{i}', **data}))
+    return configs
+
+# Only a tenth of the services are touched, so most configs are tried against the whole push
+def build_paths(count, rng):
+    touched = range(SERVICES - SERVICES // 10, SERVICES)
+    paths = []
+    for i in range(count):
+        service = rng.choice(touched)
+        kind = i % 4
+        if kind == 0:
+            paths.append(f'services/svc{service}/pkg{i % 13}/module{i}.py')
+        elif kind == 1:
+            paths.append(f'protos/v{i % 3}/svc{service}.proto')
+        elif kind == 2:
+            paths.append(f'infra/svc{service}/modules/m{i % 7}/main{i}.tf')
+        else:
+            paths.append(f'libs/group{i % 5}/src/lib{service}.py')
+    return paths
+
+def main():
+    rng = random.Random(1)
+    configs = {syntax: build_configs(syntax) for syntax in ('glob', 'regex', 'fnmatch')}
+    print(f'{"paths":>8} {"matched":>8} {"glob ms":>9} {"regex ms":>9} {"fnmatch ms":>11}')
+    for count in PATH_COUNTS:
+        paths = build_paths(count, rng)
+        with contextlib.redirect_stdout(io.StringIO()):
+            expected = filter.Matcher(configs['regex']).match(paths)
+            assert [c.CodePipelineName for c in filter.Matcher(configs['glob']).match(paths)] == [c.CodePipelineName for c in expected]
+            timings = {syntax: timeit(lambda: filter.Matcher(configs[syntax]).match(paths), repeat=3) for syntax in configs}
+        print(f'{count:8} {len(expected):8} {timings["glob"] * 1000:9.1f} {timings["regex"] * 1000:9.1f} {timings["fnmatch"] * 1000:11.1f}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,39 @@
+# Reports the cold start import cost of each handler module with python -X importtime, and checks that
+# an unauthorized webhook request is answered without importing boto3.
+# Run from src: python -m benchmarks.bench_import
+import os
+import subprocess
+import sys
+import benchmarks  # noqa: F401 sets the handler environment
+
+HANDLERS = ['webhook.org', 'eval.filter', 'cfresource.resource']
+SRC = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+UNAUTHORIZED = '''
+import sys
+from webhook import org
+org.handler({'body': '{}', 'headers': {'x-github-event': 'push', 'x-hub-signature': 'sha1=00'}}, None)
+print('boto3' in sys.modules)
+'''
+
+def import_time(module):
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                            capture_output=True, text=True, env=os.environ, cwd=SRC, check=True)
+    cumulative = {}
+    for line in result.stderr.splitlines():
+        if line.startswith('import time:') and '|' in line:
+            _, total, name = line.split('|')
+            if total.strip().isdigit():
+                cumulative[name.strip()] = int(total)
+    return cumulative.get(module, 0), cumulative.get('boto3', 0)
+
+def main():
+    print(f'{"handler":<22} {"import ms":>10} {"boto3 ms":>10}')
+    for module in HANDLERS:
+        total, boto3 = import_time(module)
+        print(f'{module:<22} {total / 1000:10.1f} {boto3 / 1000:10.1f}')
+    result = subprocess.run([sys.executable, '-c', UNAUTHORIZED], capture_output=True, text=True, env=os.environ, cwd=SRC, check=True)
+    print(f'boto3 imported by unauthorized webhook request: {result.stdout.strip().splitlines()[-1]}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+# End to end trigger latency, from the webhook receiving a push to the pipeline start returning, for
+# the async invoke and the in-process evaluation modes. AWS calls are simulated with fixed latencies.
+# Run from src: python -m benchmarks.bench_inline
+import contextlib
+import hmac
+import io
+import json
+import statistics
+import time
+from hashlib import sha1
+from unittest.mock import patch
+import benchmarks  # noqa: F401 sets the handler environment
+from common import clients as shared_clients
+from eval import filter
+from webhook import org
+from tests.fakes import FakeS3
+
+S3_LATENCY = 0.015
+INVOKE_LATENCY = 0.02
+# Time between an Event invoke being accepted and the eval function starting to run it
+ASYNC_DISPATCH_DELAY = 0.05
+START_LATENCY = 0.04
+CONFIGS = 20
+ITERATIONS = 20
+
+class SlowS3(FakeS3):
+    def count(self, operation):
+        time.sleep(S3_LATENCY)
+        return super().count(operation)
+
+class SlowCodePipeline:
+    def start_pipeline_execution(self, name):
+        time.sleep(START_LATENCY)
+        return {'pipelineExecutionId': f'{name}-execution'}
+
+class SlowLambda:
+    def __init__(self):
+        self.payloads = []
+
+    def invoke(self, FunctionName, InvocationType, Payload):
+        time.sleep(INVOKE_LATENCY)
+        self.payloads.append(Payload)
+        return {'StatusCode': 202}
+
+def build_s3():
+    s3 = SlowS3()
+    prefix = filter.build_config_prefix(filter.S3_PREFIX, 'repo', 'master')
+    for i in range(CONFIGS):
+        config = {'GitHubRepo': 'repo', 'GitHubBranch': 'master', 'CodePipelineName': f'pipeline{i}',
+                  'ChangeMatchExpressions': f'services/svc{i}/.*'}
+        s3.add(f'{prefix}repo-master-pipeline{i}.json', json.dumps(config), bucket=filter.S3_BUCKET)
+    return s3
+
+def build_request():
+    push = {'ref': 'refs/heads/master', 'repository': {'name': 'repo'},
+            'commits': [{'added': ['services/svc3/app.py', 'services/svc7/app.py'], 'removed': [], 'modified': []}]}
+    body = json.dumps(push)
+    signature = hmac.new(org.SECRET, msg=body.encode('utf-8'), digestmod=sha1).hexdigest()
+    return {'body': body, 'headers': {'x-github-event': 'push', 'x-hub-signature': f'sha1={signature}'}}
+
+def run_async(request, invoker):
+    org.handler(request, None)
+    time.sleep(ASYNC_DISPATCH_DELAY)
+    filter.handler(json.loads(invoker.payloads[-1]), None)
+
+def run_inline(request, invoker):
+    org.handler(request, None)
+
+def measure(mode, run):
+    filter.config_cache.clear()
+    s3, invoker = build_s3(), SlowLambda()
+    clients = {'s3': s3, 'codepipeline': SlowCodePipeline(), 'lambda': invoker}
+    request = build_request()
+    timings = []
+    with patch.dict(shared_clients.clients, clients), \
+            patch('webhook.org.EVAL_MODE', mode), patch('webhook.org.load_evaluator', return_value=filter):
+        for _ in range(ITERATIONS):
+            start = time.perf_counter()
+            run(request, invoker)
+            timings.append((time.perf_counter() - start) * 1000)
+    return timings[0], statistics.median(timings[1:])
+
+def main():
+    with contextlib.redirect_stdout(io.StringIO()):
+        results = [(mode, *measure(mode, run)) for mode, run in [('async', run_async), ('inline', run_inline)]]
+    print(f'{CONFIGS} configs, simulated S3 {S3_LATENCY * 1000:.0f} ms, invoke {INVOKE_LATENCY * 1000:.0f} ms, '
+          f'async dispatch {ASYNC_DISPATCH_DELAY * 1000:.0f} ms, pipeline start {START_LATENCY * 1000:.0f} ms')
+    print(f'{"mode":<8} {"first ms":>10} {"warm p50 ms":>12}')
+    for mode, first, warm in results:
+        print(f'{mode:<8} {first:10.1f} {warm:12.1f}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,209 @@
+# Load test of the eval handler with synthetic pushes and config sets against stubbed S3 and
+# CodePipeline clients. Reports cold (caches cleared before every push) and warm p50/p99 latency,
+# peak traced memory of a cold push and S3 calls per push, and writes the results as JSON so runs
+# can be compared. With --baseline the run fails when a p50 regressed beyond --tolerance.
+# Run from src: python -m benchmarks.bench_load [--scenario NAME] [--output results.json]
+import argparse
+import contextlib
+import io
+import json
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+from collections import Counter
+from unittest.mock import patch
+import benchmarks  # noqa: F401 sets the handler environment
+from common import clients as shared_clients
+from eval import filter
+from tests.fakes import FakeS3
+
+REPO = 'repo'
+BRANCH = 'master'
+
+# name: (configs, patterns per config, changed paths, commits)
+SCENARIOS = {
+    'single': (1, 1, 1, 1),
+    'typical': (50, 3, 100, 10),
+    'many-configs': (1000, 2, 200, 20),
+    'many-patterns': (100, 50, 500, 50),
+    'big-push': (200, 5, 10000, 500),
+    'largest': (1000, 50, 10000, 500),
+}
+DEFAULT_SCENARIOS = ['single', 'typical', 'many-configs', 'many-patterns', 'big-push']
+
+class FakeCodePipeline:
+    def __init__(self):
+        self.calls = Counter()
+
+    def start_pipeline_execution(self, name):
+        self.calls['start_pipeline_execution'] += 1
+        return {'pipelineExecutionId': f'{name}-execution'}
+
+# Mostly literal prefixes, which is how configs are written in practice, with some anchored
+# alternations and extension patterns that have to run as regexes.
+def build_patterns(rng, services, count):
+    patterns = []
+    for _ in range(count):
+        service = rng.randrange(services)
+        kind = rng.random()
+        if kind < 0.6:
+            patterns.append(f'services/svc{service}/.*')
+        elif kind < 0.9:
+            patterns.append(f'^libs/lib{service}/(src|include)/.*\\.(py|h)$')
+        else:
+            patterns.append(f'.*/svc{service}[^/]*\\.proto$')
+    return patterns
+
+def build_configs(rng, configs, patterns, services):
+    return [{
+        'GitHubRepo': REPO,
+        'GitHubBranch': BRANCH,
+        'CodePipelineName': f'pipeline{i}',
+        'ChangeMatchExpressions': ','.join(build_patterns(rng, services, patterns))
+    } for i in range(configs)]
+
+def build_push(rng, paths, commits, services):
+    changed = []
+    for i in range(paths):
+        service = rng.randrange(services * 4)
+        if i % 3 == 0:
+            changed.append(f'libs/lib{service}/src/module{i}.py')
+        else:
+            changed.append(f'services/svc{service}/pkg{i % 17}/file{i}.py')
+    commits = max(1, min(commits, paths))
+    return {
+        'ref': f'refs/heads/{BRANCH}',
+        'repository': {'name': REPO},
+        'commits': [{'added': changed[c::commits], 'removed': [], 'modified': []} for c in range(commits)]
+    }
+
+def build_s3(configs, legacy_keys):
+    s3 = FakeS3()
+    objects = {}
+    for config in configs:
+        if legacy_keys:
+            key = f'{filter.build_prefix(filter.S3_PREFIX, REPO, BRANCH)}-{config["CodePipelineName"]}.json'
+        else:
+            key = f'{filter.build_config_prefix(filter.S3_PREFIX, REPO, BRANCH)}{REPO}-{BRANCH}-{config["CodePipelineName"]}.json'
+        s3.add(key, json.dumps(config), bucket=filter.S3_BUCKET)
+        if not legacy_keys:
+            objects[key] = s3.objects[(filter.S3_BUCKET, key)][1]
+    index = {'Version': filter.INDEX_VERSION, 'Configs': {c['CodePipelineName']: c for c in configs}, 'Objects': objects}
+    s3.add(filter.build_index_key(filter.S3_PREFIX, REPO, BRANCH), json.dumps(index), bucket=filter.S3_BUCKET)
+    return s3
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))]
+
+def clear_caches():
+    filter.config_cache.clear()
+    filter.pattern_cache.clear()
+    filter.config_snapshot = filter.ConfigSnapshot(filter.S3_BUCKET, filter.S3_PREFIX, filter.SNAPSHOT_CHECK_INTERVAL)
+
+def run_pushes(event, s3, codepipeline, iterations, cold):
+    timings = []
+    calls = Counter()
+    for _ in range(iterations):
+        if cold:
+            clear_caches()
+        before = s3.calls.copy()
+        start = time.perf_counter()
+        filter.handler(event, None)
+        timings.append((time.perf_counter() - start) * 1000)
+        calls.update(s3.calls - before)
+    return {
+        'p50_ms': round(statistics.median(timings), 3),
+        'p99_ms': round(percentile(timings, 99), 3),
+        'max_ms': round(max(timings), 3),
+        's3_calls_per_push': {op: count / iterations for op, count in sorted(calls.items())}
+    }
+
+def peak_memory(event):
+    clear_caches()
+    tracemalloc.start()
+    try:
+        filter.handler(event, None)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def run_scenario(name, iterations, source, seed, legacy_keys=False):
+    configs, patterns, paths, commits = SCENARIOS[name]
+    rng = random.Random(seed)
+    services = max(configs, 1)
+    config_set = build_configs(rng, configs, patterns, services)
+    event = build_push(rng, paths, commits, services)
+    s3, codepipeline = build_s3(config_set, legacy_keys), FakeCodePipeline()
+    clients = {'s3': s3, 'codepipeline': codepipeline}
+    with patch.dict(shared_clients.clients, clients), patch('eval.filter.CONFIG_SOURCE', source), \
+            patch('eval.filter.READ_LEGACY_KEYS', legacy_keys), \
+            patch('eval.filter.metrics', filter.Metrics(None, 'eval')), contextlib.redirect_stdout(io.StringIO()):
+        cold = run_pushes(event, s3, codepipeline, iterations, cold=True)
+        clear_caches()
+        filter.handler(event, None)
+        warm = run_pushes(event, s3, codepipeline, iterations, cold=False)
+        memory = peak_memory(event)
+        started = len(filter.find_pipelines(event))
+    clear_caches()
+    return {
+        'scenario': name,
+        'configs': configs,
+        'patterns_per_config': patterns,
+        'paths': paths,
+        'commits': commits,
+        'pipelines_started': started,
+        'cold': cold,
+        'warm': warm,
+        'peak_memory_kb': round(memory / 1024, 1)
+    }
+
+def compare(results, baseline, tolerance):
+    previous = {r['scenario']: r for r in baseline['results']}
+    regressions = []
+    for result in results:
+        before = previous.get(result['scenario'])
+        if before is None:
+            continue
+        for phase in ('cold', 'warm'):
+            now, then = result[phase]['p50_ms'], before[phase]['p50_ms']
+            if now > then * (1 + tolerance):
+                regressions.append(f'{result["scenario"]} {phase} p50 {then:.2f} -> {now:.2f} ms')
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Load test the eval handler with synthetic pushes and configs')
+    parser.add_argument('--scenario', action='append', choices=sorted(SCENARIOS), help='repeat to run several, default all but largest')
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--source', choices=['scan', 'index', 'snapshot'], default='scan')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--legacy-keys', action='store_true', help='store configs under the legacy keys and read them, as before migrating')
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    parser.add_argument('--baseline', help='JSON results of an earlier run to compare p50 latencies against')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed p50 increase over the baseline, default 0.25')
+    args = parser.parse_args(argv)
+
+    results = [run_scenario(name, args.iterations, args.source, args.seed, args.legacy_keys) for name in args.scenario or DEFAULT_SCENARIOS]
+    report = {'source': args.source, 'legacy_keys': args.legacy_keys, 'iterations': args.iterations, 'python': sys.version.split()[0], 'results': results}
+
+    print(f'{"scenario":<14} {"cold p50":>9} {"cold p99":>9} {"warm p50":>9} {"warm p99":>9} {"peak KB":>9} {"S3 cold":>8} {"S3 warm":>8}')
+    for r in results:
+        print(f'{r["scenario"]:<14} {r["cold"]["p50_ms"]:9.2f} {r["cold"]["p99_ms"]:9.2f} {r["warm"]["p50_ms"]:9.2f} '
+              f'{r["warm"]["p99_ms"]:9.2f} {r["peak_memory_kb"]:9.0f} {sum(r["cold"]["s3_calls_per_push"].values()):8.1f} '
+              f'{sum(r["warm"]["s3_calls_per_push"].values()):8.1f}')
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f'Regression: {regression}')
+        if regressions:
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,64 @@
+# Compares matching a 10k path push against prefix style configs, and leaving out docs with a
+# negative lookahead in ChangeMatchExpressions against ExcludeMatchExpressions.
+# Run from src: python -m benchmarks.bench_matching
+from benchmarks import timeit
+from eval import filter
+
+SERVICES = 80
+PATHS = 10000
+
+def build_configs():
+    configs = []
+    for i in range(SERVICES):
+        expressions = f'services/svc{i}/.*,libs/lib{i % 10}/.*'
+        configs.append(filter.parse_config({'CodePipelineName': f'pipeline{i}', 'ChangeMatchExpressions': expressions}))
+    return configs
+
+def build_exclude_configs():
+    lookahead, excludes = [], []
+    for i in range(SERVICES):
+        lookahead.append(filter.parse_config({'CodePipelineName': f'pipeline{i}', 'ChangeMatchExpressions': f'services/svc{i}/(?!.*\\.md$).*'}))
+        excludes.append(filter.parse_config({'CodePipelineName': f'pipeline{i}', 'ChangeMatchExpressions': f'services/svc{i}/.*',
+                                             'ExcludeMatchExpressions': '.*\\.md'}))
+    return lookahead, excludes
+
+def build_paths():
+    # Only the last quarter of the services are touched, so most configs scan the whole push
+    touched = range(SERVICES * 3 // 4, SERVICES)
+    return [f'services/svc{touched[i % len(touched)]}/src/module{i}.py' for i in range(PATHS)]
+
+def per_config(configs, paths):
+    event = {'commits': [{'added': paths, 'removed': [], 'modified': []}]}
+    return [c for c in configs if filter.is_match(event, c.Matches)]
+
+def main():
+    configs = build_configs()
+    paths = build_paths()
+    expected = per_config(configs, paths)
+    assert filter.Matcher(configs).match(paths) == expected
+    assert filter.Matcher(configs, prefix_index=False).match(paths) == expected
+
+    results = {
+        'is_match per config': timeit(lambda: per_config(configs, paths)),
+        'Matcher regex only': timeit(lambda: filter.Matcher(configs, prefix_index=False).match(paths)),
+        'Matcher prefix index': timeit(lambda: filter.Matcher(configs).match(paths)),
+    }
+    print(f'{SERVICES} configs, {PATHS} paths, {len(expected)} matched')
+    for name, seconds in results.items():
+        print(f'{name:<24} {seconds * 1000:8.2f} ms')
+
+    # Half the touched services only have docs changed, so those configs scan the whole push
+    lookahead, excludes = build_exclude_configs()
+    docs = [p.replace('.py', '.md') if int(p.split('/')[1][3:]) % 2 else p for p in paths]
+    expected = [c.CodePipelineName for c in filter.Matcher(lookahead).match(docs)]
+    assert [c.CodePipelineName for c in filter.Matcher(excludes).match(docs)] == expected
+    results = {
+        'negative lookahead': timeit(lambda: filter.Matcher(lookahead).match(docs)),
+        'ExcludeMatchExpressions': timeit(lambda: filter.Matcher(excludes).match(docs)),
+    }
+    print(f'{SERVICES} configs leaving out docs, {PATHS} paths, {len(expected)} matched')
+    for name, seconds in results.items():
+        print(f'{name:<24} {seconds * 1000:8.2f} ms')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,41 @@
+# Cost of the metrics calls the handlers make, with metrics disabled (METRICS_NAMESPACE unset) and
+# enabled, next to the webhook handler for an ignored and a signed push event.
+# Run from src: python -m benchmarks.bench_metrics
+import contextlib
+import io
+import time
+from unittest.mock import patch
+import benchmarks  # noqa: F401 sets the handler environment
+from benchmarks.bench_webhook import build_request, per_call_us
+from webhook import org
+
+ITERATIONS = 200000
+
+def call_ns(metrics):
+    start = time.perf_counter()
+    for _ in range(ITERATIONS):
+        with metrics.timer('Stage'):
+            pass
+        metrics.count('Count')
+    return (time.perf_counter() - start) / ITERATIONS * 1e9
+
+def main():
+    disabled = org.Metrics(None, 'bench')
+    enabled = org.Metrics('Bench', 'bench', emit=lambda line: None)
+    print(f'timer + count, disabled {call_ns(disabled):8.0f} ns')
+    print(f'timer + count, enabled  {call_ns(enabled):8.0f} ns')
+    print(f'{"event":<14} {"disabled us":>12} {"enabled us":>12}')
+    with patch('webhook.org.invoke_function'), contextlib.redirect_stdout(io.StringIO()):
+        rows = []
+        for event in ['status', 'push']:
+            request = build_request(event)
+            with patch('webhook.org.metrics', disabled):
+                off = per_call_us(org.handler, request)
+            with patch('webhook.org.metrics', enabled):
+                on = per_call_us(org.handler, request)
+            rows.append((event, off, on))
+    for event, off, on in rows:
+        print(f'{event:<14} {off:12.2f} {on:12.2f}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+# Size and load time of a whole prefix of configs in the formats the eval function can read: one
+# JSON object per config, a single JSON document with every config, and the compressed snapshot
+# written by the resource function. Decoding the snapshot is measured with a cold pattern cache, as
+# on a cold start, and a warm one, as on a refresh after a config change.
+# Run from src: python -m benchmarks.bench_snapshot
+import gzip
+import json
+import benchmarks  # noqa: F401 sets the handler environment
+from benchmarks import timeit
+from common.snapshot import encode_snapshot
+from eval import filter
+
+COUNTS = [100, 1000, 5000]
+
+def build_configs(count):
+    return {f'platform-monorepo-{i % 5}-master-{i}.json': {
+        'GitHubRepo': f'platform-monorepo-{i % 5}',
+        'GitHubBranch': 'master' if i % 3 else f'release-{i % 7}',
+        'ChangeMatchExpressions': f'services/svc{i % 200}/.*,libs/lib{i % 20}/.*,^proto/svc{i % 200}\\.proto$',
+        'CodePipelineName': f'platform-monorepo-{i % 5}-service-{i}-pipeline'
+    } for i in range(count)}
+
+def load_documents(documents):
+    filter.pattern_cache.clear()
+    return [filter.parse_config(json.loads(document)) for document in documents]
+
+def load_single(document):
+    filter.pattern_cache.clear()
+    return [filter.parse_config(config) for config in json.loads(document).values()]
+
+def load_snapshot(data, cold=True):
+    if cold:
+        filter.pattern_cache.clear()
+    return filter.decode_branches(data)
+
+def main():
+    print(f'{"configs":>8} {"files KB":>9} {"json KB":>8} {"gzip KB":>8} {"snap KB":>8} '
+          f'{"files ms":>9} {"json ms":>8} {"snap ms":>8} {"warm ms":>8}')
+    for count in COUNTS:
+        configs = build_configs(count)
+        documents = [json.dumps(config).encode() for config in configs.values()]
+        single = json.dumps(configs).encode()
+        snapshot = encode_snapshot(configs)
+        assert sum(len(b) for r in filter.decode_branches(snapshot).values() for b in r.values()) == count
+        load_snapshot(snapshot)
+        print(f'{count:8} {sum(map(len, documents)) / 1024:9.0f} {len(single) / 1024:8.0f} '
+              f'{len(gzip.compress(single)) / 1024:8.0f} {len(snapshot) / 1024:8.0f} '
+              f'{timeit(lambda: load_documents(documents)) * 1000:9.1f} {timeit(lambda: load_single(single)) * 1000:8.1f} '
+              f'{timeit(lambda: load_snapshot(snapshot)) * 1000:8.1f} {timeit(lambda: load_snapshot(snapshot, cold=False)) * 1000:8.1f}')
+
+if __name__ == '__main__':
+    main()
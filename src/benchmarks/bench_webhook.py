@@ -0,0 +1,52 @@
+# Per event type latency of the webhook handler against the previous order of checks, which verified
+# the HMAC over the whole body and logged both signatures before looking at the event type.
+# Run from src: python -m benchmarks.bench_webhook
+import contextlib
+import hmac
+import io
+import json
+import time
+from hashlib import sha1
+from unittest.mock import patch
+import benchmarks  # noqa: F401 sets the handler environment
+from webhook import org
+
+EVENTS = ['push', 'check_run', 'status', 'pull_request', 'ping']
+ITERATIONS = 2000
+
+def previous_handler(request, context):
+    sent = request['headers']['x-hub-signature'].split('=')[-1].strip()
+    calculated = hmac.new(org.SECRET, msg=request['body'].encode('utf-8'), digestmod=sha1).hexdigest()
+    print(f'HMAC SIGNATURE sent={sent} calculated={calculated}')
+    if not hmac.compare_digest(calculated, sent):
+        return org.unauthorized()
+    github_event = request['headers']['x-github-event']
+    return org.EVENT_MAP[github_event](request) if github_event in org.EVENT_MAP else org.success()
+
+def build_request(event):
+    commits = [{'added': [f'services/svc{c}/file{f}.py' for f in range(20)], 'removed': [], 'modified': [],
+                'author': {'name': 'First Last', 'email': 'user@org'}, 'message': 'x' * 200} for c in range(100)]
+    body = json.dumps({'ref': 'refs/heads/master', 'repository': {'name': 'repo'}, 'commits': commits})
+    signature = hmac.new(org.SECRET, msg=body.encode('utf-8'), digestmod=sha1).hexdigest()
+    return {'body': body, 'headers': {'x-github-event': event, 'x-hub-signature': f'sha1={signature}'}}
+
+def per_call_us(fn, request):
+    start = time.perf_counter()
+    for _ in range(ITERATIONS):
+        fn(request, None)
+    return (time.perf_counter() - start) / ITERATIONS * 1e6
+
+def main():
+    print(f'{"event":<14} {"previous us":>12} {"current us":>12}')
+    with patch('webhook.org.invoke_function'), contextlib.redirect_stdout(io.StringIO()):
+        rows = []
+        for event in EVENTS:
+            request = build_request(event)
+            rows.append((event, per_call_us(previous_handler, request), per_call_us(org.handler, request)))
+    body_kb = len(build_request('push')['body']) / 1024
+    for event, previous, current in rows:
+        print(f'{event:<14} {previous:12.1f} {current:12.1f}')
+    print(f'body size {body_kb:.0f} KB')
+
+if __name__ == '__main__':
+    main()
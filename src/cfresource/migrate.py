@@ -0,0 +1,80 @@
+# Copies configs stored under legacy keys, S3_PREFIX/<repo-branch truncated>-<hash>.json, to the exact
+# repo/branch layout written by the resource function, and optionally deletes the legacy objects.
+# A config already present under its new key is left as it is, the resource function wrote it later.
+# Copied configs are added to the index of their repo/branch, one branch at a time so the workers do not
+# conflict on it. Once no legacy keys remain, the eval function can be deployed with READ_LEGACY_KEYS=false.
+# Run from src: S3_BUCKET=bucket S3_PREFIX=prefix python -m cfresource.migrate [--dry-run] [--delete-legacy]
+import argparse
+import json
+from concurrent.futures import ThreadPoolExecutor
+from botocore.exceptions import ClientError
+from cfresource import resource
+from common.layout import KEY_LAYOUT, get_config_filename
+
+def list_legacy_keys(client, bucket):
+    system = (f'{resource.S3_PREFIX}/_', f'{resource.S3_PREFIX}/{KEY_LAYOUT}/')
+    for page in client.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=f'{resource.S3_PREFIX}/'):
+        for info in page.get('Contents', []):
+            key = info['Key']
+            if key.endswith('.json') and not key.startswith(system):
+                yield key
+
+def migrate_key(client, bucket, key, dry_run=False, delete_legacy=False):
+    body = client.get_object(Bucket=bucket, Key=key)['Body'].read()
+    try:
+        config = json.loads(body)
+        properties = resource.ResourceProperties(
+            config['GitHubRepo'], config['GitHubBranch'], config['ChangeMatchExpressions'], config['CodePipelineName'])
+    except (ValueError, KeyError, TypeError) as e:
+        return 'invalid', key, repr(e), None
+    filename = get_config_filename(resource.S3_PREFIX, key)
+    target = resource.get_s3_key(properties, filename)
+    if dry_run:
+        return 'planned', key, target, None
+    try:
+        etag = client.put_object(Bucket=bucket, Key=target, Body=body, ContentType='application/json', IfNoneMatch='*').get('ETag')
+        outcome, copy = 'copied', (properties, filename, config, etag)
+    except ClientError as e:
+        if e.response['Error']['Code'] not in resource.CONFLICT_CODES:
+            raise
+        outcome, copy = 'exists', None
+    if delete_legacy:
+        client.delete_object(Bucket=bucket, Key=key)
+    return outcome, key, target, copy
+
+def migrate(client, bucket, dry_run=False, delete_legacy=False, workers=8):
+    def run(key):
+        try:
+            return migrate_key(client, bucket, key, dry_run, delete_legacy)
+        except Exception as e:
+            return 'failed', key, repr(e), None
+
+    keys = list(list_legacy_keys(client, bucket))
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        results = list(executor.map(run, keys))
+    summary = {}
+    for outcome, key, detail, copy in results:
+        if copy is not None:
+            properties, filename, config, etag = copy
+            try:
+                resource.update_index(client, bucket, properties, filename, config, etag)
+            except Exception as e:
+                outcome, detail = 'unindexed', repr(e)
+        summary[outcome] = summary.get(outcome, 0) + 1
+        if outcome != 'copied' or dry_run:
+            print(f'{outcome}: {key} {detail}')
+    return summary
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Move configs from legacy keys to the exact repo/branch key layout')
+    parser.add_argument('--dry-run', action='store_true', help='only print where each legacy config would be copied')
+    parser.add_argument('--delete-legacy', action='store_true', help='delete legacy objects once their new key exists')
+    parser.add_argument('--workers', type=int, default=8)
+    args = parser.parse_args(argv)
+
+    summary = migrate(resource.s3_client(), resource.S3_BUCKET, args.dry_run, args.delete_legacy, args.workers)
+    print(f'Migrated configs under s3://{resource.S3_BUCKET}/{resource.S3_PREFIX}: {summary}')
+    return 1 if summary.get('failed') or summary.get('unindexed') else 0
+
+if __name__ == '__main__':
+    raise SystemExit(main())
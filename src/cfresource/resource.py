@@ -2,53 +2,242 @@ import os
 from dataclasses import dataclass, asdict, field, fields
 import hashlib
 import json
-import boto3
-import requests
+import random
+import re
+import time
+from common.clients import get_client
+from common.layout import (
+    INDEX_VERSION, KEY_LAYOUT, build_config_prefix, build_generation_key, build_index_key, build_legacy_key, build_prefix,
+    build_snapshot_key, get_config_filename)
+from common.metrics import Metrics
+from common.schema import OPTIONAL_PROPERTIES, ConfigProperties, compile_expressions, validate_config
+from common.snapshot import decode_snapshot, encode_snapshot
 
 PHYSICAL_RESOURCE_ID = 'GitHubIntegrationMonoRepoS3ConfigResource'
 S3_BUCKET = os.environ['S3_BUCKET']
 S3_PREFIX = os.environ['S3_PREFIX']
-s3client = boto3.client('s3')
+INDEX_RETRIES = int(os.environ.get('INDEX_RETRIES', '5'))
+CONFLICT_CODES = ('PreconditionFailed', 'ConditionalRequestConflict')
+METRICS_NAMESPACE = os.environ.get('METRICS_NAMESPACE')
+WRITE_SNAPSHOT = os.environ.get('WRITE_SNAPSHOT', 'false').lower() == 'true'
+SNAPSHOT_RETRIES = int(os.environ.get('SNAPSHOT_RETRIES', '10'))
 
+# The event is not logged as a whole since its ResponseURL is a presigned URL
 def handler(event, context):
-    print(event)
+    print(f'{event.get("RequestType")} request {event.get("RequestId")} for {event.get("LogicalResourceId")}')
     try:
         request_type = event['RequestType']
         properties = extract_and_validate_properties(event, 'ResourceProperties')
         file_name = get_filename(properties)
-        EVENT_MAP[request_type](event, properties, file_name)
+        with metrics.timer(request_type):
+            EVENT_MAP[request_type](event, properties, file_name)
         response = success(event, None)
     except Exception as e:
+        metrics.count('Failures')
         response = failure(event, repr(e))
     finally:
-        send_response(event['ResponseURL'], response)
+        with metrics.timer('SendResponse'):
+            send_response(event['ResponseURL'], response)
+        metrics.flush()
 
 def handle_create(event, properties, filename):
-    put_s3(s3client, S3_BUCKET, get_s3_key(filename), props_to_config_data(properties), 'application/json')
+    validate_properties(properties)
+    etag = put_s3(s3_client(), S3_BUCKET, get_s3_key(properties, filename), props_to_config_data(properties), 'application/json')
+    update_index(s3_client(), S3_BUCKET, properties, filename, props_to_config(properties), etag)
+    update_snapshot(s3_client(), S3_BUCKET, {filename: props_to_config(properties)})
+    bump_generation(s3_client(), S3_BUCKET, event)
 
 def handle_update(event, properties, filename):
     oldProperties = extract_and_validate_properties(event, 'OldResourceProperties')
     oldFilename = get_filename(oldProperties)
-    delete_s3(s3client, S3_BUCKET, get_s3_key(oldFilename))
-    put_s3(s3client, S3_BUCKET, get_s3_key(filename), props_to_config_data(properties), 'application/json')
+    validate_properties(properties)
+    delete_config(s3_client(), S3_BUCKET, oldProperties, oldFilename)
+    update_index(s3_client(), S3_BUCKET, oldProperties, oldFilename, None)
+    etag = put_s3(s3_client(), S3_BUCKET, get_s3_key(properties, filename), props_to_config_data(properties), 'application/json')
+    update_index(s3_client(), S3_BUCKET, properties, filename, props_to_config(properties), etag)
+    update_snapshot(s3_client(), S3_BUCKET, {oldFilename: None, filename: props_to_config(properties)})
+    bump_generation(s3_client(), S3_BUCKET, event)
 
-def props_to_config_data(properties):
+# Optional properties that were not set are left out
+def props_to_config(properties):
     data = asdict(properties)
     if 'ServiceToken' in data:
         del data['ServiceToken']
-    return json.dumps(data).encode()
+    return {name: value for name, value in data.items() if value is not None}
+
+def props_to_config_data(properties):
+    return json.dumps(props_to_config(properties)).encode()
 
-def get_s3_key(filename):
-    return f'{S3_PREFIX}/{filename}.json'
+# Configs live under one prefix per exact repo and branch, so the eval function lists only the configs
+# of the pushed branch. Keys of configs written before this layout are removed along with the new ones.
+def get_s3_key(properties, filename):
+    return f'{build_config_prefix(S3_PREFIX, properties.GitHubRepo, properties.GitHubBranch)}{filename}.json'
+
+def get_legacy_s3_key(filename):
+    return build_legacy_key(S3_PREFIX, filename)
+
+def delete_config(client, bucket, properties, filename):
+    delete_s3(client, bucket, get_s3_key(properties, filename))
+    delete_s3(client, bucket, get_legacy_s3_key(filename))
 
 def put_s3(client, bucket, key, body, contentType):
-    client.put_object(Bucket=S3_BUCKET, Key=key, Body=body, ContentType=contentType)
+    with metrics.timer('S3Put'):
+        return client.put_object(Bucket=S3_BUCKET, Key=key, Body=body, ContentType=contentType).get('ETag')
 
 def delete_s3(client, bucket, key):
-    client.delete_object(Bucket=bucket, Key=key)
+    with metrics.timer('S3Delete'):
+        client.delete_object(Bucket=bucket, Key=key)
 
 def handle_delete(event, properties, filename):
-    delete_s3(s3client, S3_BUCKET, get_s3_key(filename))
+    delete_config(s3_client(), S3_BUCKET, properties, filename)
+    update_index(s3_client(), S3_BUCKET, properties, filename, None)
+    update_snapshot(s3_client(), S3_BUCKET, {filename: None})
+    bump_generation(s3_client(), S3_BUCKET, event)
+
+# The index holds every config of one repo/branch so the eval function can resolve a push with a
+# single GET. Writes are conditional on the ETag that was read and are retried when another stack
+# updated the index in between. A None config removes the entry. Objects records the ETag of every
+# config under the repo/branch prefix, so readers can tell when the configs changed without the index.
+def update_index(client, bucket, properties, filename, config, configEtag=None):
+    from botocore.exceptions import ClientError
+    key = build_index_key(S3_PREFIX, properties.GitHubRepo, properties.GitHubBranch)
+    configKey = get_s3_key(properties, filename)
+    for attempt in range(INDEX_RETRIES):
+        index, etag = get_index(client, bucket, properties, configKey)
+        if config is None:
+            index['Configs'].pop(filename, None)
+            index['Objects'].pop(configKey, None)
+        else:
+            index['Configs'][filename] = config
+            index['Objects'][configKey] = configEtag
+        try:
+            with metrics.timer('IndexPut'):
+                put_index(client, bucket, key, index, etag)
+            return
+        except ClientError as e:
+            if e.response['Error']['Code'] not in CONFLICT_CODES:
+                raise
+            metrics.count('IndexConflicts')
+            print(f'Index {key} was modified concurrently, attempt {attempt + 1} of {INDEX_RETRIES}')
+    raise RuntimeError(f'Unable to update index {key} after {INDEX_RETRIES} attempts')
+
+# An index that does not match the configs under the prefix, for example after the migration script
+# copied legacy configs, is seeded again. The config being written is left out of the comparison.
+def get_index(client, bucket, properties, configKey):
+    from botocore.exceptions import ClientError
+    key = build_index_key(S3_PREFIX, properties.GitHubRepo, properties.GitHubBranch)
+    try:
+        with metrics.timer('IndexGet'):
+            response = client.get_object(Bucket=bucket, Key=key)
+    except ClientError as e:
+        if e.response['Error']['Code'] not in ('NoSuchKey', '404'):
+            raise
+        return seed_index(client, bucket, properties), None
+    index = json.load(response['Body'])
+    if index.get('Version') != INDEX_VERSION or not matches_configs(client, bucket, properties, index, configKey):
+        return seed_index(client, bucket, properties), response['ETag']
+    return index, response['ETag']
+
+def matches_configs(client, bucket, properties, index, configKey):
+    listed = list_etags(client, bucket, build_config_prefix(S3_PREFIX, properties.GitHubRepo, properties.GitHubBranch))
+    listed.pop(configKey, None)
+    return listed == {key: etag for key, etag in index['Objects'].items() if key != configKey}
+
+def list_etags(client, bucket, prefix):
+    etags = {}
+    for page in client.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix):
+        for info in page.get('Contents', []):
+            etags[info['Key']] = info.get('ETag')
+    return etags
+
+# Configs written before the index existed only live as per-file objects, so a new index starts from
+# the configs under the repo/branch prefix and the legacy repo-branch prefix that belong to exactly
+# this repo and branch. Only the repo/branch prefix is recorded in Objects, legacy keys are no longer
+# written and are removed together with their index entry.
+def seed_index(client, bucket, properties):
+    configs = {}
+    metrics.count('IndexSeeds')
+    objects = list_etags(client, bucket, build_config_prefix(S3_PREFIX, properties.GitHubRepo, properties.GitHubBranch))
+    legacy = list_etags(client, bucket, build_prefix(S3_PREFIX, properties.GitHubRepo, properties.GitHubBranch))
+    for key in list(objects) + list(legacy):
+        config = json.load(client.get_object(Bucket=bucket, Key=key)['Body'])
+        if config.get('GitHubRepo') == properties.GitHubRepo and config.get('GitHubBranch') == properties.GitHubBranch:
+            configs.setdefault(get_config_filename(S3_PREFIX, key), config)
+    return {
+        'Version': INDEX_VERSION,
+        'GitHubRepo': properties.GitHubRepo,
+        'GitHubBranch': properties.GitHubBranch,
+        'Configs': configs,
+        'Objects': objects
+    }
+
+# One object with every config under the prefix, read by the eval function with CONFIG_SOURCE=snapshot.
+# It is updated like the index, conditional on the ETag that was read, but every stack writes to it so
+# conflicting writers back off for a random time. When it cannot be updated it is deleted, and the eval
+# function reads the per-file configs until the next change seeds a new one. A None config removes it.
+def update_snapshot(client, bucket, changes):
+    from botocore.exceptions import ClientError
+    if not WRITE_SNAPSHOT:
+        return
+    key = build_snapshot_key(S3_PREFIX)
+    for attempt in range(SNAPSHOT_RETRIES):
+        configs, etag = get_snapshot(client, bucket)
+        for filename, config in changes.items():
+            if config is None:
+                configs.pop(filename, None)
+            else:
+                configs[filename] = config
+        condition = {'IfMatch': etag} if etag else {'IfNoneMatch': '*'}
+        try:
+            with metrics.timer('SnapshotPut'):
+                client.put_object(Bucket=bucket, Key=key, Body=encode_snapshot(configs), ContentType='application/octet-stream', **condition)
+            return
+        except ClientError as e:
+            if e.response['Error']['Code'] not in CONFLICT_CODES:
+                raise
+            metrics.count('SnapshotConflicts')
+            time.sleep(random.uniform(0, 0.1 * (attempt + 1)))
+    print(f'Unable to update snapshot {key} after {SNAPSHOT_RETRIES} attempts, deleting it')
+    delete_s3(client, bucket, key)
+
+def get_snapshot(client, bucket):
+    from botocore.exceptions import ClientError
+    try:
+        response = client.get_object(Bucket=bucket, Key=build_snapshot_key(S3_PREFIX))
+    except ClientError as e:
+        if e.response['Error']['Code'] not in ('NoSuchKey', '404'):
+            raise
+        return seed_snapshot(client, bucket), None
+    configs = decode_snapshot(response['Body'].read())
+    if configs is None:
+        return seed_snapshot(client, bucket), response['ETag']
+    return configs, response['ETag']
+
+# Per-file configs, of both key layouts, preferring the repo/branch layout for a config in both
+def seed_snapshot(client, bucket):
+    configs = {}
+    layout = f'{S3_PREFIX}/{KEY_LAYOUT}/'
+    metrics.count('SnapshotSeeds')
+    for page in client.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=f'{S3_PREFIX}/'):
+        for info in page.get('Contents', []):
+            key = info['Key']
+            if key.startswith(f'{S3_PREFIX}/_') or not key.endswith('.json'):
+                continue
+            filename = get_config_filename(S3_PREFIX, key)
+            if filename in configs and not key.startswith(layout):
+                continue
+            configs[filename] = json.load(client.get_object(Bucket=bucket, Key=key)['Body'])
+    return configs
+
+# The eval function caches which repo/branches have configs and revalidates that against the ETag of
+# this marker, so it is rewritten with new content after every change to the configs
+def bump_generation(client, bucket, event):
+    body = json.dumps({'RequestId': event['RequestId'], 'LogicalResourceId': event['LogicalResourceId'], 'Updated': time.time()})
+    put_s3(client, bucket, build_generation_key(S3_PREFIX), body.encode(), 'application/json')
+
+def put_index(client, bucket, key, index, etag):
+    condition = {'IfMatch': etag} if etag else {'IfNoneMatch': '*'}
+    client.put_object(Bucket=bucket, Key=key, Body=json.dumps(index).encode(), ContentType='application/json', **condition)
 
 EVENT_MAP = {
     'Create': handle_create,
@@ -56,12 +245,9 @@ EVENT_MAP = {
     'Delete': handle_delete
 }
 
-@dataclass
-class ResourceProperties:
-    GitHubRepo: str
-    GitHubBranch: str
-    ChangeMatchExpressions: str
-    CodePipelineName: str
+# The config record with the token CloudFormation adds to the properties of every custom resource
+@dataclass(frozen=True)
+class ResourceProperties(ConfigProperties):
     ServiceToken: str = field(default=None)
 
 def extract_and_validate_properties(event, key):
@@ -72,9 +258,29 @@ def extract_and_validate_properties(event, key):
         if f.name not in raw_properties:
             raise ValueError(f'Property {f.name} is missing from the event {properties}')
         properties[f.name] = raw_properties[f.name]
+    for name in OPTIONAL_PROPERTIES:
+        if raw_properties.get(name):
+            properties[name] = raw_properties[name]
 
     return ResourceProperties(**properties)
 
+# Checks what the eval function validates when it loads a config, so a stack with an unusable config
+# fails to deploy instead of the config being skipped on every push. Only applied to the properties
+# being written, old properties are removed as they are.
+def validate_properties(properties):
+    config = props_to_config(properties)
+    validate_config(config)
+    for name in ('ChangeMatchExpressions', 'ExcludeMatchExpressions'):
+        compile_expressions(config, name, check_expression)
+
+# Glob expressions only need checking when they are regular expressions, starting with re:
+def check_expression(expression, syntax):
+    if syntax != 'glob':
+        return re.compile(expression)
+    if expression.startswith('re:'):
+        return re.compile(expression[3:])
+    return None
+
 def get_filename(properties):
     fulltext = f'{properties.GitHubRepo}-{properties.GitHubBranch}-{properties.CodePipelineName}'
     hash = hashlib.sha1(fulltext.encode()).hexdigest().upper()
@@ -82,7 +288,7 @@ def get_filename(properties):
 
 def failure(request, reason):
     print(f'Failed: reason={reason}')
-    print(f'Failed: request={request}')
+    print(f'Failed: request={request.get("RequestId")} resource={request.get("LogicalResourceId")}')
     return get_response(request, False, reason=reason)
 
 def success(request, data):
@@ -106,4 +312,10 @@ def get_response(request, success, reason='', data=None):
     return response
 
 def send_response(url, data):
+    import requests
     requests.put(url, json=data)
+
+metrics = Metrics(METRICS_NAMESPACE, 'cfresource')
+
+def s3_client():
+    return get_client('s3')
@@ -0,0 +1,21 @@
+import threading
+
+# Clients are created on first use and reused for the life of the container, so boto3 is only
+# imported by invocations that call AWS. Creation is locked since the default session is not thread safe.
+# Modules set their botocore Config options per service with configure before the first use.
+CLIENT_CONFIG = {}
+clients = {}
+clients_lock = threading.Lock()
+
+def configure(service, **options):
+    CLIENT_CONFIG[service] = dict(CLIENT_CONFIG.get(service, {}), **options)
+
+def get_client(service):
+    if service not in clients:
+        with clients_lock:
+            if service not in clients:
+                import boto3
+                from botocore.config import Config
+                options = dict({'max_pool_connections': 10, 'tcp_keepalive': True}, **CLIENT_CONFIG.get(service, {}))
+                clients[service] = boto3.client(service, config=Config(**options))
+    return clients[service]
@@ -0,0 +1,37 @@
+import hashlib
+
+# Object keys shared by the cfresource function, which writes the configs, the index, the snapshot and
+# the generation marker, and the eval function, which reads them. Configs live under one prefix per
+# exact repo and branch. Configs written before that layout sit directly under the prefix, named after
+# the repo-branch truncated to 52 characters.
+KEY_LAYOUT = 'v2'
+INDEX_VERSION = 2
+
+def key_hash(value):
+    return hashlib.sha1(value.encode()).hexdigest().upper()[:16]
+
+def build_config_prefix(prefix, repo, branch):
+    return f'{prefix}/{KEY_LAYOUT}/{key_hash(repo)}/{key_hash(branch)}/'
+
+def build_prefix(prefix, repo, branch):
+    filePart = f'{repo}-{branch}'[:52]
+    return f'{prefix}/{filePart}'
+
+def build_legacy_key(prefix, filename):
+    return f'{prefix}/{filename}.json'
+
+# The file name a config was written under, in either layout
+def get_config_filename(prefix, key):
+    name = key[len(prefix) + 1:-len('.json')]
+    return name.split('/', 3)[3] if name.startswith(f'{KEY_LAYOUT}/') else name
+
+def build_index_key(prefix, repo, branch):
+    fulltext = f'{repo}-{branch}'
+    hash = hashlib.sha1(f'{repo}/{branch}'.encode()).hexdigest().upper()
+    return f'{prefix}/_index/{fulltext[:52]}-{hash[:8]}.json'
+
+def build_snapshot_key(prefix):
+    return f'{prefix}/_snapshot.bin'
+
+def build_generation_key(prefix):
+    return f'{prefix}/_generation'
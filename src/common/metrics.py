@@ -0,0 +1,67 @@
+import json
+import threading
+import time
+from contextlib import nullcontext
+
+# Stage durations and counts of one invocation, written as a CloudWatch Embedded Metric Format line
+# when flushed. Enabled by setting METRICS_NAMESPACE, otherwise timers are a shared no-op context and
+# every other call returns straight away.
+class Metrics:
+    def __init__(self, namespace, service, clock=time.perf_counter, emit=print):
+        self.namespace = namespace
+        self.service = service
+        self.enabled = bool(namespace)
+        self.clock = clock
+        self.emit = emit
+        self.lock = threading.Lock()
+        self.timings = {}
+        self.counts = {}
+
+    def timer(self, name):
+        return Timer(self, name) if self.enabled else NULL_TIMER
+
+    def timing(self, name, ms):
+        if self.enabled:
+            with self.lock:
+                self.timings.setdefault(name, []).append(round(ms, 3))
+
+    def count(self, name, value=1):
+        if self.enabled:
+            with self.lock:
+                self.counts[name] = self.counts.get(name, 0) + value
+
+    def flush(self):
+        if not self.enabled:
+            return
+        with self.lock:
+            timings, counts = self.timings, self.counts
+            self.timings, self.counts = {}, {}
+        if not timings and not counts:
+            return
+        definitions = [{'Name': name, 'Unit': 'Milliseconds'} for name in timings]
+        definitions.extend({'Name': name, 'Unit': 'Count'} for name in counts)
+        record = {
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{'Namespace': self.namespace, 'Dimensions': [['Service']], 'Metrics': definitions}]
+            },
+            'Service': self.service
+        }
+        # EMF takes at most 100 values per metric
+        record.update((name, values[:100]) for name, values in timings.items())
+        record.update(counts)
+        self.emit(json.dumps(record, separators=(',', ':')))
+
+class Timer:
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = self.metrics.clock()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.timing(self.name, (self.metrics.clock() - self.start) * 1000)
+
+NULL_TIMER = nullcontext()
@@ -0,0 +1,49 @@
+import re
+from dataclasses import MISSING, dataclass, field, fields
+
+MATCH_SYNTAXES = ('regex', 'glob')
+
+# A pipeline config as the cfresource function writes it from its resource properties and the eval
+# function reads it back. Optional properties that are not set are left out of the stored JSON.
+@dataclass(frozen=True)
+class ConfigProperties:
+    GitHubRepo: str
+    GitHubBranch: str
+    ChangeMatchExpressions: str
+    CodePipelineName: str
+    ExcludeMatchExpressions: str = field(default=None)
+    MatchSyntax: str = field(default=None)
+
+PROPERTIES = tuple(f.name for f in fields(ConfigProperties))
+OPTIONAL_PROPERTIES = tuple(f.name for f in fields(ConfigProperties) if f.default is not MISSING)
+
+# Checks the properties of a stored config and returns its match syntax. Configs written before the
+# repo/branch key layout may lack the properties the reader passes as optional.
+def validate_config(data, optional=()):
+    if not isinstance(data, dict):
+        raise ValueError(f'Config is a {type(data).__name__}, not an object')
+    for name in PROPERTIES:
+        value = data.get(name)
+        if name in OPTIONAL_PROPERTIES or name in optional:
+            if not isinstance(value or '', str):
+                raise ValueError(f'Property {name} must be a string')
+        elif not isinstance(value, str) or not value:
+            raise ValueError(f'Property {name} must be a non-empty string')
+    syntax = data.get('MatchSyntax') or 'regex'
+    if syntax not in MATCH_SYNTAXES:
+        raise ValueError(f'Property MatchSyntax must be one of {", ".join(MATCH_SYNTAXES)}')
+    return syntax
+
+def split_expressions(expressions):
+    return [expression.strip() for expression in expressions.split(',')] if expressions else []
+
+# Compiles each expression of a property with compile(expression, syntax)
+def compile_expressions(data, name, compile):
+    syntax = data.get('MatchSyntax') or 'regex'
+    compiled = []
+    for expression in split_expressions(data.get(name)):
+        try:
+            compiled.append(compile(expression, syntax))
+        except re.error as e:
+            raise ValueError(f'{name} {expression!r} is not a valid regular expression: {e}')
+    return compiled
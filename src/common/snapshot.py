@@ -0,0 +1,66 @@
+import gzip
+import json
+import struct
+from common.schema import split_expressions
+
+SNAPSHOT_MAGIC = b'CPSNAP'
+SNAPSHOT_VERSION = 1
+
+# A version header followed by gzip compressed JSON. Every distinct string is stored once in a table
+# and configs refer to their repo, branch, pipeline name and each of their patterns by position, so
+# patterns repeated across configs and repo/branch names cost one entry. Readers ignore fields past the
+# ones they know, new fields are appended to a config. Exclude patterns follow the patterns when set,
+# and an empty list of them precedes a MatchSyntax other than regex.
+def encode_snapshot(configs):
+    strings, positions = [], {}
+
+    def ref(value):
+        if value not in positions:
+            positions[value] = len(strings)
+            strings.append(value)
+        return positions[value]
+
+    entries = []
+    for filename, config in sorted(configs.items()):
+        patterns = [ref(regex) for regex in split_expressions(config['ChangeMatchExpressions'])]
+        entry = [filename, ref(config.get('GitHubRepo', '')), ref(config.get('GitHubBranch', '')), ref(config['CodePipelineName']), patterns]
+        excludes, syntax = config.get('ExcludeMatchExpressions'), config.get('MatchSyntax') or 'regex'
+        if excludes or syntax != 'regex':
+            entry.append([ref(regex) for regex in split_expressions(excludes)])
+        if syntax != 'regex':
+            entry.append(ref(syntax))
+        entries.append(entry)
+    payload = json.dumps({'Strings': strings, 'Configs': entries}, separators=(',', ':')).encode()
+    return SNAPSHOT_MAGIC + struct.pack('>H', SNAPSHOT_VERSION) + gzip.compress(payload, mtime=0)
+
+# The string table and the config entries, None when the data is not a snapshot of a known version
+def read_snapshot(data):
+    if data[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+        return None
+    version, = struct.unpack_from('>H', data, len(SNAPSHOT_MAGIC))
+    if version != SNAPSHOT_VERSION:
+        print(f'Unknown config snapshot version {version}')
+        return None
+    payload = json.loads(gzip.decompress(data[len(SNAPSHOT_MAGIC) + 2:]))
+    return payload['Strings'], payload['Configs']
+
+# The configs by file name as they were encoded, None when the data is not a snapshot of a known version
+def decode_snapshot(data):
+    snapshot = read_snapshot(data)
+    if snapshot is None:
+        return None
+    strings, entries = snapshot
+    configs = {}
+    for entry in entries:
+        config = {
+            'GitHubRepo': strings[entry[1]],
+            'GitHubBranch': strings[entry[2]],
+            'CodePipelineName': strings[entry[3]],
+            'ChangeMatchExpressions': ','.join(strings[i] for i in entry[4])
+        }
+        if len(entry) > 5 and entry[5]:
+            config['ExcludeMatchExpressions'] = ','.join(strings[i] for i in entry[5])
+        if len(entry) > 6:
+            config['MatchSyntax'] = strings[entry[6]]
+        configs[entry[0]] = config
+    return configs
@@ -1,54 +1,640 @@
 import os
+import sys
 import json
 import re
-import boto3
+import hashlib
+import threading
+import time
+from bisect import bisect_left
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from common.clients import configure, get_client
+from common.layout import (
+    INDEX_VERSION, KEY_LAYOUT, build_config_prefix, build_generation_key, build_index_key, build_prefix, build_snapshot_key,
+    key_hash)
+from common.metrics import Metrics
+from common.schema import MATCH_SYNTAXES, compile_expressions, validate_config
+from common.snapshot import read_snapshot
 
 S3_BUCKET = os.environ['S3_BUCKET']
 S3_PREFIX = os.environ['S3_PREFIX']
-s3client = boto3.client('s3')
+CONFIG_CACHE_SIZE = int(os.environ.get('CONFIG_CACHE_SIZE', '64'))
+CONFIG_CACHE_TTL = int(os.environ.get('CONFIG_CACHE_TTL', '900'))
+PATTERN_CACHE_SIZE = int(os.environ.get('PATTERN_CACHE_SIZE', '1024'))
+CONFIG_FETCH_WORKERS = int(os.environ.get('CONFIG_FETCH_WORKERS', '8'))
+PIPELINE_START_WORKERS = int(os.environ.get('PIPELINE_START_WORKERS', '8'))
+CONFIG_SOURCE = os.environ.get('CONFIG_SOURCE', 'scan')
+READ_LEGACY_KEYS = os.environ.get('READ_LEGACY_KEYS', 'true').lower() == 'true'
+NEGATIVE_CACHE_TTL = int(os.environ.get('NEGATIVE_CACHE_TTL', '0'))
+SNAPSHOT_CHECK_INTERVAL = float(os.environ.get('SNAPSHOT_CHECK_INTERVAL', '30'))
+METRICS_NAMESPACE = os.environ.get('METRICS_NAMESPACE')
 
+S3ObjectInfo = namedtuple('S3ObjectInfo', ['bucket', 'key', 'etag', 'last_modified'], defaults=(None, None))
+
+# When some configs could not be fetched, the pipelines of the others are still started and the
+# invocation then fails so Lambda retries the push. The retry starts those pipelines with the same
+# request tokens, see request_token.
 def handler(event, context):
+    try:
+        event = resolve_event(s3_client(), event)
+        try:
+            names, error = find_pipelines(event), None
+        except ConfigFetchError as e:
+            print(f'{e}, starting the pipelines of the other configs')
+            names, error = match_pipelines(event, e.configs), e
+        summary = start_code_pipelines(names, push=event)
+        if error is not None:
+            raise error
+        return summary
+    finally:
+        metrics.flush()
+
+def find_pipelines(event):
     repo, branch = extract_info(event)
-    infos = get_s3_object_infos(s3client, S3_BUCKET, S3_PREFIX, repo, branch)
-    configs = get_configs(s3client, infos)
-    for config in configs:
-        if is_match(event, config['Matches']):
-            start_code_pipeline(config['CodePipelineName'])
+    with metrics.timer('LoadConfigs'):
+        configs = load_configs(s3_client(), repo, branch)
+    print(f'Pattern cache {pattern_cache.stats()}')
+    return match_pipelines(event, configs)
+
+# Entry point for push events delivered as an SQS batch. Records are grouped by repo/branch so configs
+# are loaded once per group, and only records that failed are reported back for SQS to retry.
+def sqs_handler(event, context):
+    try:
+        return handle_records(event['Records'])
+    finally:
+        metrics.flush()
+
+def handle_records(records):
+    groups = OrderedDict()
+    failures = []
+    metrics.count('Records', len(records))
+    for record in records:
+        try:
+            push = resolve_event(s3_client(), json.loads(record['body']))
+            groups.setdefault(extract_info(push), []).append((record['messageId'], push))
+        except Exception as e:
+            print(f'Unable to read push event from message {record["messageId"]}: {e!r}')
+            failures.append(record['messageId'])
+
+    for (repo, branch), pushes in groups.items():
+        error = None
+        try:
+            configs = load_configs(s3_client(), repo, branch)
+        except ConfigFetchError as e:
+            print(f'{e} for {repo}-{branch}, evaluating the other configs')
+            configs, error = e.configs, e
+        except Exception as e:
+            print(f'Unable to load configs for {repo}-{branch}: {e!r}')
+            failures.extend(messageId for messageId, _ in pushes)
+            continue
+        for messageId, push in pushes:
+            try:
+                summary = evaluate(push, configs)
+            except Exception as e:
+                print(f'Unable to evaluate message {messageId}: {e!r}')
+                failures.append(messageId)
+                continue
+            if error is not None or any(result['Error'] for result in summary):
+                failures.append(messageId)
+
+    print(f'Pattern cache {pattern_cache.stats()}')
+    metrics.count('RecordFailures', len(failures))
+    return {'batchItemFailures': [{'itemIdentifier': messageId} for messageId in failures]}
+
+def evaluate(event, configs):
+    return start_code_pipelines(match_pipelines(event, configs), push=event)
+
+# Paths are fed to the matcher as they are read, so it stops reading once every config matched.
+# Paths counts the distinct paths it read.
+def match_pipelines(event, configs):
+    seen = set()
+    with metrics.timer('Match'):
+        matcher = Matcher(configs)
+        matched = matcher.match(iter_unique_paths(event, seen))
+    metrics.count('Paths', len(seen))
+    metrics.count('PatternsEvaluated', len(matcher.targets))
+    metrics.count('PipelinesMatched', len(matched))
+    return [config.CodePipelineName for config in matched]
+
+# Pushes too large for the invoke payload are spilled to S3 by the webhook as JSON lines, a header
+# followed by one changed path per line, and arrive here as a pointer that repeats the header. The
+# paths are left as a generator that the matcher consumes once: the object is only opened when the
+# configs are loaded and matching starts, streamed line by line, and not read further once every
+# config matched.
+def resolve_event(client, event):
+    location = event.get('PayloadLocation')
+    if location is None:
+        return event
+    resolved = {name: value for name, value in event.items() if name != 'PayloadLocation'}
+    resolved['commits'] = [{'added': read_spilled_paths(client, location), 'removed': [], 'modified': []}]
+    return resolved
+
+def read_spilled_paths(client, location):
+    with metrics.timer('ResolveEvent'):
+        body = client.get_object(Bucket=location['Bucket'], Key=location['Key'])['Body']
+    count = 0
+    try:
+        lines = body.iter_lines()
+        next(lines, None)
+        for line in lines:
+            if line:
+                count += 1
+                yield json.loads(line)
+    finally:
+        body.close()
+        print(f'Read {count} changed paths from s3://{location["Bucket"]}/{location["Key"]}')
 
 def extract_info(event):
     branch = event['ref'].split('/')[-1]
     repo = event['repository']['name']
     return (repo, branch)
 
+def load_configs(client, repo, branch):
+    if CONFIG_SOURCE == 'snapshot':
+        configs = config_snapshot.get(client, repo, branch)
+        if configs is not None:
+            return configs
+        print(f'No config snapshot loaded, scanning configs for {repo}-{branch}')
+    if not configured_branches.is_configured(client, repo, branch):
+        print(f'No configs for {repo}-{branch}')
+        metrics.count('Unconfigured')
+        return []
+    if CONFIG_SOURCE == 'index':
+        configs = get_index_configs(client, S3_BUCKET, S3_PREFIX, repo, branch)
+        if configs is not None:
+            return configs
+        print(f'No usable index for {repo}-{branch}, scanning configs')
+    infos = get_s3_object_infos(client, S3_BUCKET, S3_PREFIX, repo, branch)
+    try:
+        configs = get_configs(client, infos, build_config_prefix(S3_PREFIX, repo, branch))
+    except ConfigFetchError as e:
+        raise ConfigFetchError([config for config in e.configs if belongs_to(config, repo, branch)], e.errors)
+    return [config for config in configs if belongs_to(config, repo, branch)]
+
+# Legacy keys are listed by a truncated repo-branch prefix that also matches longer repo or branch
+# names, so configs naming another repo or branch are dropped
+def belongs_to(config, repo, branch):
+    return config.GitHubRepo in (None, repo) and config.GitHubBranch in (None, branch)
+
+# Resolves a repo/branch with the single index object maintained by the cfresource function. A cached
+# index is revalidated with a conditional GET. Returns None when the index is missing or has an
+# unknown version so the caller can fall back to scanning the per-file configs. Everything that writes
+# configs, the cfresource function and cfresource.migrate, updates the index along with them.
+def get_index_configs(client, bucket, prefix, repo, branch):
+    from botocore.exceptions import ClientError
+    key = build_index_key(prefix, repo, branch)
+    cached = config_cache.lookup(key, key)
+    args = {'Bucket': bucket, 'Key': key}
+    if cached:
+        args['IfNoneMatch'] = cached[0]
+    try:
+        with metrics.timer('IndexGet'):
+            response = client.get_object(**args)
+    except ClientError as e:
+        code = e.response['Error']['Code']
+        if cached and code in ('304', 'NotModified'):
+            metrics.count('IndexNotModified')
+            config_cache.put(key, {key: cached})
+            return cached[2]
+        if code in ('NoSuchKey', '404'):
+            return None
+        raise
+    index = json.load(response['Body'])
+    if index.get('Version') != INDEX_VERSION:
+        return None
+    configs = []
+    for name, data in index['Configs'].items():
+        try:
+            configs.append(parse_config(data))
+        except ValueError as e:
+            print(f'Skipping config {name} in {key}: {e}')
+            metrics.count('ConfigErrors')
+    config_cache.put(key, {key: (response['ETag'], response.get('LastModified'), configs)})
+    return configs
+
+# Lists the configs written under the exact repo/branch prefix and, while READ_LEGACY_KEYS is set, the
+# ones still under the legacy truncated repo-branch prefix
 def get_s3_object_infos(client, bucket, prefix, repo, branch):
-    prefix = build_prefix(prefix, repo, branch)
+    results = list_object_infos(client, bucket, build_config_prefix(prefix, repo, branch))
+    if READ_LEGACY_KEYS:
+        results.extend(list_object_infos(client, bucket, build_prefix(prefix, repo, branch)))
+    return results
+
+def list_object_infos(client, bucket, prefix):
     list_objects = client.get_paginator('list_objects_v2')
     args = {'Bucket': bucket, 'Prefix': prefix}
     results = []
-    for page in list_objects.paginate(**args):
-        if 'Contents' in page:
-            for info in page['Contents']:
-                results.append((bucket, info['Key']))
+    with metrics.timer('S3List'):
+        for page in list_objects.paginate(**args):
+            metrics.count('S3ListPages')
+            if 'Contents' in page:
+                for info in page['Contents']:
+                    results.append(S3ObjectInfo(bucket, info['Key'], info.get('ETag'), info.get('LastModified')))
     return results
 
-def build_prefix(prefix, repo, branch):
-    filePart = f'{repo}-{branch}'[:52]
-    return f'{prefix}/{filePart}'
-
-def get_configs(client, s3infos):
+# Invalid configs and objects deleted since the listing are skipped. Any other error, e.g. throttling,
+# is raised as a ConfigFetchError once every object was tried, carrying the configs that were read.
+def get_configs(client, s3infos, prefix=None, workers=CONFIG_FETCH_WORKERS):
+    cached = [config_cache.get(prefix, info.key, info.etag) for info in s3infos]
+    missing = [info for info, config in zip(s3infos, cached) if config is None]
+    metrics.count('ConfigsScanned', len(s3infos))
+    metrics.count('ConfigCacheHits', len(s3infos) - len(missing))
+    metrics.count('ConfigCacheMisses', len(missing))
+    fetched = iter(fetch_configs(client, missing, workers))
     configs = []
-    for info in s3infos:
-        config = json.load(client.get_object(Bucket=info[0], Key=info[1])['Body'])
-        config['Matches'] = build_regex_matches(config['ChangeMatchExpressions'])
+    objects = {}
+    errors = {}
+    for info, config in zip(s3infos, cached):
+        if config is None:
+            config, error = next(fetched)
+            if error is not None:
+                print(f'Unable to load config {info.bucket}/{info.key}: {error!r}')
+                metrics.count('ConfigErrors')
+                if not is_permanent(error):
+                    errors[info.key] = error
+                continue
+        objects[info.key] = (info.etag, info.last_modified, config)
         configs.append(config)
+    config_cache.put(prefix, objects)
+    if errors:
+        raise ConfigFetchError(configs, errors)
     return configs
 
-def build_regex_matches(changeMatchExpressions):
+def is_permanent(error):
+    if isinstance(error, ValueError):
+        return True
+    return getattr(error, 'response', {}).get('Error', {}).get('Code') in ('NoSuchKey', '404')
+
+class ConfigFetchError(Exception):
+    def __init__(self, configs, errors):
+        super().__init__(f'Unable to fetch {len(errors)} configs: {", ".join(sorted(errors))}')
+        self.configs = configs
+        self.errors = errors
+
+# Fetches with a bounded pool sharing the thread safe client. Results keep the order of s3infos and
+# each is a (config, error) pair so one failing object does not stop the others.
+def fetch_configs(client, s3infos, workers=CONFIG_FETCH_WORKERS):
+    def fetch(info):
+        try:
+            return (load_config(client, info.bucket, info.key), None)
+        except Exception as e:
+            return (None, e)
+
+    return map_bounded(fetch, s3infos, workers)
+
+def map_bounded(fn, items, workers):
+    if workers <= 1 or len(items) <= 1:
+        return [fn(item) for item in items]
+    with ThreadPoolExecutor(max_workers=min(workers, len(items))) as executor:
+        return list(executor.map(fn, items))
+
+def load_config(client, bucket, key):
+    with metrics.timer('S3Get'):
+        data = json.load(client.get_object(Bucket=bucket, Key=key)['Body'])
+    return parse_config(data)
+
+# What a config is reduced to once loaded. Only the fields matching and starting need are kept, the
+# patterns come from the shared pattern cache and repo/branch names are interned, so caches can hold
+# thousands of configs. Configs are validated against common.schema, shared with the cfresource function.
+# Excludes holds the compiled ExcludeMatchExpressions, empty when the config has none.
+@dataclass(frozen=True)
+class PipelineConfig:
+    __slots__ = ('CodePipelineName', 'GitHubRepo', 'GitHubBranch', 'Matches', 'Excludes')
+    CodePipelineName: str
+    GitHubRepo: str
+    GitHubBranch: str
+    Matches: tuple
+    Excludes: tuple
+
+def parse_config(data):
+    validate_config(data, optional=('GitHubRepo', 'GitHubBranch'))
+    matches = tuple(compile_expressions(data, 'ChangeMatchExpressions', compile_match))
+    excludes = tuple(compile_expressions(data, 'ExcludeMatchExpressions', compile_match))
+    repo, branch = data.get('GitHubRepo'), data.get('GitHubBranch')
+    return PipelineConfig(
+        data['CodePipelineName'],
+        sys.intern(repo) if repo else None,
+        sys.intern(branch) if branch else None,
+        matches,
+        excludes)
+
+# Survives between invocations of a warm container. Keyed by the repo/branch S3 prefix, an object is
+# served from memory while its ETag in the latest listing is unchanged and the prefix entry is within the TTL.
+class ConfigCache:
+    def __init__(self, max_size, ttl, clock=time.monotonic):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self.entries = OrderedDict()
+
+    def get(self, prefix, key, etag):
+        cached = self.lookup(prefix, key)
+        return cached[2] if cached and etag is not None and cached[0] == etag else None
+
+    def lookup(self, prefix, key):
+        entry = self.entries.get(prefix)
+        if entry is None:
+            return None
+        loaded, objects = entry
+        if self.clock() - loaded > self.ttl:
+            del self.entries[prefix]
+            return None
+        self.entries.move_to_end(prefix)
+        return objects.get(key)
+
+    def put(self, prefix, objects):
+        if prefix is None or self.max_size <= 0:
+            return
+        entry = self.entries.get(prefix)
+        loaded = entry[0] if entry and self.clock() - entry[0] <= self.ttl else self.clock()
+        self.entries[prefix] = (loaded, objects)
+        self.entries.move_to_end(prefix)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+config_cache = ConfigCache(CONFIG_CACHE_SIZE, CONFIG_CACHE_TTL)
+
+# Which repo/branches have any config, from one listing of the whole prefix, so pushes to branches
+# without configs skip the per push listing. A branch found in the listing is simply loaded as usual.
+# Before a branch is reported as unconfigured the generation marker, rewritten by the cfresource
+# function after every change, is revalidated with a conditional GET, and the listing is redone when
+# the marker changed or the listing is older than the ttl. A ttl of 0 disables the check.
+class ConfiguredBranches:
+    def __init__(self, bucket, prefix, ttl, clock=time.monotonic):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.ttl = ttl
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.loaded = None
+        self.generation = None
+        self.exact = set()
+        self.legacy = []
+
+    def is_configured(self, client, repo, branch):
+        if self.ttl <= 0:
+            return True
+        with self.lock:
+            if self.loaded is not None and self.contains(repo, branch):
+                return True
+            generation = get_generation(client, self.bucket, self.prefix, self.generation)
+            if self.loaded is None or generation != self.generation or self.clock() - self.loaded > self.ttl:
+                self.refresh(client, generation)
+            return self.contains(repo, branch)
+
+    def contains(self, repo, branch):
+        if (key_hash(repo), key_hash(branch)) in self.exact:
+            return True
+        if not READ_LEGACY_KEYS:
+            return False
+        name = build_prefix(self.prefix, repo, branch)
+        position = bisect_left(self.legacy, name)
+        return position < len(self.legacy) and self.legacy[position].startswith(name)
+
+    def refresh(self, client, generation):
+        exact, legacy = set(), []
+        layout = f'{self.prefix}/{KEY_LAYOUT}/'
+        with metrics.timer('ConfiguredRefresh'):
+            for info in list_object_infos(client, self.bucket, f'{self.prefix}/'):
+                if info.key.startswith(layout):
+                    parts = info.key[len(layout):].split('/', 2)
+                    if len(parts) == 3:
+                        exact.add((parts[0], parts[1]))
+                elif info.key.endswith('.json') and not info.key.startswith(f'{self.prefix}/_'):
+                    legacy.append(info.key)
+        legacy.sort()
+        self.exact, self.legacy = exact, legacy
+        self.generation = generation
+        self.loaded = self.clock()
+        print(f'Listed configs of {len(exact)} repo/branches and {len(legacy)} legacy keys, generation {generation}')
+
+# The ETag of the generation marker, None when there is none yet
+def get_generation(client, bucket, prefix, etag=None):
+    from botocore.exceptions import ClientError
+    args = {'Bucket': bucket, 'Key': build_generation_key(prefix)}
+    if etag:
+        args['IfNoneMatch'] = etag
+    try:
+        with metrics.timer('GenerationGet'):
+            return client.get_object(**args)['ETag']
+    except ClientError as e:
+        code = e.response['Error']['Code']
+        if etag and code in ('304', 'NotModified'):
+            return etag
+        if code in ('NoSuchKey', '404'):
+            return None
+        raise
+
+configured_branches = ConfiguredBranches(S3_BUCKET, S3_PREFIX, NEGATIVE_CACHE_TTL)
+
+# Every config under the prefix held in memory as repo -> branch -> configs, loaded once per container
+# so a push is resolved without any S3 call. At most every check_interval seconds a background thread
+# revalidates the generation marker and, when it changed, lists the prefix again and fetches only the
+# objects whose ETag changed. Pushes keep using the previous snapshot until the new one is complete.
+class ConfigSnapshot:
+    def __init__(self, bucket, prefix, check_interval, clock=time.monotonic):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.check_interval = check_interval
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.branches = None
+        self.objects = {}
+        self.generation = None
+        self.checked = None
+        self.thread = None
+
+    def get(self, client, repo, branch):
+        if self.branches is None and not self.preload(client):
+            return None
+        if self.clock() - self.checked >= self.check_interval:
+            self.refresh_in_background(client)
+        return self.branches.get(repo, {}).get(branch, [])
+
+    def preload(self, client):
+        try:
+            self.load(client)
+            return True
+        except Exception as e:
+            print(f'Unable to load config snapshot: {e!r}')
+            return False
+
+    # Without a generation marker every check lists the prefix again
+    def load(self, client, check=False):
+        with self.lock:
+            if not check and self.branches is not None:
+                return
+            generation = get_generation(client, self.bucket, self.prefix, self.generation if check else None)
+            if check and generation is not None and generation == self.generation:
+                self.checked = self.clock()
+                return
+            with metrics.timer('SnapshotLoad'):
+                self.build(client, generation)
+
+    def build(self, client, generation):
+        branches = get_snapshot_branches(client, self.bucket, self.prefix)
+        if branches is not None:
+            self.objects, self.branches = {}, branches
+            self.generation = generation
+            self.checked = self.clock()
+            print(f'Loaded config snapshot object of {sum(len(b) for b in branches.values())} repo/branches, generation {generation}')
+            return
+        infos = [info for info in list_object_infos(client, self.bucket, f'{self.prefix}/') if self.is_config(info.key)]
+        cached = [self.objects.get(info.key) for info in infos]
+        missing = [info for info, entry in zip(infos, cached) if entry is None or entry[0] != info.etag]
+        fetched = dict(zip((info.key for info in missing), fetch_configs(client, missing)))
+        objects, branches, errors = {}, {}, {}
+        for info, entry in zip(infos, cached):
+            if info.key in fetched:
+                config, error = fetched[info.key]
+                if error is not None:
+                    print(f'Unable to load config {info.bucket}/{info.key}: {error!r}')
+                    metrics.count('ConfigErrors')
+                    if not is_permanent(error):
+                        errors[info.key] = error
+                    continue
+                entry = (info.etag, config)
+            objects[info.key] = entry
+            config = entry[1]
+            branches.setdefault(config.GitHubRepo, {}).setdefault(config.GitHubBranch, []).append(config)
+        if errors:
+            # An incomplete snapshot would skip those configs until the next change, keep the previous one
+            raise ConfigFetchError([], errors)
+        self.objects, self.branches = objects, branches
+        self.generation = generation
+        self.checked = self.clock()
+        metrics.count('SnapshotFetches', len(missing))
+        print(f'Loaded config snapshot of {len(objects)} configs, fetched {len(missing)}, generation {generation}')
+
+    def is_config(self, key):
+        if key.startswith(f'{self.prefix}/{KEY_LAYOUT}/'):
+            return True
+        return READ_LEGACY_KEYS and key.endswith('.json') and not key.startswith(f'{self.prefix}/_')
+
+    def refresh_in_background(self, client):
+        if self.thread is not None and self.thread.is_alive():
+            return
+        self.checked = self.clock()
+        self.thread = threading.Thread(target=self.refresh, args=(client,), daemon=True)
+        self.thread.start()
+
+    def refresh(self, client):
+        try:
+            self.load(client, check=True)
+        except Exception as e:
+            print(f'Unable to refresh config snapshot, keeping the previous one: {e!r}')
+
+config_snapshot = ConfigSnapshot(S3_BUCKET, S3_PREFIX, SNAPSHOT_CHECK_INTERVAL)
+
+# The snapshot object the cfresource function maintains when WRITE_SNAPSHOT is set, as repo -> branch
+# -> configs. None when there is none or it has an unknown version, the per-file configs are read then.
+def get_snapshot_branches(client, bucket, prefix):
+    from botocore.exceptions import ClientError
+    try:
+        with metrics.timer('SnapshotGet'):
+            data = client.get_object(Bucket=bucket, Key=build_snapshot_key(prefix))['Body'].read()
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+            return None
+        raise
+    return decode_branches(data)
+
+# Builds the configs straight from the entries of common.snapshot, which refer to their repo, branch,
+# pipeline name, patterns and, when they have any, exclude patterns and match syntax by position in a
+# table of distinct strings. Each distinct pattern is compiled once.
+def decode_branches(data):
+    snapshot = read_snapshot(data)
+    if snapshot is None:
+        return None
+    strings = [sys.intern(value) for value in snapshot[0]]
+    compiled = {}
+    branches = {}
+    for entry in snapshot[1]:
+        excludes = entry[5] if len(entry) > 5 else ()
+        syntax = strings[entry[6]] if len(entry) > 6 else 'regex'
+        try:
+            if syntax not in MATCH_SYNTAXES:
+                raise ValueError(f'unknown MatchSyntax {syntax!r}')
+            for i in (*entry[4], *excludes):
+                if (syntax, i) not in compiled:
+                    compiled[syntax, i] = compile_match(strings[i], syntax)
+        except (re.error, ValueError) as e:
+            print(f'Skipping config {entry[0]} in snapshot: {e}')
+            metrics.count('ConfigErrors')
+            continue
+        repo, branch = strings[entry[1]] or None, strings[entry[2]] or None
+        config = PipelineConfig(strings[entry[3]], repo, branch, tuple(compiled[syntax, i] for i in entry[4]),
+                                tuple(compiled[syntax, i] for i in excludes))
+        branches.setdefault(repo, {}).setdefault(branch, []).append(config)
+    return branches
+
+def build_regex_matches(changeMatchExpressions, syntax='regex'):
     change_matches = []
     for regex in changeMatchExpressions.split(','):
-        change_matches.append(re.compile(regex.strip()))
+        change_matches.append(compile_match(regex.strip(), syntax))
     return change_matches
 
+# With the glob syntax an expression is only a regular expression when it starts with re:
+def compile_match(expression, syntax='regex'):
+    if syntax != 'glob':
+        return pattern_cache.compile(expression)
+    if expression.startswith('re:'):
+        return pattern_cache.compile(expression[3:])
+    return pattern_cache.compile_glob(expression)
+
+# Process wide store of compiled patterns so identical expressions are compiled once and shared
+# across configs and warm invocations. Least recently used patterns are evicted past max_size.
+class PatternCache:
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.patterns = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def compile(self, regex):
+        return self.get(regex, regex, re.compile)
+
+    def compile_glob(self, glob):
+        return self.get(('glob', glob), glob, parse_glob)
+
+    # Configs are parsed on the fetch workers, so the lookup and the insert are locked. Patterns are
+    # compiled outside the lock, two threads missing on the same key both compile it.
+    def get(self, key, source, build):
+        with self.lock:
+            pattern = self.patterns.get(key)
+            if pattern is not None:
+                self.hits += 1
+                self.patterns.move_to_end(key)
+            else:
+                self.misses += 1
+        if pattern is not None:
+            metrics.count('PatternCacheHits')
+            return pattern
+        metrics.count('PatternCacheMisses')
+        pattern = build(source)
+        if self.max_size > 0:
+            with self.lock:
+                self.patterns[key] = pattern
+                while len(self.patterns) > self.max_size:
+                    self.patterns.popitem(last=False)
+        return pattern
+
+    def stats(self):
+        return {'size': len(self.patterns), 'hits': self.hits, 'misses': self.misses}
+
+    def clear(self):
+        with self.lock:
+            self.patterns.clear()
+            self.hits = 0
+            self.misses = 0
+
+pattern_cache = PatternCache(PATTERN_CACHE_SIZE)
+
 def is_match(event, regex):
     changes = extract_paths(event)
     for r in regex:
@@ -58,23 +644,342 @@ def is_match(event, regex):
                 return True
     return False
 
+# Patterns using backreferences, named groups, conditionals or global inline flags change meaning
+# when embedded in a larger expression, so they are always evaluated on their own.
+UNCOMBINABLE = re.compile(r'\\[1-9]|\(\?P[=<]|\(\?\(|\(\?[aiLmsux]+\)')
+
+# Matches the changed paths of a push against every config in a single pass. Identical patterns are
+# shared between configs, and combinable patterns are joined into one alternation so a path that
+# matches nothing is rejected with a single regex call. Without excludes the set of matched configs
+# is the same as calling is_match for each config.
+# A path matching one of a config's Excludes does not match that config, whatever its Matches say, but
+# other paths of the push still can. Excludes are only tried on a path that matched an include of a
+# config having them, each distinct exclude at most once per path, and literal prefixes without a regex.
+class Matcher:
+    def __init__(self, configs, prefix_index=True):
+        self.configs = configs
+        targets = OrderedDict()
+        excludes = OrderedDict()
+        self.config_excludes = []
+        for index, config in enumerate(configs):
+            for pattern in config.Matches:
+                targets.setdefault(pattern, (pattern, []))[1].append(index)
+            self.config_excludes.append(tuple(excludes.setdefault(p, (len(excludes), p))[0] for p in config.Excludes))
+        self.targets = list(targets.values())
+        self.excludes = [(p, literal_prefix(p) if prefix_index else None) for _, p in excludes.values()]
+        self.config_targets = [[] for _ in configs]
+        for i, (_, indices) in enumerate(self.targets):
+            for index in indices:
+                self.config_targets[index].append(i)
+        self.prefixes = PrefixIndex()
+        self.basenames = {}
+        self.verified = set()
+        self.combinable = []
+        self.separate = []
+        for i, (pattern, _) in enumerate(self.targets):
+            prefix = literal_prefix(pattern) if prefix_index else None
+            if prefix is not None:
+                self.prefixes.add(prefix, i)
+            elif prefix_index and isinstance(pattern, Glob) and pattern.basename is not None:
+                self.basenames.setdefault(pattern.basename, []).append(i)
+            elif prefix_index and isinstance(pattern, Glob):
+                self.prefixes.add(pattern.prefix, i)
+                self.verified.add(i)
+            elif is_combinable(pattern):
+                self.combinable.append(i)
+            else:
+                self.separate.append(i)
+        try:
+            build_combined(self.targets, self.combinable)
+        except re.error as e:
+            print(f'Unable to combine patterns, matching separately: {e}')
+            self.separate.extend(self.combinable)
+            self.combinable = []
+
+    def match(self, paths):
+        remaining = set(range(len(self.configs)))
+        if not remaining:
+            return []
+        pending = set(range(len(self.targets)))
+        active = list(self.combinable)
+        combined = build_combined(self.targets, active)
+        for path in paths:
+            excluded = {} if self.excludes else None
+            for i in self.prefixes.lookup(path):
+                if i in pending and (i not in self.verified or self.targets[i][0].match_rest(path)):
+                    self.matched(i, path, remaining, pending, excluded)
+            if self.basenames:
+                for i in self.basenames.get(path[path.rfind('/') + 1:], ()):
+                    if i in pending and self.targets[i][0].match(path):
+                        self.matched(i, path, remaining, pending, excluded)
+            if combined is not None:
+                found = combined.match(path)
+                if found:
+                    position = int(found.lastgroup[1:])
+                    changed = False
+                    for i in active[position:]:
+                        if i in pending and (i == active[position] or self.targets[i][0].match(path)):
+                            self.matched(i, path, remaining, pending, excluded)
+                            changed = True
+                    if changed and len(active) > 1:
+                        still_active = [i for i in active if i in pending]
+                        if len(still_active) <= len(active) // 2:
+                            active = still_active
+                            combined = build_combined(self.targets, active)
+            for i in self.separate:
+                if i in pending and self.targets[i][0].match(path):
+                    self.matched(i, path, remaining, pending, excluded)
+            if not remaining:
+                break
+        return [config for index, config in enumerate(self.configs) if index not in remaining]
+
+    def matched(self, target, path, remaining, pending, excluded):
+        pattern, indices = self.targets[target]
+        for index in indices:
+            if index in remaining and not (self.config_excludes[index] and self.is_excluded(index, path, excluded)):
+                print(f'found match with {pattern.pattern} for {self.configs[index].CodePipelineName}')
+                remaining.discard(index)
+                for i in self.config_targets[index]:
+                    if i in pending and all(other not in remaining for other in self.targets[i][1]):
+                        pending.discard(i)
+
+    # excluded holds the outcome of each exclude already tried on this path
+    def is_excluded(self, index, path, excluded):
+        for i in self.config_excludes[index]:
+            if i not in excluded:
+                pattern, prefix = self.excludes[i]
+                excluded[i] = path.startswith(prefix) if prefix is not None else bool(pattern.match(path))
+            if excluded[i]:
+                return True
+        return False
+
+# A pattern made of an optional ^, literal characters and an optional trailing .* only checks that a
+# path starts with the literal text under re.match, so it can be resolved without running the regex.
+LITERAL_PREFIX = re.compile(r'\^?((?:[^.^$*+?{}\[\]\\|()]|\\[^0-9A-Za-z])*)(?:\.\*)?')
+LITERAL_ESCAPE = re.compile(r'\\(.)')
+
+def literal_prefix(pattern):
+    if isinstance(pattern, Glob):
+        return pattern.prefix if pattern.segments == (None,) else None
+    if pattern.flags != re.UNICODE:
+        return None
+    found = LITERAL_PREFIX.fullmatch(pattern.pattern)
+    return LITERAL_ESCAPE.sub(r'\1', found.group(1)) if found else None
+
+# Literal prefixes grouped by length, so the prefixes of a path are found with one dict lookup per
+# distinct prefix length instead of one regex per pattern.
+class PrefixIndex:
+    def __init__(self):
+        self.prefixes = {}
+        self.lengths = []
+
+    def add(self, prefix, target):
+        if prefix not in self.prefixes:
+            self.prefixes[prefix] = []
+            self.lengths = sorted(set(self.lengths) | {len(prefix)})
+        self.prefixes[prefix].append(target)
+
+    def lookup(self, path):
+        for length in self.lengths:
+            if length > len(path):
+                break
+            targets = self.prefixes.get(path[:length])
+            if targets:
+                yield from targets
+
+    def __len__(self):
+        return len(self.prefixes)
+
+# A glob matched against the whole changed path: * and ? match within one path segment, [...] one
+# character of a set, \\ escapes the next character, and a ** segment matches any number of whole
+# segments, at least one at the end. The leading literal segments are a prefix looked up through the
+# PrefixIndex, or a literal last segment, the basename, through a dict when there is one. The remaining
+# segments are compared one by one with string operations. Only segments using ? or [...] are matched
+# with a regex, of that segment alone. None stands for a ** segment.
+@dataclass(frozen=True)
+class Glob:
+    __slots__ = ('pattern', 'prefix', 'segments', 'basename')
+    pattern: str
+    prefix: str
+    segments: tuple
+    basename: str
+
+    def __eq__(self, other):
+        return isinstance(other, Glob) and other.pattern == self.pattern
+
+    def __hash__(self):
+        return hash((Glob, self.pattern))
+
+    def match(self, path):
+        return path.startswith(self.prefix) and self.match_rest(path)
+
+    # Only checks the part of the path after the prefix, which the caller already found
+    def match_rest(self, path):
+        rest = path[len(self.prefix):]
+        segments = self.segments
+        if not segments:
+            return not rest
+        if len(segments) == 2 and segments[0] is None:
+            return segments[1](rest[rest.rfind('/') + 1:])
+        return match_segments(segments, rest.split('/'), 0, 0)
+
+GLOB_SPECIAL = re.compile(r'[*?\[\\]')
+
+def parse_glob(glob):
+    parts = glob.lstrip('/').split('/')
+    literal = 0
+    while literal < len(parts) and not GLOB_SPECIAL.search(parts[literal]):
+        literal += 1
+    if literal == len(parts):
+        return Glob(glob, '/'.join(parts), (), None)
+    segments = []
+    for part in parts[literal:]:
+        if part != '**':
+            segments.append(segment_matcher(part))
+        elif not segments or segments[-1] is not None:
+            segments.append(None)
+    basename = parts[-1] if not GLOB_SPECIAL.search(parts[-1]) else None
+    return Glob(glob, ''.join(f'{part}/' for part in parts[:literal]), tuple(segments), basename)
+
+def segment_matcher(part):
+    if not GLOB_SPECIAL.search(part):
+        return part.__eq__
+    pieces = part.split('*')
+    if len(pieces) == 2 and not GLOB_SPECIAL.search(part.replace('*', '')):
+        head, tail = pieces
+        size = len(head) + len(tail)
+        return lambda segment: len(segment) >= size and segment.startswith(head) and segment.endswith(tail)
+    return re.compile(translate_segment(part), re.DOTALL).fullmatch
+
+def translate_segment(part):
+    regex = []
+    i = 0
+    while i < len(part):
+        c = part[i]
+        i += 1
+        if c == '*':
+            while i < len(part) and part[i] == '*':
+                i += 1
+            regex.append('.*')
+        elif c == '?':
+            regex.append('.')
+        elif c == '\\' and i < len(part):
+            regex.append(re.escape(part[i]))
+            i += 1
+        elif c == '[':
+            end = part.find(']', i + 2 if part[i:i + 1] in ('!', '^') else i + 1)
+            if end < 0:
+                regex.append('\\[')
+                continue
+            chars = part[i:end].replace('\\', '\\\\')
+            regex.append(f'[^{chars[1:]}]' if chars[0] in '!^' else f'[{chars}]')
+            i = end + 1
+        else:
+            regex.append(re.escape(c))
+    return ''.join(regex)
+
+def match_segments(segments, parts, s, p):
+    while s < len(segments):
+        segment = segments[s]
+        if segment is None:
+            if s == len(segments) - 1:
+                return p < len(parts)
+            return any(match_segments(segments, parts, s + 1, start) for start in range(p, len(parts)))
+        if p >= len(parts) or not segment(parts[p]):
+            return False
+        s += 1
+        p += 1
+    return p == len(parts)
+
+def is_combinable(pattern):
+    if isinstance(pattern, Glob):
+        return False
+    return pattern.flags == re.UNICODE and not UNCOMBINABLE.search(pattern.pattern)
+
+# Alternations change whenever the active set shrinks, so they are left to the re module's own cache
+# rather than taking slots of config patterns in pattern_cache
+def build_combined(targets, active):
+    if not active:
+        return None
+    alternation = '|'.join(f'(?P<p{position}>{targets[i][0].pattern})' for position, i in enumerate(active))
+    return re.compile(alternation)
+
 def extract_paths(event):
-    changes = []
+    return list(iter_unique_paths(event))
+
+# Each changed path once, in order, as the commits are read
+def iter_unique_paths(event, seen=None):
+    seen = set() if seen is None else seen
+    for path in iter_paths(event):
+        if path not in seen:
+            seen.add(path)
+            yield path
+
+def iter_paths(event):
     for commit in event['commits']:
         for i in ['added', 'removed', 'modified']:
-            changes += commit[i]
-    return changes
+            yield from commit[i]
+
+# Starts each distinct pipeline once, concurrently, and returns a summary per start in name order
+def start_code_pipelines(pipelineNames, workers=PIPELINE_START_WORKERS, push=None):
+    names = list(dict.fromkeys(pipelineNames))
+    if names:
+        codepipeline_client()
+    summary = map_bounded(lambda name: dispatch_pipeline(name, request_token(push, name)), names, workers)
+    for result in summary:
+        print(f'Pipeline start {result}')
+    return summary
+
+def dispatch_pipeline(pipelineName, token=None):
+    start = time.perf_counter()
+    executionId, error = None, None
+    try:
+        executionId = start_code_pipeline(pipelineName, token)
+    except Exception as e:
+        error = repr(e)
+    latency = (time.perf_counter() - start) * 1000
+    metrics.timing('PipelineStart', latency)
+    if error is not None:
+        metrics.count('PipelineStartErrors')
+    return {
+        'CodePipelineName': pipelineName,
+        'ExecutionId': executionId,
+        'LatencyMs': round(latency, 1),
+        'Error': error
+    }
 
-def start_code_pipeline(pipelineName):
+def start_code_pipeline(pipelineName, token=None):
     client = codepipeline_client()
     print(f'Starting code pipeline: {pipelineName}')
-    response = client.start_pipeline_execution(name=pipelineName)
-    print(f'Start response {response}')
+    args = {'name': pipelineName}
+    if token:
+        args['clientRequestToken'] = token
+    response = client.start_pipeline_execution(**args)
+    return response['pipelineExecutionId']
+
+# Starts for one push are idempotent on the commits it moved the branch between, so when a push is
+# retried after a partial failure CodePipeline returns the executions it already started instead of
+# starting them again. A later push back to an already built commit, e.g. a rollback, moves the branch
+# from another commit and starts new executions. Pushes without the head commit get a new token from
+# botocore on every start.
+def request_token(push, pipelineName):
+    if not push or not push.get('after'):
+        return None
+    repo, branch = extract_info(push)
+    return hashlib.sha1(f'{repo}/{branch}/{push.get("before")}/{push["after"]}/{pipelineName}'.encode()).hexdigest()
+
+metrics = Metrics(METRICS_NAMESPACE, 'eval')
+
+def s3_client():
+    return get_client('s3')
 
-cpclient = None
 def codepipeline_client():
-    import boto3
-    global cpclient
-    if not cpclient:
-        cpclient = boto3.client('codepipeline')
-    return cpclient
+    return get_client('codepipeline')
+
+# Config reads and pipeline starts run on worker threads that each need a pooled connection
+for service in ('s3', 'codepipeline'):
+    configure(service, max_pool_connections=max(CONFIG_FETCH_WORKERS, PIPELINE_START_WORKERS, 10))
+
+# Loaded during the init phase of the container rather than by its first push
+if CONFIG_SOURCE == 'snapshot':
+    config_snapshot.preload(s3_client())
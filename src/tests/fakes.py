@@ -0,0 +1,67 @@
+import io
+import hashlib
+import threading
+from collections import Counter
+from botocore.exceptions import ClientError
+from botocore.response import StreamingBody
+
+def client_error(code, operation, status=400):
+    return ClientError({'Error': {'Code': code, 'Message': code}, 'ResponseMetadata': {'HTTPStatusCode': status}}, operation)
+
+# Local S3 stand-in for the handful of calls the functions make, safe to use from several threads
+class FakeS3:
+    def __init__(self, page_size=1000):
+        self.objects = {}
+        self.calls = Counter()
+        self.page_size = page_size
+        self.lock = threading.Lock()
+        self.failures = {}
+
+    def add(self, key, body, bucket='test-bucket'):
+        body = body if isinstance(body, bytes) else body.encode()
+        self.objects[(bucket, key)] = (body, f'"{hashlib.md5(body).hexdigest()}"')
+
+    def count(self, operation):
+        with self.lock:
+            self.calls[operation] += 1
+            return self.calls[operation]
+
+    def get_object(self, Bucket, Key, IfNoneMatch=None):
+        self.count('get_object')
+        if (Bucket, Key) in self.failures:
+            raise self.failures[(Bucket, Key)]
+        if (Bucket, Key) not in self.objects:
+            raise client_error('NoSuchKey', 'GetObject', 404)
+        body, etag = self.objects[(Bucket, Key)]
+        if IfNoneMatch == etag:
+            raise client_error('304', 'GetObject', 304)
+        return {'Body': StreamingBody(io.BytesIO(body), len(body)), 'ETag': etag, 'ContentLength': len(body)}
+
+    def put_object(self, Bucket, Key, Body, IfMatch=None, IfNoneMatch=None, **kwargs):
+        self.count('put_object')
+        with self.lock:
+            current = self.objects.get((Bucket, Key))
+            if IfNoneMatch == '*' and current is not None:
+                raise client_error('PreconditionFailed', 'PutObject', 412)
+            if IfMatch is not None and (current is None or current[1] != IfMatch):
+                raise client_error('PreconditionFailed', 'PutObject', 412)
+            self.add(Key, Body, bucket=Bucket)
+            return {'ETag': self.objects[(Bucket, Key)][1]}
+
+    def delete_object(self, Bucket, Key):
+        self.count('delete_object')
+        self.objects.pop((Bucket, Key), None)
+        return {}
+
+    def get_paginator(self, operation):
+        assert operation == 'list_objects_v2'
+        return self
+
+    def paginate(self, Bucket, Prefix=''):
+        keys = sorted(k for b, k in self.objects if b == Bucket and k.startswith(Prefix))
+        for start in range(0, max(len(keys), 1), self.page_size):
+            self.count('list_objects_v2')
+            page = keys[start:start + self.page_size]
+            contents = [{'Key': k, 'ETag': self.objects[(Bucket, k)][1], 'Size': len(self.objects[(Bucket, k)][0])}
+                        for k in page]
+            yield {'Contents': contents} if contents else {}
@@ -1,6 +1,7 @@
 import os
 import os.path
-from dataclasses import asdict
+import json
+from dataclasses import asdict, replace
 import pytest
 from unittest.mock import patch
 import boto3
@@ -9,6 +10,9 @@ from botocore.stub import Stubber
 os.environ['S3_BUCKET'] = 'test-bucket'
 os.environ['S3_PREFIX'] = 'test-prefix'
 from cfresource import resource
+from common.layout import INDEX_VERSION, build_config_prefix, build_index_key, build_snapshot_key
+from common.snapshot import SNAPSHOT_MAGIC, decode_snapshot, encode_snapshot
+from tests.fakes import FakeS3, client_error
 
 def test_extract_and_validate_properties():
     source = {
@@ -23,6 +27,8 @@ def test_extract_and_validate_properties():
     actual = resource.extract_and_validate_properties(source, 'body')
 
     actual_dict = asdict(actual)
+    source['body']['ExcludeMatchExpressions'] = None
+    source['body']['MatchSyntax'] = None
     source['body']['ServiceToken'] = None
     assert actual_dict == source['body']
 
@@ -40,6 +46,8 @@ def test_extract_and_validate_properties_extra():
     actual = resource.extract_and_validate_properties(source, 'body')
 
     actual_dict = asdict(actual)
+    source['body']['ExcludeMatchExpressions'] = None
+    source['body']['MatchSyntax'] = None
     source['body']['ServiceToken'] = None
     del source['body']['NopeNotNeeded']
     assert actual_dict == source['body']
@@ -88,17 +96,25 @@ def valid_properties():
         ('NameOfTheCodePipeline', 'GitHubRepositoryName-MyBranchName-NameOfTheCodePipel-26BA0737'),
         ('cpname', 'GitHubRepositoryName-MyBranchName-cpname-254D7E69')])
 def test_get_filename(pipeline, expected, valid_properties):
-    valid_properties.CodePipelineName = pipeline
+    properties = replace(valid_properties, CodePipelineName=pipeline)
 
-    actual = resource.get_filename(valid_properties)
+    actual = resource.get_filename(properties)
 
     print(actual)
     assert actual == expected
 
-def test_get_s3_key():
-    actual = resource.get_s3_key('somefile')
+def test_get_s3_key(valid_properties):
+    actual = resource.get_s3_key(valid_properties, 'somefile')
 
-    assert actual == 'test-prefix/somefile.json'
+    assert actual == 'test-prefix/v2/94B27944CB146ACB/005B9AB60BB9226C/somefile.json'
+    assert resource.get_legacy_s3_key('somefile') == 'test-prefix/somefile.json'
+
+def test_get_config_prefix_exact():
+    prefixes = {build_config_prefix(resource.S3_PREFIX, repo, branch) for repo, branch in [
+        ('repo', 'main'), ('repo', 'main-legacy'), ('repo', 'mainline'), ('repo-main', 'legacy')]}
+
+    assert len(prefixes) == 4
+    assert not any(a != b and b.startswith(a) for a in prefixes for b in prefixes)
 
 def build_cf_event(eventType):
     event = {
@@ -131,19 +147,25 @@ def build_cf_event(eventType):
 
 @patch('cfresource.resource.send_response')
 @patch('cfresource.resource.put_s3')
-def test_handler_create(putS3, sendResponse):
+@patch('cfresource.resource.update_index')
+@patch('cfresource.resource.bump_generation')
+def test_handler_create(bumpGeneration, updateIndex, putS3, sendResponse):
     event, filename, config = build_cf_event('Create')
 
     resource.handler(event, None)
 
     s3_args = putS3.call_args.args
     assert s3_args[1] == 'test-bucket'
-    assert s3_args[2] == resource.get_s3_key(filename)
+    assert s3_args[2] == resource.get_s3_key(resource.extract_and_validate_properties(event, 'ResourceProperties'), filename)
     assert s3_args[3] == config
     assert s3_args[4] == 'application/json'
+    index_args = updateIndex.call_args.args
+    assert index_args[3] == filename
+    assert index_args[4] == json.loads(config)
     response_args = sendResponse.call_args.args
     assert response_args[0] == 'https://some-url'
     assert response_args[1]['Status'] == 'SUCCESS'
+    assert bumpGeneration.call_count == 1
 
 @patch('cfresource.resource.send_response')
 @patch('cfresource.resource.put_s3', side_effect=KeyError)
@@ -160,25 +182,154 @@ def test_handler_create_fail(putS3, sendResponse):
 @patch('cfresource.resource.send_response')
 @patch('cfresource.resource.put_s3')
 @patch('cfresource.resource.delete_s3')
-def test_handler_update(deleteS3, putS3, sendResponse):
+@patch('cfresource.resource.update_index')
+@patch('cfresource.resource.bump_generation')
+def test_handler_update(bumpGeneration, updateIndex, deleteS3, putS3, sendResponse):
     event, filename, config = build_cf_event('Update')
     oldprops = resource.extract_and_validate_properties(event, 'OldResourceProperties')
     oldfilename = resource.get_filename(oldprops)
 
     resource.handler(event, None)
 
-    s3_delete_args = deleteS3.call_args.args
-    assert s3_delete_args[1] == 'test-bucket'
-    assert s3_delete_args[2] == resource.get_s3_key(oldfilename)
+    assert [c.args[1:] for c in deleteS3.call_args_list] == [
+        ('test-bucket', resource.get_s3_key(oldprops, oldfilename)),
+        ('test-bucket', resource.get_legacy_s3_key(oldfilename))]
     s3_args = putS3.call_args.args
     assert s3_args[1] == 'test-bucket'
-    assert s3_args[2] == resource.get_s3_key(filename)
+    assert s3_args[2] == resource.get_s3_key(resource.extract_and_validate_properties(event, 'ResourceProperties'), filename)
     assert s3_args[3] == config
     assert s3_args[4] == 'application/json'
+    removed, added = [c.args for c in updateIndex.call_args_list]
+    assert (removed[3], removed[4]) == (oldfilename, None)
+    assert (added[3], added[4]) == (filename, json.loads(config))
     response_args = sendResponse.call_args.args
     assert response_args[0] == 'https://some-url'
     assert response_args[1]['Status'] == 'SUCCESS'
 
+@patch('cfresource.resource.send_response')
+@patch('cfresource.resource.delete_s3')
+@patch('cfresource.resource.update_index')
+@patch('cfresource.resource.bump_generation')
+def test_handler_delete(bumpGeneration, updateIndex, deleteS3, sendResponse):
+    event, filename, config = build_cf_event('Delete')
+
+    resource.handler(event, None)
+
+    properties = resource.extract_and_validate_properties(event, 'ResourceProperties')
+    assert [c.args[2] for c in deleteS3.call_args_list] == [
+        resource.get_s3_key(properties, filename), resource.get_legacy_s3_key(filename)]
+    assert updateIndex.call_args.args[3:] == (filename, None)
+    assert sendResponse.call_args.args[1]['Status'] == 'SUCCESS'
+    assert bumpGeneration.call_count == 1
+
+@patch('cfresource.resource.send_response')
+@patch('cfresource.resource.put_s3', side_effect=KeyError)
+def test_handler_does_not_log_response_url(putS3, sendResponse, capsys):
+    event, filename, config = build_cf_event('Create')
+
+    resource.handler(event, None)
+
+    logged = capsys.readouterr().out
+    assert 'aeef721d-6bad-474b-9eba-c0bc90b36c75' in logged
+    assert 'https://some-url' not in logged
+
+def test_get_index_key():
+    assert build_index_key(resource.S3_PREFIX, 'repo', 'branch') == 'test-prefix/_index/repo-branch-73F751F7.json'
+
+def props(pipeline, repo='repo', branch='branch'):
+    return resource.ResourceProperties(
+        GitHubRepo=repo, GitHubBranch=branch, ChangeMatchExpressions='.*', CodePipelineName=pipeline)
+
+def read_index(s3, repo='repo', branch='branch'):
+    return json.loads(s3.objects[('test-bucket', build_index_key(resource.S3_PREFIX, repo, branch))][0])
+
+# Writes or removes the per-file config and then the index, like the handlers do
+def write_config(s3, properties, remove=False):
+    key = resource.get_s3_key(properties, resource.get_filename(properties))
+    if remove:
+        s3.delete_object(Bucket='test-bucket', Key=key)
+        resource.update_index(s3, 'test-bucket', properties, resource.get_filename(properties), None)
+    else:
+        etag = resource.put_s3(s3, 'test-bucket', key, resource.props_to_config_data(properties), 'application/json')
+        resource.update_index(s3, 'test-bucket', properties, resource.get_filename(properties), resource.props_to_config(properties), etag)
+
+def test_update_index_add_and_remove():
+    s3 = FakeS3()
+    one, two = props('one'), props('two')
+
+    write_config(s3, one)
+    write_config(s3, two)
+    write_config(s3, one, remove=True)
+
+    index = read_index(s3)
+    assert index['Version'] == INDEX_VERSION
+    assert index['Configs'] == {resource.get_filename(two): resource.props_to_config(two)}
+    two_key = resource.get_s3_key(two, resource.get_filename(two))
+    assert index['Objects'] == {two_key: s3.objects[('test-bucket', two_key)][1]}
+    assert s3.calls['get_object'] == 4
+
+def test_update_index_reseeds_when_stale():
+    s3 = FakeS3()
+    one, two, three = props('one'), props('two'), props('three')
+    write_config(s3, one)
+    # Copied by the migration script, the index does not know about it
+    s3.add(resource.get_s3_key(two, resource.get_filename(two)), resource.props_to_config_data(two))
+
+    write_config(s3, three)
+
+    index = read_index(s3)
+    assert set(index['Configs']) == {resource.get_filename(p) for p in (one, two, three)}
+    assert set(index['Objects']) == {resource.get_s3_key(p, resource.get_filename(p)) for p in (one, two, three)}
+
+def test_update_index_retries_on_conflict():
+    s3 = FakeS3()
+    one, two = props('one'), props('two')
+    write_config(s3, one)
+    put_object = s3.put_object
+
+    def concurrent_put(**kwargs):
+        # Another stack writes the index between our read and our conditional write
+        if s3.calls['put_object'] == 3:
+            s3.add(kwargs['Key'], json.dumps(dict(read_index(s3), Concurrent=True)))
+        return put_object(**kwargs)
+
+    with patch.object(s3, 'put_object', side_effect=concurrent_put):
+        write_config(s3, two)
+
+    index = read_index(s3)
+    assert index['Concurrent'] is True
+    assert set(index['Configs']) == {resource.get_filename(one), resource.get_filename(two)}
+    assert s3.calls['put_object'] == 5
+
+def test_update_index_gives_up():
+    s3 = FakeS3()
+    one = props('one')
+
+    with patch.object(s3, 'put_object', side_effect=client_error('PreconditionFailed', 'PutObject', 412)):
+        with pytest.raises(RuntimeError):
+            resource.update_index(s3, 'test-bucket', one, resource.get_filename(one), resource.props_to_config(one))
+
+def test_update_index_seeds_from_existing_configs():
+    s3 = FakeS3()
+    existing, legacy, collision, new = props('existing'), props('legacy'), props('other', branch='branch-legacy'), props('new')
+    s3.add(resource.get_s3_key(existing, resource.get_filename(existing)), resource.props_to_config_data(existing))
+    for p in (legacy, collision):
+        s3.add(resource.get_legacy_s3_key(resource.get_filename(p)), resource.props_to_config_data(p))
+
+    resource.update_index(s3, 'test-bucket', new, resource.get_filename(new), resource.props_to_config(new))
+
+    assert set(read_index(s3)['Configs']) == {resource.get_filename(p) for p in (existing, legacy, new)}
+
+
+def test_bump_generation_changes_etag():
+    s3 = FakeS3()
+    event, filename, config = build_cf_event('Create')
+
+    resource.bump_generation(s3, 'test-bucket', event)
+    first = s3.objects[('test-bucket', 'test-prefix/_generation')][1]
+    resource.bump_generation(s3, 'test-bucket', event)
+
+    assert s3.objects[('test-bucket', 'test-prefix/_generation')][1] != first
 
 def test_put_s3():
     client = boto3.client('s3')
@@ -221,3 +372,127 @@ def test_delete_s3():
     with stub:
         resource.delete_s3(client, bucket, key)
         stub.assert_no_pending_responses()
+
+@pytest.mark.parametrize('changes,error', [
+    ({'ChangeMatchExpressions': 'services/(api/.*'}, 'not a valid regular expression'),
+    ({'ChangeMatchExpressions': ''}, 'ChangeMatchExpressions'),
+    ({'GitHubBranch': 5}, 'GitHubBranch'),
+    ({'ExcludeMatchExpressions': 'docs/(.*'}, 'ExcludeMatchExpressions'),
+    ({'ExcludeMatchExpressions': ['docs/.*']}, 'ExcludeMatchExpressions'),
+    ({'MatchSyntax': 'fnmatch'}, 'MatchSyntax'),
+    ({'MatchSyntax': 'glob', 'ChangeMatchExpressions': 'services/**,re:services/(api'}, 'not a valid regular expression')])
+@patch('cfresource.resource.send_response')
+@patch('cfresource.resource.put_s3')
+def test_handler_create_invalid(putS3, sendResponse, changes, error):
+    event, filename, config = build_cf_event('Create')
+    event['ResourceProperties'].update(changes)
+
+    resource.handler(event, None)
+
+    assert not putS3.called
+    response = sendResponse.call_args.args[1]
+    assert response['Status'] == 'FAILED'
+    assert error in response['Reason']
+
+def test_extract_exclude_match_expressions():
+    event, _, config = build_cf_event('Create')
+    event['ResourceProperties']['ExcludeMatchExpressions'] = 'docs/.*,.*\\.md'
+
+    properties = resource.extract_and_validate_properties(event, 'ResourceProperties')
+
+    assert properties.ExcludeMatchExpressions == 'docs/.*,.*\\.md'
+    assert resource.props_to_config(properties)['ExcludeMatchExpressions'] == 'docs/.*,.*\\.md'
+    assert 'ExcludeMatchExpressions' not in json.loads(config)
+
+@patch('cfresource.resource.send_response')
+@patch('cfresource.resource.put_s3')
+@patch('cfresource.resource.update_index')
+@patch('cfresource.resource.bump_generation')
+def test_handler_create_glob(bumpGeneration, updateIndex, putS3, sendResponse):
+    event, _, _ = build_cf_event('Create')
+    event['ResourceProperties'].update({'ChangeMatchExpressions': 'services/[api/**', 'MatchSyntax': 'glob'})
+
+    resource.handler(event, None)
+
+    assert sendResponse.call_args.args[1]['Status'] == 'SUCCESS'
+    assert json.loads(putS3.call_args.args[3])['MatchSyntax'] == 'glob'
+
+def test_resource_properties_immutable(valid_properties):
+    with pytest.raises(AttributeError):
+        valid_properties.GitHubRepo = 'other'
+
+def snapshot_configs():
+    return {resource.get_filename(p): resource.props_to_config(p) for p in (
+        props('one'), props('two', branch='other'), resource.ResourceProperties('repo', 'branch', 'services/.*, docs/.*', 'three', 'docs/.*'))}
+
+def test_snapshot_round_trip():
+    configs = snapshot_configs()
+
+    data = encode_snapshot(configs)
+
+    assert data.startswith(SNAPSHOT_MAGIC)
+    decoded = decode_snapshot(data)
+    assert decoded[resource.get_filename(props('one'))] == configs[resource.get_filename(props('one'))]
+    assert sorted(c['ChangeMatchExpressions'] for c in decoded.values()) == ['.*', '.*', 'services/.*,docs/.*']
+    assert [c.get('ExcludeMatchExpressions') for c in decoded.values()].count('docs/.*') == 1
+
+def test_snapshot_round_trip_glob():
+    configs = {'glob': resource.props_to_config(resource.ResourceProperties('repo', 'branch', 'services/**', 'glob', MatchSyntax='glob')),
+               'exclude': resource.props_to_config(resource.ResourceProperties('repo', 'branch', '**', 'exclude', '*.md', 'glob'))}
+
+    assert decode_snapshot(encode_snapshot(configs)) == configs
+    assert decode_snapshot(b'{"Version": 1}') is None
+    assert decode_snapshot(SNAPSHOT_MAGIC + b'\x00\x63') is None
+
+@patch('cfresource.resource.WRITE_SNAPSHOT', True)
+def test_update_snapshot_seeds_and_updates():
+    s3 = FakeS3()
+    exact, legacy, removed = props('exact'), props('legacy', branch='other'), props('removed')
+    s3.add(resource.get_s3_key(exact, resource.get_filename(exact)), resource.props_to_config_data(exact))
+    for p in (legacy, removed):
+        s3.add(resource.get_legacy_s3_key(resource.get_filename(p)), resource.props_to_config_data(p))
+    s3.add(build_index_key(resource.S3_PREFIX, 'repo', 'branch'), '{}')
+    new = props('new')
+
+    resource.update_snapshot(s3, 'test-bucket', {resource.get_filename(removed): None, resource.get_filename(new): resource.props_to_config(new)})
+
+    snapshot = decode_snapshot(s3.objects[('test-bucket', build_snapshot_key(resource.S3_PREFIX))][0])
+    assert sorted(c['CodePipelineName'] for c in snapshot.values()) == ['exact', 'legacy', 'new']
+    assert s3.calls['list_objects_v2'] == 1
+
+    resource.update_snapshot(s3, 'test-bucket', {resource.get_filename(exact): None})
+
+    snapshot = decode_snapshot(s3.objects[('test-bucket', build_snapshot_key(resource.S3_PREFIX))][0])
+    assert sorted(c['CodePipelineName'] for c in snapshot.values()) == ['legacy', 'new']
+    assert s3.calls['list_objects_v2'] == 1
+
+@patch('cfresource.resource.WRITE_SNAPSHOT', True)
+@patch('cfresource.resource.time.sleep')
+def test_update_snapshot_conflicts(sleep):
+    s3 = FakeS3()
+    s3.add(build_snapshot_key(resource.S3_PREFIX), encode_snapshot({}))
+    put_object = s3.put_object
+    conflicts = [client_error('PreconditionFailed', 'PutObject', 412)] * 2
+
+    def conflicting_put(**kwargs):
+        if conflicts:
+            raise conflicts.pop()
+        return put_object(**kwargs)
+
+    with patch.object(s3, 'put_object', side_effect=conflicting_put):
+        resource.update_snapshot(s3, 'test-bucket', {'one': resource.props_to_config(props('one'))})
+
+    assert list(decode_snapshot(s3.objects[('test-bucket', build_snapshot_key(resource.S3_PREFIX))][0])) == ['one']
+    assert sleep.call_count == 2
+
+    with patch.object(s3, 'put_object', side_effect=client_error('PreconditionFailed', 'PutObject', 412)):
+        resource.update_snapshot(s3, 'test-bucket', {'two': resource.props_to_config(props('two'))})
+
+    assert ('test-bucket', build_snapshot_key(resource.S3_PREFIX)) not in s3.objects
+
+def test_update_snapshot_disabled():
+    s3 = FakeS3()
+
+    resource.update_snapshot(s3, 'test-bucket', {'one': resource.props_to_config(props('one'))})
+
+    assert sum(s3.calls.values()) == 0
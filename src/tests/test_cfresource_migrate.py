@@ -0,0 +1,75 @@
+import os
+import json
+import pytest
+
+os.environ['S3_BUCKET'] = 'test-bucket'
+os.environ['S3_PREFIX'] = 'test-prefix'
+from cfresource import resource, migrate
+from common.layout import build_index_key
+from tests.fakes import FakeS3
+
+def props(pipeline, repo='repo', branch='branch'):
+    return resource.ResourceProperties(GitHubRepo=repo, GitHubBranch=branch, ChangeMatchExpressions='.*', CodePipelineName=pipeline)
+
+def add_legacy(s3, properties):
+    filename = resource.get_filename(properties)
+    s3.add(resource.get_legacy_s3_key(filename), resource.props_to_config_data(properties))
+    return filename
+
+@pytest.fixture()
+def s3():
+    s3 = FakeS3(page_size=2)
+    s3.add('test-prefix/_index/repo-branch-73F751F7.json', '{}')
+    return s3
+
+@pytest.mark.parametrize('delete_legacy', [False, True])
+def test_migrate(s3, delete_legacy):
+    one, two, slashed = props('one'), props('two', branch='main-legacy'), props('three', branch='feature/x')
+    filenames = {p: add_legacy(s3, p) for p in (one, two, slashed)}
+    s3.add('test-prefix/broken-config.json', 'not json')
+
+    summary = migrate.migrate(s3, 'test-bucket', delete_legacy=delete_legacy, workers=2)
+
+    assert summary == {'copied': 3, 'invalid': 1}
+    for p, filename in filenames.items():
+        body = s3.objects[('test-bucket', resource.get_s3_key(p, filename))][0]
+        assert json.loads(body)['CodePipelineName'] == p.CodePipelineName
+        assert (('test-bucket', resource.get_legacy_s3_key(filename)) in s3.objects) is not delete_legacy
+    assert ('test-bucket', 'test-prefix/_index/repo-branch-73F751F7.json') in s3.objects
+
+def test_migrate_keeps_newer_config(s3):
+    one = props('one')
+    filename = add_legacy(s3, one)
+    newer = resource.get_s3_key(one, filename)
+    s3.add(newer, b'{"newer": true}')
+
+    summary = migrate.migrate(s3, 'test-bucket', delete_legacy=True)
+
+    assert summary == {'exists': 1}
+    assert s3.objects[('test-bucket', newer)][0] == b'{"newer": true}'
+    assert ('test-bucket', resource.get_legacy_s3_key(filename)) not in s3.objects
+
+def test_migrate_dry_run(s3):
+    add_legacy(s3, props('one'))
+    objects = dict(s3.objects)
+
+    summary = migrate.migrate(s3, 'test-bucket', dry_run=True, delete_legacy=True)
+
+    assert summary == {'planned': 1}
+    assert s3.objects == objects
+    assert s3.calls['put_object'] == 0
+
+def test_migrated_configs_are_indexed(s3):
+    one, two, other = props('one'), props('two'), props('other', branch='main')
+    for p in (one, two, other):
+        add_legacy(s3, p)
+
+    summary = migrate.migrate(s3, 'test-bucket', delete_legacy=True, workers=3)
+
+    assert summary == {'copied': 3}
+    for p in (one, two, other):
+        index = json.loads(s3.objects[('test-bucket', build_index_key(resource.S3_PREFIX, p.GitHubRepo, p.GitHubBranch))][0])
+        key = resource.get_s3_key(p, resource.get_filename(p))
+        assert index['Configs'][resource.get_filename(p)] == resource.props_to_config(p)
+        assert index['Objects'][key] == s3.objects[('test-bucket', key)][1]
+    assert len(json.loads(s3.objects[('test-bucket', build_index_key(resource.S3_PREFIX, 'repo', 'branch'))][0])['Configs']) == 2
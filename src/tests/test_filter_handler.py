@@ -2,9 +2,12 @@ import os
 import io
 import datetime
 import re
+import time
+import tracemalloc
 import pytest
 import json
 import boto3
+from concurrent.futures import ThreadPoolExecutor
 from unittest.mock import patch
 from botocore.stub import Stubber
 from botocore.response import StreamingBody
@@ -13,6 +16,14 @@ os.environ['S3_BUCKET'] = 'test-bucket'
 os.environ['S3_PREFIX'] = 'some/prefix'
 
 from eval import filter
+from common import clients
+from common.metrics import NULL_TIMER
+from common.snapshot import SNAPSHOT_MAGIC, SNAPSHOT_VERSION, encode_snapshot
+from tests.fakes import FakeS3, client_error
+
+def pipeline_config(name, expressions, excludes=None, syntax=None):
+    return filter.parse_config({'CodePipelineName': name, 'ChangeMatchExpressions': expressions, 'ExcludeMatchExpressions': excludes,
+                                'MatchSyntax': syntax})
 
 @pytest.fixture()
 def github_event():
@@ -272,6 +283,63 @@ def test_extract_paths():
     for i in ["one", "two", "three"]:
         assert i in paths
 
+def test_extract_paths_unique_in_order():
+    event = {'commits': [
+        {'added': ['a', 'b'], 'removed': [], 'modified': ['a']},
+        {'added': [], 'removed': ['c'], 'modified': ['b', 'a']}]}
+
+    assert filter.extract_paths(event) == ['a', 'b', 'c']
+
+def big_push(commits=200, files=50, unique=500):
+    return {
+        'ref': 'refs/heads/master',
+        'repository': {'name': 'repo'},
+        'commits': [{
+            'added': [f'services/svc{(c * files + f) % unique}/file.py' for f in range(files // 2)],
+            'removed': [],
+            'modified': [f'services/svc{(c * files + f) % unique}/file.py' for f in range(files // 2, files)]
+        } for c in range(commits)]
+    }
+
+def concatenated_paths(event):
+    changes = []
+    for commit in event['commits']:
+        for i in ['added', 'removed', 'modified']:
+            changes += commit[i]
+    return changes
+
+def peak_memory(fn, event):
+    tracemalloc.start()
+    try:
+        result = fn(event)
+        return result, tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def test_extract_paths_200_commits_memory():
+    event = big_push()
+
+    paths, peak = peak_memory(filter.extract_paths, event)
+    concatenated, concatenated_peak = peak_memory(concatenated_paths, event)
+
+    print(f'unique paths={len(paths)} peak={peak} bytes, concatenated paths={len(concatenated)} peak={concatenated_peak} bytes')
+    assert len(concatenated) == 10000
+    assert sorted(paths) == sorted(set(concatenated))
+    assert peak < concatenated_peak
+
+@patch('eval.filter.start_code_pipeline')
+@patch('eval.filter.get_s3_object_infos', return_value=[])
+def test_handler_200_commits_single_extraction(s3infos, start):
+    event = big_push()
+    configs = [pipeline_config(f'pipeline{i}', f'services/svc{i * 10 + 9}/.*,.*\\.md')
+               for i in range(20)]
+
+    with patch('eval.filter.get_configs', return_value=configs), \
+            patch('eval.filter.iter_unique_paths', wraps=filter.iter_unique_paths) as extract:
+        filter.handler(event, None)
+
+    assert extract.call_count == 1
+    assert start.call_count == 20
 
 @pytest.mark.parametrize('regexs,expected', [
     pytest.param(('^no-way-this-matches.sh', ), False, id='no-match'),
@@ -285,6 +353,166 @@ def test_is_match(github_event, regexs, expected):
 
     assert actual == expected
 
+MATCHER_PATHS = [
+    'services/billing/api.py', 'services/billing/README.md', 'services/search/index.py',
+    'libs/common/util.py', 'shared/config.yaml', 'docs/readme.md', 'Makefile', 'aa/aa.txt']
+
+@pytest.mark.parametrize('expressions', [
+    pytest.param(['services/billing/.*', 'libs/common/.*', 'nothing/.*'], id='prefixes'),
+    pytest.param(['.*\\.md', 'services/(billing|search)/.*\\.py', '^Makefile$'], id='groups'),
+    pytest.param(['(a+)/\\1', '(?i)DOCS/.*', '(?P<name>shared)/.*', 'libs/.*'], id='uncombinable'),
+    pytest.param(['services/.*,libs/.*', 'services/.*', 'services/billing/.*,docs/.*'], id='shared-patterns'),
+    pytest.param([], id='no-configs'),
+])
+def test_matcher_same_as_is_match(expressions):
+    event = {'commits': [{'added': MATCHER_PATHS[:4], 'removed': MATCHER_PATHS[4:6], 'modified': MATCHER_PATHS[6:]}]}
+    configs = [pipeline_config(f'pipeline{i}', e) for i, e in enumerate(expressions)]
+    expected = [c for c in configs if filter.is_match(event, c.Matches)]
+
+    actual = filter.Matcher(configs).match(filter.extract_paths(event))
+
+    assert actual == expected
+
+@pytest.mark.parametrize('regex,expected', [
+    pytest.param('services/billing/.*', 'services/billing/', id='dir'),
+    pytest.param('^services/billing/.*', 'services/billing/', id='anchored'),
+    pytest.param('readme\\.md', 'readme.md', id='escaped'),
+    pytest.param('Makefile', 'Makefile', id='literal'),
+    pytest.param('.*', '', id='everything'),
+    pytest.param('readme.md', None, id='any-char'),
+    pytest.param('services/.*\\.py', None, id='suffix'),
+    pytest.param('services/.*$', None, id='end-anchor'),
+    pytest.param('(?i)services/.*', None, id='flags'),
+    pytest.param('services\\d', None, id='class-escape'),
+])
+def test_literal_prefix(regex, expected):
+    assert filter.literal_prefix(re.compile(regex)) == expected
+
+def test_matcher_prefix_index():
+    configs = [pipeline_config('a', 'services/billing/.*,.*\\.md'),
+               pipeline_config('b', 'services/.*'),
+               pipeline_config('c', 'services/search/.*')]
+
+    matcher = filter.Matcher(configs)
+    actual = matcher.match(['services/billing/api.py'])
+
+    assert len(matcher.prefixes) == 3
+    assert [matcher.targets[i][0].pattern for i in matcher.combinable] == ['.*\\.md']
+    assert [c.CodePipelineName for c in actual] == ['a', 'b']
+
+@pytest.mark.parametrize('prefix_index', [True, False])
+@pytest.mark.parametrize('expressions,excludes,expected', [
+    pytest.param('services/.*', '.*\\.md', ['pipeline'], id='other-path-matches'),
+    pytest.param('services/billing/.*', 'services/billing/README\\.md,.*\\.py', [], id='every-path-excluded'),
+    pytest.param('services/billing/.*', 'services/billing/', [], id='literal-exclude'),
+    pytest.param('.*\\.md', 'docs/.*', ['pipeline'], id='include-elsewhere'),
+    pytest.param('docs/.*', 'services/.*', ['pipeline'], id='exclude-not-hit'),
+])
+def test_matcher_excludes(prefix_index, expressions, excludes, expected):
+    configs = [pipeline_config('pipeline', expressions, excludes)]
+
+    actual = filter.Matcher(configs, prefix_index).match(MATCHER_PATHS)
+
+    assert [c.CodePipelineName for c in actual] == expected
+
+def test_matcher_excludes_per_config():
+    configs = [pipeline_config('a', 'services/.*', '.*\\.md'),
+               pipeline_config('b', 'services/.*'),
+               pipeline_config('c', 'services/.*', 'services/.*')]
+    tried = []
+
+    class Pattern:
+        pattern = '(?!)'
+        flags = 0
+
+        def match(self, path):
+            tried.append(path)
+    configs.append(filter.PipelineConfig('d', None, None, configs[0].Matches, (Pattern(),)))
+
+    matcher = filter.Matcher(configs)
+    actual = matcher.match(['services/billing/README.md', 'docs/readme.md', 'services/billing/api.py'])
+
+    assert [c.CodePipelineName for c in actual] == ['a', 'b', 'd']
+    assert len(matcher.excludes) == 3
+    assert tried == ['services/billing/README.md']
+
+@pytest.mark.parametrize('glob,path,expected', [
+    ('services/api/**', 'services/api/src/app.py', True),
+    ('services/api/**', 'services/api', False),
+    ('services/api/**', 'services/api-gateway/app.py', False),
+    ('*.tf', 'main.tf', True),
+    ('*.tf', 'infra/main.tf', False),
+    ('**/*.tf', 'main.tf', True),
+    ('**/*.tf', 'infra/prod/main.tf', True),
+    ('**/*.tf', 'infra/main.tf.bak', False),
+    ('services/*/src/**', 'services/billing/src/app.py', True),
+    ('services/*/src/**', 'services/src/app.py', False),
+    ('libs/**/test_*.py', 'libs/test_util.py', True),
+    ('libs/**/test_*.py', 'libs/a/b/test_util.py', True),
+    ('libs/**/test_*.py', 'libs/a/b/util.py', False),
+    ('docs/readme.md', 'docs/readme.md', True),
+    ('docs/readme.md', 'docs/readme.md.bak', False),
+    ('/docs/*.md', 'docs/readme.md', True),
+    ('src/[!t]*/?.py', 'src/app/a.py', True),
+    ('src/[!t]*/?.py', 'src/tests/a.py', False),
+    ('src/*.[ch]', 'src/main.c', True),
+    ('a/b*c*d/e', 'a/b-c-d/e', True),
+    ('a\\*b/**', 'a*b/c', True),
+    ('a\\*b/**', 'axb/c', False),
+    ('**', 'any/path', True),
+])
+def test_glob(glob, path, expected):
+    pattern = filter.parse_glob(glob)
+
+    assert bool(pattern.match(path)) == expected
+
+@pytest.mark.parametrize('prefix_index', [True, False])
+@pytest.mark.parametrize('expressions,excludes,expected', [
+    pytest.param('services/billing/**', None, ['pipeline'], id='prefix'),
+    pytest.param('services/*/index.py', None, ['pipeline'], id='verified-prefix'),
+    pytest.param('**/*.md', 'services/**', ['pipeline'], id='basename'),
+    pytest.param('**/*.md', 'services/**,docs/*', [], id='excluded'),
+    pytest.param('Makefile.*', None, [], id='whole-path'),
+    pytest.param('re:Makefile.*', None, ['pipeline'], id='regex-entry'),
+    pytest.param('nothing/**,re:aa/.*', 're:.*\\.txt', [], id='regex-exclude'),
+])
+def test_matcher_globs(prefix_index, expressions, excludes, expected):
+    configs = [pipeline_config('pipeline', expressions, excludes, 'glob')]
+
+    actual = filter.Matcher(configs, prefix_index).match(MATCHER_PATHS)
+
+    assert [c.CodePipelineName for c in actual] == expected
+
+def test_matcher_glob_targets():
+    configs = [pipeline_config('a', 'services/billing/**,services/*/index.py,**/*.md', syntax='glob'),
+               pipeline_config('b', 'Makefile', syntax='glob'),
+               pipeline_config('c', 'Makefile'),
+               pipeline_config('d', 'services/billing/**', syntax='glob')]
+
+    matcher = filter.Matcher(configs)
+    actual = matcher.match(['Makefile.bak', 'services/search/index.py'])
+
+    assert len(matcher.targets) == 5
+    assert [matcher.targets[i][0].pattern for i in sorted(matcher.verified)] == ['**/*.md', 'Makefile']
+    assert list(matcher.basenames) == ['index.py']
+    assert not matcher.combinable and not matcher.separate
+    assert [c.CodePipelineName for c in actual] == ['a', 'c']
+
+def test_matcher_single_pass_over_paths():
+    configs = [pipeline_config('a', 'one'),
+               pipeline_config('b', 'two')]
+    consumed = []
+
+    def paths():
+        for p in ['one', 'two', 'three', 'four']:
+            consumed.append(p)
+            yield p
+
+    actual = filter.Matcher(configs).match(paths())
+
+    assert [c.CodePipelineName for c in actual] == ['a', 'b']
+    assert consumed == ['one', 'two']
+
 def test_build_regex_matches():
     regexes = filter.build_regex_matches('^.*$,.*')
 
@@ -292,6 +520,56 @@ def test_build_regex_matches():
         assert isinstance(r, re.Pattern)
     assert ['^.*$', '.*'] == [x.pattern for x in regexes]
 
+def test_build_regex_matches_shares_patterns():
+    filter.pattern_cache.clear()
+
+    first = filter.build_regex_matches('shared/.*, libs/common/.*')
+    second = filter.build_regex_matches('libs/common/.*,other/.*')
+
+    assert first[1] is second[0]
+    assert filter.pattern_cache.stats() == {'size': 3, 'hits': 1, 'misses': 3}
+
+def test_pattern_cache_evicts_least_recent():
+    cache = filter.PatternCache(2)
+    a = cache.compile('a')
+    cache.compile('b')
+    cache.compile('a')
+    cache.compile('c')
+
+    assert list(cache.patterns) == ['a', 'c']
+    assert cache.compile('a') is a
+    assert cache.compile('b') is not None
+    assert cache.stats() == {'size': 2, 'hits': 2, 'misses': 4}
+
+def test_matcher_combined_patterns_not_cached():
+    filter.pattern_cache.clear()
+    configs = [pipeline_config(f'p{i}', f'services/svc{i}/.*') for i in range(5)]
+
+    matcher = filter.Matcher(configs, prefix_index=False)
+    matched = matcher.match([f'services/svc{i}/app.py' for i in range(5)])
+    assert [c.CodePipelineName for c in matched] == [f'p{i}' for i in range(5)]
+
+    assert filter.pattern_cache.stats() == {'size': 5, 'hits': 0, 'misses': 5}
+
+def test_pattern_cache_concurrent_eviction():
+    cache = filter.PatternCache(8)
+    expressions = [f'p{i}/.*' for i in range(16)] * 200
+    metrics = filter.Metrics('Namespace', 'eval', emit=lambda line: None)
+    count = metrics.count
+
+    def slow_count(name, value=1):
+        # Gives the other threads a chance to evict while a lookup is in progress
+        time.sleep(0.0001)
+        count(name, value)
+
+    with patch('eval.filter.metrics', metrics), patch.object(metrics, 'count', side_effect=slow_count), \
+            ThreadPoolExecutor(max_workers=8) as executor:
+        compiled = list(executor.map(cache.compile, expressions))
+
+    assert [p.pattern for p in compiled] == expressions
+    assert len(cache.patterns) == 8
+    assert cache.hits + cache.misses == len(expressions)
+
 @pytest.mark.parametrize('prefix,repo,branch,expected', [
     pytest.param('prefix', 'repo', 'branch', 'prefix/repo-branch', id='normal'),
     pytest.param('superlongprefixtomakesure-we-arent-off', 'repo', 'branch', 'superlongprefixtomakesure-we-arent-off/repo-branch', id='long prefix'),
@@ -303,21 +581,125 @@ def test_build_prefix(prefix, repo, branch, expected):
     assert actual == expected
 
 @patch('eval.filter.start_code_pipeline')
-@patch('eval.filter.get_configs', return_value=[{'CodePipelineName': 'pipeline', 'Matches': filter.build_regex_matches('.*org.py.*')}])
+@patch('eval.filter.get_configs', return_value=[pipeline_config('pipeline', '.*org.py.*')])
 @patch('eval.filter.get_s3_object_infos', return_value=[])
 def test_handler_starts(s3infos, configs, start, github_event):
     filter.handler(github_event, None)
 
     assert start.called
 
+@patch('eval.filter.codepipeline_client')
+@patch('eval.filter.start_code_pipeline', return_value='execution')
+@patch('eval.filter.get_configs', return_value=[
+    pipeline_config('pipeline', '.*org.py.*'),
+    pipeline_config('pipeline', 'readme.md')])
+@patch('eval.filter.get_s3_object_infos', return_value=[])
+def test_handler_starts_pipeline_once(s3infos, configs, start, codepipeline_client, github_event):
+    actual = filter.handler(github_event, None)
+
+    assert start.call_count == 1
+    assert [(r['CodePipelineName'], r['ExecutionId']) for r in actual] == [('pipeline', 'execution')]
+
 @patch('eval.filter.start_code_pipeline')
-@patch('eval.filter.get_configs', return_value=[{'CodePipelineName': 'pipeline', 'Matches': filter.build_regex_matches('not-a-chance')}])
+@patch('eval.filter.get_configs', return_value=[pipeline_config('pipeline', 'not-a-chance')])
 @patch('eval.filter.get_s3_object_infos', return_value=[])
 def test_handler_nomatch_nostart(s3infos, configs, start, github_event):
     filter.handler(github_event, None)
 
     assert start.called is False
 
+def sqs_record(messageId, repo='repo', branch='master', paths=('services/api/app.py',), body=None):
+    push = {'ref': f'refs/heads/{branch}', 'repository': {'name': repo}, 'commits': [{'added': list(paths), 'removed': [], 'modified': []}]}
+    return {'messageId': messageId, 'body': json.dumps(push) if body is None else body}
+
+@patch('eval.filter.start_code_pipelines', side_effect=lambda names, push: [
+    {'CodePipelineName': n, 'ExecutionId': None if n == 'broken' else 'id', 'LatencyMs': 1, 'Error': 'boom' if n == 'broken' else None}
+    for n in names])
+@patch('eval.filter.load_configs')
+def test_sqs_handler(load_configs, start):
+    def configs(client, repo, branch):
+        if repo == 'unavailable':
+            raise RuntimeError('S3 down')
+        return [pipeline_config('api', 'services/api/.*'),
+                pipeline_config('broken', 'broken/.*')]
+    load_configs.side_effect = configs
+    event = {'Records': [
+        sqs_record('1'),
+        sqs_record('2', paths=('services/api/other.py',)),
+        sqs_record('3', branch='feature'),
+        sqs_record('4', paths=('broken/thing',)),
+        sqs_record('5', body='not json'),
+        sqs_record('6', repo='unavailable'),
+    ]}
+
+    actual = filter.sqs_handler(event, None)
+
+    assert [c.args[1:] for c in load_configs.call_args_list] == [('repo', 'master'), ('repo', 'feature'), ('unavailable', 'master')]
+    assert start.call_count == 4
+    assert actual == {'batchItemFailures': [{'itemIdentifier': '5'}, {'itemIdentifier': '4'}, {'itemIdentifier': '6'}]}
+
+def spilled_push(s3, paths):
+    lines = [json.dumps({'ref': 'refs/heads/master', 'repository': {'name': 'repo'}})] + [json.dumps(p) for p in paths]
+    s3.add('spill/repo/push.jsonl', '\n'.join(lines))
+    return {'ref': 'refs/heads/master', 'repository': {'name': 'repo'},
+            'PayloadLocation': {'Bucket': 'test-bucket', 'Key': 'spill/repo/push.jsonl'}}
+
+def test_resolve_event_streams_spilled_push():
+    s3 = FakeS3()
+    paths = [f'services/svc{i}/file.py' for i in range(5000)]
+    event = spilled_push(s3, paths)
+
+    reads = []
+    read = StreamingBody.read
+
+    def chunked_read(body, amt=None):
+        reads.append(amt)
+        return read(body, amt)
+
+    actual = filter.resolve_event(s3, event)
+    assert s3.calls['get_object'] == 0
+    assert filter.extract_info(actual) == ('repo', 'master')
+
+    with patch.object(StreamingBody, 'read', chunked_read):
+        assert filter.extract_paths(actual) == paths
+
+    assert len(reads) > 1
+    assert None not in reads
+
+def test_match_pipelines_stops_reading_spilled_push():
+    s3 = FakeS3()
+    paths = [f'services/svc{i}/file.py' for i in range(5000)]
+    event = filter.resolve_event(s3, spilled_push(s3, paths))
+    configs = [pipeline_config('svc0', 'services/svc0/.*'), pipeline_config('svc1', 'services/svc1/.*')]
+
+    reads = []
+    read = StreamingBody.read
+
+    def chunked_read(body, amt=None):
+        reads.append(amt)
+        return read(body, amt)
+
+    with patch.object(StreamingBody, 'read', chunked_read), patch.object(filter, 'metrics', filter.Metrics('test', 'eval')):
+        assert filter.match_pipelines(event, configs) == ['svc0', 'svc1']
+        assert filter.metrics.counts['Paths'] == 2
+
+    assert sum(reads) < len('\n'.join(json.dumps(p) for p in paths)) / 10
+
+def test_resolve_event_passthrough(github_event):
+    assert filter.resolve_event(None, github_event) is github_event
+
+@patch('eval.filter.start_code_pipelines', return_value=[])
+@patch('eval.filter.load_configs', return_value=[pipeline_config('svc42', 'services/svc42/.*')])
+def test_handler_spilled_push(load_configs, start):
+    s3 = FakeS3()
+    event = spilled_push(s3, [f'services/svc{i}/file.py' for i in range(100)])
+
+    with patch('eval.filter.s3_client', return_value=s3):
+        filter.handler(event, None)
+
+    assert load_configs.call_args.args[1:] == ('repo', 'master')
+    assert start.call_args.args[0] == ['svc42']
+
 def test_get_s3_object_infos():
     client = boto3.client('s3')
     stub = Stubber(client)
@@ -350,18 +732,48 @@ def test_get_s3_object_infos():
         ],
         'EncodingType': 'url'
     }
-    expected = [('test-bucket', f'{s3prefix}/config1.json'), ('test-bucket', f'{s3prefix}/config2.json')]
+    lastModified = datetime.datetime(2020, 1, 20, 22, 9)
+    expected = [
+        ('test-bucket', f'{s3prefix}/config1.json', '"abc123"', lastModified),
+        ('test-bucket', f'{s3prefix}/config2.json', '"abc123"', lastModified)]
+    exact = filter.build_config_prefix(prefix, repo, branch)
+    stub.add_response('list_objects_v2', service_response={'IsTruncated': False, 'KeyCount': 0}, expected_params={'Bucket': bucket, 'Prefix': exact})
     stub.add_response('list_objects_v2', service_response=response, expected_params={'Bucket': bucket, 'Prefix': s3prefix})
 
     with stub:
         infos = filter.get_s3_object_infos(client, bucket, prefix, repo, branch)
+        stub.assert_no_pending_responses()
+
+    assert [tuple(x[:3]) for x in infos] == [x[:3] for x in expected]
+    assert [x.last_modified.replace(tzinfo=None) for x in infos] == [x[3] for x in expected]
+
+def test_build_config_prefix():
+    actual = filter.build_config_prefix('some/prefix', 'repo', 'main')
+
+    assert actual == 'some/prefix/v2/32A6FCBAA4543F07/B28B7AF69320201D/'
+    assert actual != filter.build_config_prefix('some/prefix', 'repo', 'main-legacy')
 
-    assert infos == expected
+def layout_config(pipeline, repo, branch):
+    return json.dumps({'GitHubRepo': repo, 'GitHubBranch': branch, 'CodePipelineName': pipeline, 'ChangeMatchExpressions': '.*'})
+
+@pytest.mark.parametrize('legacy,expected', [(True, ['exact', 'legacy']), (False, ['exact'])])
+def test_load_configs_exact_layout(config_cache, legacy, expected):
+    s3 = FakeS3()
+    for repo, branch in [('repo', 'main'), ('repo', 'main-legacy'), ('repo', 'mainline'), ('repo-main', 'x')]:
+        s3.add(filter.build_config_prefix('some/prefix', repo, branch) + f'{repo}-{branch}-exact.json', layout_config('exact', repo, branch))
+        s3.add(f'some/prefix/{repo}-{branch}-legacy.json', layout_config('legacy', repo, branch))
+
+    with patch('eval.filter.READ_LEGACY_KEYS', legacy):
+        actual = filter.load_configs(s3, 'repo', 'main')
+
+    assert [(c.CodePipelineName, c.GitHubRepo, c.GitHubBranch) for c in actual] == [(p, 'repo', 'main') for p in expected]
+    assert s3.calls['list_objects_v2'] == (2 if legacy else 1)
+    assert s3.calls['get_object'] == (5 if legacy else 1)
 
 def test_get_configs():
     client = boto3.client('s3')
     stub = Stubber(client)
-    infos = [('test-bucket', 'some-prefix/config1.json')]
+    infos = [filter.S3ObjectInfo('test-bucket', 'some-prefix/config1.json')]
     expected_json = {
         'GitHubRepo': 'repo',
         'GitHubBranch': 'branch',
@@ -369,8 +781,7 @@ def test_get_configs():
         'CodePipelineName': 'pipeline'
     }
     expected_encoded = json.dumps(expected_json).encode()
-    expected_json['Matches'] = filter.build_regex_matches(expected_json['ChangeMatchExpressions'])
-    expected = [expected_json]
+    expected = [filter.PipelineConfig('pipeline', 'repo', 'branch', tuple(filter.build_regex_matches('.*')), ())]
     response = {
         'Body': StreamingBody(io.BytesIO(expected_encoded), len(expected_encoded)),
     }
@@ -382,6 +793,173 @@ def test_get_configs():
 
     assert actual == expected
 
+def config_body(pipeline='pipeline', expressions='.*'):
+    encoded = json.dumps({
+        'GitHubRepo': 'repo',
+        'GitHubBranch': 'branch',
+        'ChangeMatchExpressions': expressions,
+        'CodePipelineName': pipeline
+    }).encode()
+    return {'Body': StreamingBody(io.BytesIO(encoded), len(encoded))}
+
+@pytest.fixture()
+def config_cache():
+    filter.config_cache.clear()
+    yield filter.config_cache
+    filter.config_cache.clear()
+
+def test_get_configs_cached_etag(config_cache):
+    client = boto3.client('s3')
+    stub = Stubber(client)
+    infos = [
+        filter.S3ObjectInfo('test-bucket', 'some-prefix/config1.json', '"e1"'),
+        filter.S3ObjectInfo('test-bucket', 'some-prefix/config2.json', '"e2"')]
+    stub.add_response('get_object', config_body('one'), {'Bucket': 'test-bucket', 'Key': infos[0].key})
+    stub.add_response('get_object', config_body('two'), {'Bucket': 'test-bucket', 'Key': infos[1].key})
+    stub.add_response('get_object', config_body('three'), {'Bucket': 'test-bucket', 'Key': infos[1].key})
+
+    with stub:
+        first = filter.get_configs(client, infos, 'some-prefix')
+        second = filter.get_configs(client, infos, 'some-prefix')
+        infos[1] = infos[1]._replace(etag='"e3"')
+        third = filter.get_configs(client, infos, 'some-prefix')
+        stub.assert_no_pending_responses()
+
+    assert [c.CodePipelineName for c in first] == ['one', 'two']
+    assert second == first
+    assert [c.CodePipelineName for c in third] == ['one', 'three']
+
+def test_config_cache_ttl_and_lru():
+    now = [0]
+    cache = filter.ConfigCache(2, 10, clock=lambda: now[0])
+    cache.put('a', {'k': ('"e"', None, 'config-a')})
+    cache.put('b', {'k': ('"e"', None, 'config-b')})
+
+    assert cache.get('a', 'k', '"e"') == 'config-a'
+    assert cache.get('a', 'k', '"changed"') is None
+
+    cache.put('c', {'k': ('"e"', None, 'config-c')})
+    assert cache.get('b', 'k', '"e"') is None
+    assert cache.get('a', 'k', '"e"') == 'config-a'
+
+    now[0] = 11
+    assert cache.get('a', 'k', '"e"') is None
+    assert 'a' not in cache.entries
+
+def fake_s3_configs(count):
+    s3 = FakeS3()
+    for i in range(count):
+        s3.add(f'some/repo-branch-config{i:03}.json', config_body(f'pipeline{i}')['Body'].read())
+    infos = filter.get_s3_object_infos(s3, 'test-bucket', 'some', 'repo', 'branch')
+    return s3, infos
+
+@pytest.mark.parametrize('workers', [1, 4, 32])
+def test_get_configs_parallel_keeps_order(config_cache, workers):
+    s3, infos = fake_s3_configs(50)
+
+    actual = filter.get_configs(s3, infos, workers=workers)
+
+    assert [c.CodePipelineName for c in actual] == [f'pipeline{i}' for i in range(50)]
+    assert s3.calls['get_object'] == 50
+
+def test_get_configs_parallel_failure_isolated(config_cache):
+    s3, infos = fake_s3_configs(10)
+    s3.failures[('test-bucket', infos[3].key)] = client_error('AccessDenied', 'GetObject', 403)
+    del s3.objects[('test-bucket', infos[7].key)]
+
+    with pytest.raises(filter.ConfigFetchError) as e:
+        filter.get_configs(s3, infos, workers=4)
+
+    assert [c.CodePipelineName for c in e.value.configs] == [f'pipeline{i}' for i in range(10) if i not in (3, 7)]
+    assert list(e.value.errors) == [infos[3].key]
+
+@patch('eval.filter.start_code_pipelines', return_value=[])
+def test_handler_partial_fetch_failure(start, config_cache, github_event):
+    s3 = FakeS3()
+    prefix = filter.build_config_prefix(filter.S3_PREFIX, 'repo', 'master')
+    s3.add(f'{prefix}one.json', json.dumps({'CodePipelineName': 'one', 'ChangeMatchExpressions': '.*'}), bucket=filter.S3_BUCKET)
+    s3.add(f'{prefix}two.json', json.dumps({'CodePipelineName': 'two', 'ChangeMatchExpressions': '.*'}), bucket=filter.S3_BUCKET)
+    s3.failures[(filter.S3_BUCKET, f'{prefix}two.json')] = client_error('SlowDown', 'GetObject', 503)
+
+    with patch.dict(clients.clients, {'s3': s3}), patch('eval.filter.CONFIG_SOURCE', 'scan'), pytest.raises(filter.ConfigFetchError):
+        filter.handler(github_event, None)
+
+    start.assert_called_once_with(['one'], push=github_event)
+
+@patch('eval.filter.start_code_pipelines', return_value=[])
+@patch('eval.filter.load_configs', side_effect=filter.ConfigFetchError([pipeline_config('api', 'services/api/.*')], {'two.json': RuntimeError()}))
+def test_sqs_handler_partial_fetch_failure(load_configs, start):
+    actual = filter.sqs_handler({'Records': [sqs_record('1')]}, None)
+
+    assert start.call_args.args == (['api'],)
+    assert actual == {'batchItemFailures': [{'itemIdentifier': '1'}]}
+
+def test_fetch_configs_stubber_errors():
+    client = boto3.client('s3')
+    stub = Stubber(client)
+    infos = [filter.S3ObjectInfo('test-bucket', 'one.json'), filter.S3ObjectInfo('test-bucket', 'two.json')]
+    stub.add_client_error('get_object', service_error_code='NoSuchKey', http_status_code=404)
+    stub.add_response('get_object', config_body('two'), {'Bucket': 'test-bucket', 'Key': 'two.json'})
+
+    with stub:
+        actual = filter.fetch_configs(client, infos, workers=1)
+        stub.assert_no_pending_responses()
+
+    assert actual[0][0] is None
+    assert actual[0][1].response['Error']['Code'] == 'NoSuchKey'
+    assert actual[1][0].CodePipelineName == 'two'
+    assert actual[1][1] is None
+
+def test_build_index_key():
+    assert filter.build_index_key('test-prefix', 'repo', 'branch') == 'test-prefix/_index/repo-branch-73F751F7.json'
+
+def index_body(*pipelines, version=filter.INDEX_VERSION):
+    configs = {p: json.loads(config_body(p)['Body'].read()) for p in pipelines}
+    return json.dumps({'Version': version, 'GitHubRepo': 'repo', 'GitHubBranch': 'branch', 'Configs': configs, 'Objects': {}})
+
+def test_get_index_configs(config_cache):
+    s3 = FakeS3()
+    key = filter.build_index_key('some', 'repo', 'branch')
+    s3.add(key, index_body('one', 'two'))
+
+    first = filter.get_index_configs(s3, 'test-bucket', 'some', 'repo', 'branch')
+    second = filter.get_index_configs(s3, 'test-bucket', 'some', 'repo', 'branch')
+    s3.add(key, index_body('three'))
+    third = filter.get_index_configs(s3, 'test-bucket', 'some', 'repo', 'branch')
+
+    assert [c.CodePipelineName for c in first] == ['one', 'two']
+    assert second is first
+    assert [c.CodePipelineName for c in third] == ['three']
+    assert s3.calls['get_object'] == 3
+    assert s3.calls['list_objects_v2'] == 0
+
+@pytest.mark.parametrize('body', [None, index_body('one', version=99)], ids=['missing', 'unknown-version'])
+def test_get_index_configs_unusable(config_cache, body):
+    s3 = FakeS3()
+    if body:
+        s3.add(filter.build_index_key('some', 'repo', 'branch'), body)
+
+    assert filter.get_index_configs(s3, 'test-bucket', 'some', 'repo', 'branch') is None
+
+@pytest.mark.parametrize('indexed,expected', [(True, ['indexed']), (False, ['scanned'])])
+def test_load_configs_index_source(config_cache, indexed, expected):
+    s3 = FakeS3()
+    s3.add(filter.build_prefix('some/prefix', 'repo', 'branch') + '-scanned.json', config_body('scanned')['Body'].read())
+    if indexed:
+        s3.add(filter.build_index_key('some/prefix', 'repo', 'branch'), index_body('indexed'))
+
+    with patch('eval.filter.CONFIG_SOURCE', 'index'):
+        actual = filter.load_configs(s3, 'repo', 'branch')
+
+    assert [c.CodePipelineName for c in actual] == expected
+
+def test_get_client_created_once():
+    with patch.dict(clients.clients, clear=True):
+        first = filter.get_client('s3')
+
+        assert filter.s3_client() is first
+        assert clients.clients == {'s3': first}
+
 @patch('eval.filter.codepipeline_client')
 def test_start_code_pipeline(codepipeline_client):
     client = boto3.client('codepipeline')
@@ -394,5 +972,375 @@ def test_start_code_pipeline(codepipeline_client):
     stub.add_response('start_pipeline_execution', service_response=response, expected_params={'name': pipelineName})
 
     with stub:
-        filter.start_code_pipeline(pipelineName)
+        actual = filter.start_code_pipeline(pipelineName)
+        stub.assert_no_pending_responses()
+
+    assert actual == 'abcd123'
+
+@patch('eval.filter.codepipeline_client')
+@patch('eval.filter.start_code_pipeline', side_effect=lambda name, token: f'{name}-id')
+def test_start_code_pipelines_dedupes(start, codepipeline_client):
+    actual = filter.start_code_pipelines(['b', 'a', 'b', 'c', 'a'], workers=4)
+
+    assert sorted(c.args[0] for c in start.call_args_list) == ['a', 'b', 'c']
+    assert [(r['CodePipelineName'], r['ExecutionId'], r['Error']) for r in actual] == [
+        ('b', 'b-id', None), ('a', 'a-id', None), ('c', 'c-id', None)]
+    assert all(r['LatencyMs'] >= 0 for r in actual)
+
+def test_start_code_pipelines_failure_isolated():
+    client = boto3.client('codepipeline')
+    stub = Stubber(client)
+    stub.add_client_error('start_pipeline_execution', service_error_code='PipelineNotFoundException',
+                          expected_params={'name': 'missing'})
+    stub.add_response('start_pipeline_execution', {'pipelineExecutionId': 'id-2'}, expected_params={'name': 'found'})
+
+    with patch('eval.filter.codepipeline_client', return_value=client), stub:
+        actual = filter.start_code_pipelines(['missing', 'found'], workers=1)
         stub.assert_no_pending_responses()
+
+    assert actual[0]['ExecutionId'] is None
+    assert 'PipelineNotFoundException' in actual[0]['Error']
+    assert actual[1]['ExecutionId'] == 'id-2'
+    assert actual[1]['Error'] is None
+
+def test_start_code_pipelines_request_token():
+    client = boto3.client('codepipeline')
+    stub = Stubber(client)
+    push = {'ref': 'refs/heads/master', 'after': 'abc', 'repository': {'name': 'repo'}, 'commits': []}
+    token = filter.request_token(push, 'one')
+    for _ in range(2):
+        stub.add_response('start_pipeline_execution', {'pipelineExecutionId': 'id-1'},
+                          expected_params={'name': 'one', 'clientRequestToken': token})
+
+    with patch('eval.filter.codepipeline_client', return_value=client), stub:
+        filter.start_code_pipelines(['one'], push=push)
+        filter.start_code_pipelines(['one'], push=dict(push))
+        stub.assert_no_pending_responses()
+
+    assert token != filter.request_token(push, 'two')
+    assert token != filter.request_token(dict(push, after='def'), 'one')
+    assert filter.request_token(dict(push, after=None), 'one') is None
+
+# Returns the execution of an earlier start with the same request token, like CodePipeline
+class IdempotentCodePipeline:
+    def __init__(self):
+        self.executions = {}
+
+    def start_pipeline_execution(self, name, clientRequestToken=None):
+        key = clientRequestToken or object()
+        execution = self.executions.setdefault(key, f'{name}-{len(self.executions)}')
+        return {'pipelineExecutionId': execution}
+
+def test_start_code_pipelines_rollback_starts_again():
+    codepipeline = IdempotentCodePipeline()
+    push = {'ref': 'refs/heads/master', 'before': 'aaa', 'after': 'bbb', 'repository': {'name': 'repo'}, 'commits': []}
+    rollback = dict(push, before='ccc')
+
+    with patch('eval.filter.codepipeline_client', return_value=codepipeline):
+        first = filter.start_code_pipelines(['one'], push=push)
+        retried = filter.start_code_pipelines(['one'], push=dict(push))
+        rolled_back = filter.start_code_pipelines(['one'], push=rollback)
+
+    assert first[0]['ExecutionId'] == retried[0]['ExecutionId'] == 'one-0'
+    assert rolled_back[0]['ExecutionId'] == 'one-1'
+
+def test_parse_config():
+    actual = filter.parse_config({'GitHubRepo': 'repo', 'GitHubBranch': 'branch', 'CodePipelineName': 'pipeline',
+                                  'ChangeMatchExpressions': 'services/api/.*, .*\\.md', 'Unused': 'x' * 1000})
+
+    assert actual == filter.PipelineConfig('pipeline', 'repo', 'branch', tuple(filter.build_regex_matches('services/api/.*,.*\\.md')), ())
+    assert not hasattr(actual, '__dict__')
+    with pytest.raises(AttributeError):
+        actual.CodePipelineName = 'other'
+
+def test_parse_config_excludes():
+    actual = filter.parse_config({'CodePipelineName': 'pipeline', 'ChangeMatchExpressions': '.*', 'ExcludeMatchExpressions': 'docs/.*, .*\\.md'})
+
+    assert [p.pattern for p in actual.Excludes] == ['docs/.*', '.*\\.md']
+    assert actual.Excludes[0] is filter.pattern_cache.compile('docs/.*')
+
+def test_parse_config_glob():
+    actual = filter.parse_config({'CodePipelineName': 'pipeline', 'ChangeMatchExpressions': 'docs/**, re:.*\\.md', 'MatchSyntax': 'glob'})
+
+    glob, regex = actual.Matches
+    assert glob is filter.pattern_cache.compile_glob('docs/**')
+    assert (glob.prefix, glob.segments) == ('docs/', (None,))
+    assert regex is filter.pattern_cache.compile('.*\\.md')
+
+@pytest.mark.parametrize('data,error', [
+    ([], 'not an object'),
+    ({'ChangeMatchExpressions': '.*'}, 'CodePipelineName'),
+    ({'CodePipelineName': 'pipeline'}, 'ChangeMatchExpressions'),
+    ({'CodePipelineName': 'pipeline', 'ChangeMatchExpressions': 5}, 'ChangeMatchExpressions'),
+    ({'CodePipelineName': 'pipeline', 'ChangeMatchExpressions': '.*', 'GitHubRepo': 1}, 'GitHubRepo'),
+    ({'CodePipelineName': 'pipeline', 'ChangeMatchExpressions': 'services/(api'}, 'regular expression'),
+    ({'CodePipelineName': 'pipeline', 'ChangeMatchExpressions': '.*', 'ExcludeMatchExpressions': ['docs/.*']}, 'ExcludeMatchExpressions'),
+    ({'CodePipelineName': 'pipeline', 'ChangeMatchExpressions': '.*', 'ExcludeMatchExpressions': 'docs/(.*'}, 'ExcludeMatchExpressions'),
+    ({'CodePipelineName': 'pipeline', 'ChangeMatchExpressions': '.*', 'MatchSyntax': 'fnmatch'}, 'MatchSyntax'),
+    ({'CodePipelineName': 'pipeline', 'ChangeMatchExpressions': 'docs/**,re:docs/(.*', 'MatchSyntax': 'glob'}, 'regular expression')])
+def test_parse_config_invalid(data, error):
+    with pytest.raises(ValueError, match=error):
+        filter.parse_config(data)
+
+def test_get_configs_skips_invalid():
+    s3 = FakeS3()
+    s3.add('some/prefix/repo-master-1.json', json.dumps({'CodePipelineName': 'one', 'ChangeMatchExpressions': '.*'}))
+    s3.add('some/prefix/repo-master-2.json', json.dumps({'CodePipelineName': 'two'}))
+    infos = filter.get_s3_object_infos(s3, 'test-bucket', 'some/prefix', 'repo', 'master')
+
+    actual = filter.get_configs(s3, infos, workers=1)
+
+    assert [c.CodePipelineName for c in actual] == ['one']
+
+def test_metrics_embedded_metric_format():
+    ticks = iter([1.0, 1.25, 2.0, 2.5])
+    emitted = []
+    metrics = filter.Metrics('Namespace', 'eval', clock=lambda: next(ticks), emit=emitted.append)
+
+    with metrics.timer('S3Get'):
+        pass
+    with metrics.timer('S3Get'):
+        pass
+    metrics.count('ConfigsScanned', 3)
+    metrics.count('ConfigsScanned')
+    metrics.flush()
+    metrics.flush()
+
+    assert len(emitted) == 1
+    record = json.loads(emitted[0])
+    directive = record['_aws']['CloudWatchMetrics'][0]
+    assert directive['Namespace'] == 'Namespace'
+    assert directive['Dimensions'] == [['Service']]
+    assert directive['Metrics'] == [{'Name': 'S3Get', 'Unit': 'Milliseconds'}, {'Name': 'ConfigsScanned', 'Unit': 'Count'}]
+    assert record['Service'] == 'eval'
+    assert record['S3Get'] == [250.0, 500.0]
+    assert record['ConfigsScanned'] == 4
+
+def test_metrics_disabled():
+    emitted = []
+    metrics = filter.Metrics(None, 'eval', emit=emitted.append)
+
+    assert metrics.timer('S3Get') is NULL_TIMER
+    metrics.count('ConfigsScanned')
+    metrics.timing('S3Get', 1.0)
+    metrics.flush()
+
+    assert emitted == []
+    assert metrics.counts == {} and metrics.timings == {}
+
+@patch('eval.filter.start_code_pipeline', return_value='execution')
+@patch('eval.filter.codepipeline_client')
+def test_handler_emits_metrics(codepipeline_client, start, github_event):
+    s3 = FakeS3()
+    s3.add('some/prefix/repo-master-1.json', json.dumps({'CodePipelineName': 'pipeline', 'ChangeMatchExpressions': '.*org.py.*'}))
+    s3.add('some/prefix/repo-master-2.json', json.dumps({'CodePipelineName': 'other', 'ChangeMatchExpressions': 'nothing'}))
+    emitted = []
+    filter.config_cache.clear()
+
+    with patch('eval.filter.metrics', filter.Metrics('Namespace', 'eval', emit=emitted.append)), \
+            patch('eval.filter.s3_client', return_value=s3):
+        filter.handler(github_event, None)
+
+    record = json.loads(emitted[0])
+    names = {m['Name'] for m in record['_aws']['CloudWatchMetrics'][0]['Metrics']}
+    assert {'LoadConfigs', 'S3List', 'S3Get', 'Match', 'PipelineStart'} <= names
+    assert len(record['S3Get']) == 2
+    assert record['ConfigsScanned'] == 2
+    assert record['ConfigCacheMisses'] == 2
+    assert record['PatternsEvaluated'] == 2
+    assert record['PipelinesMatched'] == 1
+    assert record['Paths'] == len(filter.extract_paths(github_event))
+
+def configured_s3():
+    s3 = FakeS3(page_size=3)
+    s3.add(filter.build_config_prefix('some/prefix', 'repo', 'main') + 'repo-main-one.json', layout_config('one', 'repo', 'main'))
+    s3.add('some/prefix/repo-legacy-two.json', layout_config('two', 'repo', 'legacy'))
+    s3.add(filter.build_index_key('some/prefix', 'repo', 'feature'), index_body('three'))
+    s3.add('some/prefix/_generation', '1')
+    return s3
+
+@pytest.mark.parametrize('repo,branch,configured', [
+    ('repo', 'main', True), ('repo', 'legacy', True), ('repo', 'feature', False), ('repo', 'mai', False), ('other', 'main', False)])
+def test_configured_branches(repo, branch, configured):
+    s3 = configured_s3()
+    branches = filter.ConfiguredBranches('test-bucket', 'some/prefix', 60)
+
+    assert branches.is_configured(s3, repo, branch) is configured
+    assert branches.is_configured(s3, repo, branch) is configured
+    assert s3.calls['list_objects_v2'] == 2
+    assert s3.calls['get_object'] == (1 if configured else 2)
+
+def test_configured_branches_generation_and_ttl():
+    now = [0]
+    s3 = configured_s3()
+    branches = filter.ConfiguredBranches('test-bucket', 'some/prefix', 60, clock=lambda: now[0])
+
+    assert branches.is_configured(s3, 'repo', 'new') is False
+    s3.add(filter.build_config_prefix('some/prefix', 'repo', 'new') + 'repo-new-four.json', layout_config('four', 'repo', 'new'))
+    assert branches.is_configured(s3, 'repo', 'new') is False
+    s3.add('some/prefix/_generation', '2')
+    assert branches.is_configured(s3, 'repo', 'new') is True
+    assert s3.calls['list_objects_v2'] == 4
+
+    s3.add(filter.build_config_prefix('some/prefix', 'repo', 'newer') + 'repo-newer-five.json', layout_config('five', 'repo', 'newer'))
+    assert branches.is_configured(s3, 'repo', 'newer') is False
+    now[0] = 61
+    assert branches.is_configured(s3, 'repo', 'newer') is True
+
+def test_configured_branches_disabled():
+    s3 = FakeS3()
+
+    assert filter.ConfiguredBranches('test-bucket', 'some/prefix', 0).is_configured(s3, 'repo', 'main') is True
+    assert sum(s3.calls.values()) == 0
+
+@patch('eval.filter.start_code_pipeline')
+def test_handler_unconfigured_branch(start, config_cache, github_event):
+    s3 = configured_s3()
+
+    with patch('eval.filter.configured_branches', filter.ConfiguredBranches('test-bucket', 'some/prefix', 60)), \
+            patch('eval.filter.s3_client', return_value=s3):
+        assert filter.handler(github_event, None) == []
+        assert filter.handler(github_event, None) == []
+
+    assert s3.calls['list_objects_v2'] == 2
+    assert start.called is False
+
+def snapshot_s3(repos=100, branches=30, legacy=500):
+    s3 = FakeS3()
+    for r in range(repos):
+        for b in range(branches):
+            repo, branch = f'repo{r}', f'branch{b}'
+            s3.add(filter.build_config_prefix('some/prefix', repo, branch) + f'{repo}-{branch}-pipeline.json',
+                   layout_config(f'{repo}-{branch}', repo, branch))
+    for i in range(legacy):
+        s3.add(f'some/prefix/legacy{i}-main-pipeline.json', layout_config(f'legacy{i}', f'legacy{i}', 'main'))
+    s3.add(filter.build_index_key('some/prefix', 'repo0', 'branch0'), index_body('indexed'))
+    s3.add('some/prefix/_generation', '1')
+    return s3
+
+def snapshot_lookup(snapshot, s3, repo, branch):
+    return [c.CodePipelineName for c in snapshot.get(s3, repo, branch)]
+
+def test_config_snapshot_thousands_of_objects():
+    s3 = snapshot_s3()
+    snapshot = filter.ConfigSnapshot('test-bucket', 'some/prefix', 30, clock=lambda: 0)
+
+    assert snapshot_lookup(snapshot, s3, 'repo42', 'branch7') == ['repo42-branch7']
+    assert snapshot_lookup(snapshot, s3, 'legacy99', 'main') == ['legacy99']
+    assert snapshot_lookup(snapshot, s3, 'repo42', 'feature') == []
+    assert snapshot_lookup(snapshot, s3, 'unknown', 'main') == []
+    assert len(snapshot.objects) == 3500
+    assert s3.calls['list_objects_v2'] == 4
+    assert s3.calls['get_object'] == 3502
+
+def test_config_snapshot_keeps_previous_on_fetch_failure():
+    s3 = snapshot_s3(repos=2, branches=2, legacy=0)
+    snapshot = filter.ConfigSnapshot('test-bucket', 'some/prefix', 30, clock=lambda: 0)
+    snapshot.preload(s3)
+    key = filter.build_config_prefix('some/prefix', 'repo1', 'branch1') + 'repo1-branch1-pipeline.json'
+    s3.add(key, layout_config('changed', 'repo1', 'branch1'))
+    s3.add('some/prefix/_generation', '2')
+    s3.failures[('test-bucket', key)] = client_error('SlowDown', 'GetObject', 503)
+
+    snapshot.refresh(s3)
+
+    assert snapshot_lookup(snapshot, s3, 'repo1', 'branch1') == ['repo1-branch1']
+    assert snapshot.generation != filter.get_generation(s3, 'test-bucket', 'some/prefix')
+
+def test_config_snapshot_refresh():
+    now = [0]
+    s3 = snapshot_s3(repos=20, branches=10, legacy=0)
+    snapshot = filter.ConfigSnapshot('test-bucket', 'some/prefix', 30, clock=lambda: now[0])
+    snapshot.preload(s3)
+    s3.calls.clear()
+
+    now[0] = 10
+    assert snapshot_lookup(snapshot, s3, 'repo1', 'branch1') == ['repo1-branch1']
+    assert sum(s3.calls.values()) == 0
+
+    now[0] = 31
+    snapshot_lookup(snapshot, s3, 'repo1', 'branch1')
+    snapshot.thread.join()
+    assert dict(s3.calls) == {'get_object': 1}
+
+    s3.add(filter.build_config_prefix('some/prefix', 'repo1', 'branch1') + 'repo1-branch1-pipeline.json', layout_config('changed', 'repo1', 'branch1'))
+    s3.add(filter.build_config_prefix('some/prefix', 'repo1', 'new') + 'repo1-new-pipeline.json', layout_config('new', 'repo1', 'new'))
+    s3.add('some/prefix/_generation', '2')
+    s3.calls.clear()
+    now[0] = 62
+    assert snapshot_lookup(snapshot, s3, 'repo1', 'branch1') == ['repo1-branch1']
+    snapshot.thread.join()
+
+    assert snapshot_lookup(snapshot, s3, 'repo1', 'branch1') == ['changed']
+    assert snapshot_lookup(snapshot, s3, 'repo1', 'new') == ['new']
+    assert dict(s3.calls) == {'get_object': 4, 'list_objects_v2': 1}
+
+def test_config_snapshot_refresh_failure_keeps_snapshot():
+    now = [0]
+    s3 = snapshot_s3(repos=2, branches=2, legacy=0)
+    snapshot = filter.ConfigSnapshot('test-bucket', 'some/prefix', 30, clock=lambda: now[0])
+    snapshot.preload(s3)
+    s3.failures[('test-bucket', 'some/prefix/_generation')] = client_error('SlowDown', 'GetObject', 503)
+
+    now[0] = 31
+    snapshot_lookup(snapshot, s3, 'repo1', 'branch1')
+    snapshot.thread.join()
+
+    assert snapshot_lookup(snapshot, s3, 'repo1', 'branch1') == ['repo1-branch1']
+
+@pytest.mark.parametrize('loaded', [True, False])
+def test_load_configs_snapshot_source(config_cache, loaded):
+    s3 = snapshot_s3(repos=2, branches=2, legacy=0)
+    snapshot = filter.ConfigSnapshot('test-bucket', 'some/prefix', 30)
+    if not loaded:
+        s3.failures[('test-bucket', 'some/prefix/_generation')] = client_error('AccessDenied', 'GetObject', 403)
+
+    with patch('eval.filter.CONFIG_SOURCE', 'snapshot'), patch('eval.filter.config_snapshot', snapshot):
+        actual = filter.load_configs(s3, 'repo1', 'branch0')
+
+    assert [c.CodePipelineName for c in actual] == ['repo1-branch0']
+    assert s3.calls['list_objects_v2'] == (1 if loaded else 2)
+
+def encoded_snapshot(configs):
+    return encode_snapshot(configs)
+
+def test_decode_snapshot():
+    data = encoded_snapshot({
+        'a': {'GitHubRepo': 'repo', 'GitHubBranch': 'main', 'CodePipelineName': 'one', 'ChangeMatchExpressions': 'services/.*,docs/.*',
+              'ExcludeMatchExpressions': '.*\\.md'},
+        'b': {'GitHubRepo': 'repo', 'GitHubBranch': 'main', 'CodePipelineName': 'two', 'ChangeMatchExpressions': 'docs/.*'},
+        'c': {'GitHubRepo': 'repo', 'GitHubBranch': 'dev', 'CodePipelineName': 'bad', 'ChangeMatchExpressions': 'services/(.*'},
+        'd': {'GitHubRepo': 'repo', 'GitHubBranch': 'dev', 'CodePipelineName': 'bad', 'ChangeMatchExpressions': '.*', 'ExcludeMatchExpressions': '(.*'},
+        'e': {'GitHubRepo': 'repo', 'GitHubBranch': 'globs', 'CodePipelineName': 'glob', 'ChangeMatchExpressions': 'docs/.*', 'MatchSyntax': 'glob'}})
+
+    branches = filter.decode_branches(data)
+
+    one, two = branches['repo']['main']
+    assert (one.CodePipelineName, two.CodePipelineName) == ('one', 'two')
+    assert [p.pattern for p in one.Matches] == ['services/.*', 'docs/.*']
+    assert [p.pattern for p in one.Excludes] == ['.*\\.md']
+    assert two.Excludes == ()
+    glob, = branches['repo']['globs']
+    assert isinstance(glob.Matches[0], filter.Glob)
+    assert glob.Matches[0] != one.Matches[1]
+    assert one.Matches[1] is two.Matches[0]
+    assert branches['repo'].get('dev') is None
+    assert filter.decode_branches(b'not a snapshot') is None
+    assert filter.decode_branches(SNAPSHOT_MAGIC + b'\x00\x63') is None
+
+@pytest.mark.parametrize('version', [SNAPSHOT_VERSION, 99])
+def test_config_snapshot_reads_snapshot_object(version):
+    s3 = snapshot_s3(repos=3, branches=3, legacy=0)
+    data = encoded_snapshot({'a': {'GitHubRepo': 'repo1', 'GitHubBranch': 'branch1', 'CodePipelineName': 'from-snapshot', 'ChangeMatchExpressions': '.*'}})
+    s3.add('some/prefix/_snapshot.bin', data[:len(SNAPSHOT_MAGIC)] + bytes([0, version]) + data[len(SNAPSHOT_MAGIC) + 2:])
+    snapshot = filter.ConfigSnapshot('test-bucket', 'some/prefix', 30, clock=lambda: 0)
+
+    actual = snapshot_lookup(snapshot, s3, 'repo1', 'branch1')
+
+    if version == SNAPSHOT_VERSION:
+        assert actual == ['from-snapshot']
+        assert s3.calls['list_objects_v2'] == 0
+        assert s3.calls['get_object'] == 2
+    else:
+        assert actual == ['repo1-branch1']
+        assert s3.calls['list_objects_v2'] == 1
@@ -1,8 +1,12 @@
 import os
 import json
+import time
+import types
 import pytest
+import boto3
 import hmac
 from hashlib import sha1
+from concurrent.futures import ThreadPoolExecutor
 from unittest.mock import patch
 from botocore.stub import Stubber, ANY
 
@@ -11,6 +15,8 @@ os.environ['GITHUB_SECRET'] = SECRET
 os.environ['EVAL_FUNCTION_ARN'] = 'test.arn'
 
 from webhook import org
+from common import clients
+from tests.fakes import FakeS3
 
 def gh_signature(event, signature):
     if not signature:
@@ -76,7 +82,9 @@ def test_handler(invoke_function, apigw_event, invokeExpected):
     assert invoke_function.called == invokeExpected
 
 @patch('webhook.org.invoke_function')
-@pytest.mark.parametrize('apigw_event', [dict(eventName='ping', signature='BAD'), dict(eventName='push', signature='BAD')], indirect=['apigw_event'])
+@pytest.mark.parametrize('apigw_event', [
+    dict(eventName='push', signature='BAD'),
+    dict(eventName='push', signature='0' * 40)], indirect=['apigw_event'])
 def test_handler_invalid_signature(invoke_function, apigw_event):
 
     response = org.handler(apigw_event, None)
@@ -85,20 +93,52 @@ def test_handler_invalid_signature(invoke_function, apigw_event):
     assert 'Unauthorized' in response['body']
     assert invoke_function.called is False
 
+@patch('webhook.org.invoke_function')
+def test_handler_missing_signature(invoke_function, apigw_event):
+    del apigw_event['headers']['x-hub-signature']
+
+    response = org.handler(apigw_event, None)
+
+    assert response['statusCode'] == 403
+    assert invoke_function.called is False
+
+@patch('webhook.org.invoke_function')
+@patch('webhook.org.hmac.new')
+@pytest.mark.parametrize('apigw_event', [
+    dict(eventName='ping', signature='BAD'),
+    dict(eventName='check_run'),
+    dict(eventName='status')], indirect=['apigw_event'])
+def test_handler_ignored_event_skips_verification(hmac_new, invoke_function, apigw_event):
+
+    response = org.handler(apigw_event, None)
+
+    assert response['statusCode'] == 200
+    assert hmac_new.called is False
+    assert invoke_function.called is False
+
+@pytest.mark.parametrize('header,expected', [
+    ('sha1=' + 'a' * 40, True),
+    ('sha1 = ' + 'A' * 40, True),
+    ('sha256=' + 'a' * 64, False),
+    ('sha1=' + 'a' * 39, False),
+    ('sha1=' + 'g' * 40, False),
+    ('', False)])
+def test_signature_format(header, expected):
+    assert bool(org.SIGNATURE_FORMAT.fullmatch(header)) == expected
+
 
 @pytest.fixture(scope='function')
 def lambda_stub():
-    with Stubber(org.lambdaclient) as stub:
+    with Stubber(org.lambda_client()) as stub:
         yield stub
         stub.assert_no_pending_responses()
 
 
-@pytest.mark.parametrize('status', [202, 400, 500])
-def test_handler_boto3lambda_stub(lambda_stub, apigw_event, status):
+def test_handler_boto3lambda_stub(lambda_stub, apigw_event):
     lambda_stub.add_response(
-        method='invoke_async',
-        service_response={'Status': 202},
-        expected_params={'FunctionName': 'test.arn', 'InvokeArgs': ANY}
+        method='invoke',
+        service_response={'StatusCode': 202},
+        expected_params={'FunctionName': 'test.arn', 'InvocationType': 'Event', 'Payload': ANY}
     )
 
     response = org.handler(apigw_event, None)
@@ -108,11 +148,364 @@ def test_handler_boto3lambda_stub(lambda_stub, apigw_event, status):
 
 def test_handler_boto3lambda_stub_fail(lambda_stub, apigw_event):
     lambda_stub.add_client_error(
-        method='invoke_async',
+        method='invoke',
         service_error_code='ResourceNotFoundException',
-        http_status_code=500
+        http_status_code=404
     )
 
-    with pytest.raises(org.lambdaclient.exceptions.ResourceNotFoundException):
+    with pytest.raises(org.lambda_client().exceptions.ResourceNotFoundException):
+        org.handler(apigw_event, None)
+
+@patch('webhook.org.time.sleep')
+def test_invoke_function_retries_throttling(sleep, lambda_stub):
+    for _ in range(2):
+        lambda_stub.add_client_error(method='invoke', service_error_code='TooManyRequestsException', http_status_code=429)
+    lambda_stub.add_response(method='invoke', service_response={'StatusCode': 202})
+
+    assert org.invoke_function('test.arn', '{}') is True
+    delays = [c.args[0] for c in sleep.call_args_list]
+    assert len(delays) == 2
+    assert org.INVOKE_BASE_DELAY / 2 <= delays[0] <= org.INVOKE_BASE_DELAY
+    assert org.INVOKE_BASE_DELAY <= delays[1] <= org.INVOKE_BASE_DELAY * 2
+
+@patch('webhook.org.time.sleep')
+def test_invoke_function_dead_letters_when_exhausted(sleep, lambda_stub):
+    sqs = boto3.client('sqs')
+    for _ in range(org.INVOKE_MAX_ATTEMPTS):
+        lambda_stub.add_client_error(method='invoke', service_error_code='TooManyRequestsException', http_status_code=429)
+
+    with Stubber(sqs) as sqs_stub, patch('webhook.org.DEAD_LETTER_QUEUE_URL', 'https://queue'), \
+            patch.dict(clients.clients, {'sqs': sqs}):
+        sqs_stub.add_response('send_message', {'MessageId': 'id'}, {
+            'QueueUrl': 'https://queue', 'MessageBody': '{"ref":"x"}', 'MessageAttributes': ANY})
+        assert org.invoke_function('test.arn', '{"ref":"x"}') is False
+        sqs_stub.assert_no_pending_responses()
+
+    assert sleep.call_count == org.INVOKE_MAX_ATTEMPTS - 1
+
+@patch('webhook.org.time.sleep')
+def test_invoke_function_stops_at_budget(sleep, lambda_stub):
+    lambda_stub.add_client_error(method='invoke', service_error_code='TooManyRequestsException', http_status_code=429)
+
+    with patch('webhook.org.INVOKE_BUDGET', 0), pytest.raises(org.lambda_client().exceptions.TooManyRequestsException):
+        org.invoke_function('test.arn', '{}')
+
+    assert sleep.called is False
+
+@patch('webhook.org.time.sleep')
+def test_invoke_function_retries_connection_errors(sleep, lambda_stub):
+    from botocore.exceptions import EndpointConnectionError, ReadTimeoutError
+    sqs = boto3.client('sqs')
+    errors = [EndpointConnectionError(endpoint_url='https://lambda'), ReadTimeoutError(endpoint_url='https://lambda')]
+    errors += [EndpointConnectionError(endpoint_url='https://lambda')] * (org.INVOKE_MAX_ATTEMPTS - 2)
+
+    with patch.object(org.lambda_client(), 'invoke', side_effect=errors), patch('webhook.org.DEAD_LETTER_QUEUE_URL', 'https://queue'), \
+            Stubber(sqs) as sqs_stub, patch.dict(clients.clients, {'sqs': sqs}):
+        sqs_stub.add_response('send_message', {'MessageId': 'id'}, {
+            'QueueUrl': 'https://queue', 'MessageBody': '{}', 'MessageAttributes': ANY})
+        assert org.invoke_function('test.arn', '{}') is False
+        sqs_stub.assert_no_pending_responses()
+
+    assert sleep.call_count == org.INVOKE_MAX_ATTEMPTS - 1
+
+def test_lambda_client_times_out_within_budget():
+    config = org.lambda_client().meta.config
+    assert config.connect_timeout + config.read_timeout < org.INVOKE_BUDGET
+
+def push_payload(paths, ref='refs/heads/master', repo='repo', after='0000000000000000000000000000000000000001'):
+    return {'ref': ref, 'before': '0000000000000000000000000000000000000000', 'after': after, 'repository': {'name': repo, 'url': 'https://github.com/Org/repo'},
+            'commits': [{'added': paths, 'removed': [], 'modified': []}]}
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+def test_coalescer_merges_pushes_in_window():
+    clock = FakeClock()
+    store = org.MemoryWindowStore()
+    late = []
+
+    def sleep(seconds):
+        # Other webhook invocations arrive while the first one holds the window open
+        clock.now += 1
+        assert other.submit(push_payload(['b', 'a'])) is None
+        assert other.submit(push_payload(['x'], ref='refs/heads/feature')) is not None
+        clock.now += seconds - 1
+        late.append(clock.now)
+
+    owner = org.Coalescer(store, 5, clock=clock, sleep=sleep)
+    other = org.Coalescer(store, 5, clock=clock, sleep=lambda seconds: None)
+
+    actual = owner.submit(push_payload(['c', 'a']))
+
+    assert late == [1005.0]
+    assert actual == {'ref': 'refs/heads/master', 'before': '0000000000000000000000000000000000000000',
+                      'after': '0000000000000000000000000000000000000001', 'repository': {'name': 'repo'},
+                      'commits': [{'added': ['a', 'b', 'c'], 'removed': [], 'modified': []}]}
+    assert store.windows == {}
+
+def test_coalescer_opens_new_window_after_flush():
+    clock = FakeClock()
+    coalescer = org.Coalescer(org.MemoryWindowStore(), 5, clock=clock, sleep=lambda seconds: None)
+
+    first = coalescer.submit(push_payload(['a']))
+    clock.now += 2
+    second = coalescer.submit(push_payload(['b']))
+
+    assert first['commits'][0]['added'] == ['a']
+    assert second['commits'][0]['added'] == ['b']
+
+def test_coalescer_takes_over_abandoned_window():
+    clock = FakeClock()
+    store = org.MemoryWindowStore(grace=10)
+    store.open_or_merge('repo/refs/heads/master', ['lost'], clock.now, clock.now + 5)
+    clock.now += 16
+
+    actual = org.Coalescer(store, 5, clock=clock, sleep=lambda seconds: None).submit(push_payload(['new']))
+
+    assert actual['commits'][0]['added'] == ['lost', 'new']
+
+def test_coalescer_store_failure_sends_push():
+    store = org.MemoryWindowStore()
+    payload = push_payload(['a'])
+
+    with patch.object(store, 'open_or_merge', side_effect=RuntimeError('store down')):
+        actual = org.Coalescer(store, 5, sleep=lambda seconds: None).submit(payload)
+
+    assert actual is payload
+
+@patch('webhook.org.invoke_function')
+def test_handler_coalesced_push_not_invoked(invoke_function, apigw_event):
+    store = org.MemoryWindowStore()
+    store.open_or_merge('repo/refs/heads/master', ['other'], org.time.time(), org.time.time() + 5)
+    apigw_event['body'] = json.dumps(push_payload(['a']))
+    gh_signature(apigw_event, None)
+
+    with patch('webhook.org.COALESCE_WINDOW', 5), patch('webhook.org.coalescer', org.Coalescer(store, 5)):
+        response = org.handler(apigw_event, None)
+
+    assert response['statusCode'] == 200
+    assert invoke_function.called is False
+    assert store.windows['repo/refs/heads/master']['paths'] == {'a', 'other'}
+
+@pytest.mark.parametrize('window,table,mode,expected', [
+    (0, 'windows', 'async', 0),
+    (3, None, 'async', 0),
+    (3, 'windows', 'async', 3),
+    (8, 'windows', 'async', 5),
+    (3, 'windows', 'inline', 2),
+    (3, 'windows', 'inline-slow', 0)])
+def test_check_coalesce_window(window, table, mode, expected):
+    inline = 8 if mode == 'inline-slow' else 3
+    with patch('webhook.org.EVAL_MODE', mode.split('-')[0]), patch('webhook.org.INVOKE_BUDGET', 4), \
+            patch('webhook.org.INLINE_BUDGET', inline):
+        assert org.check_coalesce_window(window, table) == expected
+
+def test_lambda_client_config():
+    with patch.dict(clients.clients, clear=True):
+        client = org.lambda_client()
+
+        assert client is org.get_client('lambda')
+        assert client.meta.config.retries['total_max_attempts'] == 1
+        assert client.meta.config.tcp_keepalive is True
+
+def test_dynamodb_window_store():
+    client = boto3.client('dynamodb')
+    store = org.DynamoDBWindowStore('windows', client, grace=30)
+    key = {'Key': {'S': 'repo/refs/heads/master'}}
+    with Stubber(client) as stub:
+        stub.add_client_error('update_item', service_error_code='ConditionalCheckFailedException')
+        stub.add_response('update_item', {}, {
+            'TableName': 'windows', 'Key': key,
+            'UpdateExpression': 'SET Deadline = :deadline, Expires = :expires ADD Paths :paths',
+            'ConditionExpression': 'attribute_not_exists(Deadline) OR Deadline < :expired',
+            'ExpressionAttributeValues': {':paths': {'SS': ['a']}, ':expired': {'N': '70'},
+                                          ':deadline': {'N': '105'}, ':expires': {'N': '405'}}})
+        stub.add_response('update_item', {}, {
+            'TableName': 'windows', 'Key': key,
+            'UpdateExpression': 'ADD Paths :paths',
+            'ConditionExpression': 'Deadline >= :expired',
+            'ExpressionAttributeValues': {':paths': {'SS': ['b']}, ':expired': {'N': '71'}}})
+        stub.add_response('delete_item', {'Attributes': {'Paths': {'SS': ['b', 'a']}}}, {
+            'TableName': 'windows', 'Key': key, 'ReturnValues': 'ALL_OLD'})
+
+        assert store.open_or_merge('repo/refs/heads/master', ['a'], 100, 105) is True
+        assert store.open_or_merge('repo/refs/heads/master', ['b'], 101, 106) is False
+        assert store.take('repo/refs/heads/master') == ['a', 'b']
+
+def test_project_push():
+    payload = push_payload(['a', 'b'])
+    payload['commits'][0]['author'] = {'name': 'someone'}
+    payload['commits'].append({'id': 'sha', 'modified': ['c']})
+    payload['head_commit'] = payload['commits'][0]
+    payload['sender'] = {'login': 'someone'}
+
+    actual = org.project_push(payload)
+
+    assert actual == {
+        'ref': 'refs/heads/master', 'before': '0000000000000000000000000000000000000000',
+        'after': '0000000000000000000000000000000000000001', 'repository': {'name': 'repo'}, 'commits': [
+            {'added': ['a', 'b'], 'removed': [], 'modified': []},
+            {'added': [], 'removed': [], 'modified': ['c']}]}
+
+@patch('webhook.org.invoke_function')
+def test_handler_forwards_projection(invoke_function, apigw_event):
+    payload = push_payload(['a'])
+    payload['sender'] = {'login': 'someone'}
+    apigw_event['body'] = json.dumps(payload)
+    gh_signature(apigw_event, None)
+
+    org.handler(apigw_event, None)
+
+    sent = invoke_function.call_args.args[1]
+    assert ' ' not in sent
+    assert json.loads(sent) == org.project_push(payload)
+
+def big_payload():
+    commits = [{'added': [f'services/svc{i % 50}/file{j}.py' for j in range(40)], 'removed': [], 'modified': []} for i in range(200)]
+    return {'ref': 'refs/heads/master', 'before': '0000000000000000000000000000000000000000',
+            'after': '0000000000000000000000000000000000000001', 'repository': {'name': 'repo'}, 'commits': commits}
+
+@pytest.mark.parametrize('fallback,merged', [('merge', True), ('none', False)])
+def test_serialize_push_oversized(fallback, merged):
+    payload = big_payload()
+
+    with patch('webhook.org.MAX_INVOKE_PAYLOAD', 100 * 1024), patch('webhook.org.OVERSIZE_FALLBACK', fallback):
+        actual = json.loads(org.serialize_push(payload))
+
+    assert len(json.dumps(payload, separators=(',', ':'))) > 100 * 1024
+    assert (len(actual['commits']) == 1) == merged
+    assert sorted(set(p for c in actual['commits'] for p in c['added'])) == sorted(org.push_paths(payload))
+
+def test_serialize_push_spills_to_s3():
+    s3 = FakeS3()
+    payload = big_payload()
+
+    with patch('webhook.org.MAX_INVOKE_PAYLOAD', 1024), patch('webhook.org.OVERSIZE_FALLBACK', 'spill'), \
+            patch('webhook.org.SPILL_BUCKET', 'test-bucket'), patch('webhook.org.get_client', return_value=s3):
+        actual = json.loads(org.serialize_push(payload))
+
+    location = actual['PayloadLocation']
+    assert location['Bucket'] == 'test-bucket'
+    assert location['Key'].startswith('spill/repo/')
+    assert actual['ref'] == 'refs/heads/master'
+    assert 'commits' not in actual
+    lines = s3.objects[('test-bucket', location['Key'])][0].decode().split('\n')
+    assert json.loads(lines[0]) == {'ref': 'refs/heads/master', 'before': '0000000000000000000000000000000000000000',
+                                    'after': '0000000000000000000000000000000000000001', 'repository': {'name': 'repo'}}
+    assert [json.loads(line) for line in lines[1:]] == org.push_paths(payload)
+
+class FakeEvaluator:
+    def __init__(self, delay=0, error=None, start_error=None, start_delay=0):
+        self.delay = delay
+        self.error = error
+        self.start_error = start_error
+        self.start_delay = start_delay
+        self.started = []
+        self.metrics = org.Metrics(None, 'eval')
+
+    def find_pipelines(self, payload):
+        time.sleep(self.delay)
+        if self.error:
+            raise self.error
+        return ['pipeline'] if payload['commits'] else []
+
+    def start_code_pipelines(self, names, push=None):
+        self.started.append(names)
+        time.sleep(self.start_delay)
+        return [{'CodePipelineName': name, 'Error': self.start_error} for name in names]
+
+@pytest.mark.parametrize('evaluator,inline,started', [
+    (FakeEvaluator(), True, True),
+    (FakeEvaluator(delay=0.5), False, False),
+    (FakeEvaluator(error=RuntimeError('S3 down')), False, False),
+    (FakeEvaluator(start_error='Throttled'), False, True),
+    (FakeEvaluator(start_delay=0.5), False, True),
+    (None, False, False)], ids=['inline', 'over-budget', 'error', 'start-failed', 'slow-start', 'not-packaged'])
+@patch('webhook.org.invoke_function')
+def test_handler_inline_mode(invoke_function, apigw_event, evaluator, inline, started):
+    apigw_event['body'] = json.dumps(push_payload(['a']))
+    gh_signature(apigw_event, None)
+
+    with patch('webhook.org.EVAL_MODE', 'inline'), patch('webhook.org.INLINE_BUDGET', 0.1), \
+            patch('webhook.org.load_evaluator', return_value=evaluator), patch('webhook.org.inline_future', None), \
+            patch('webhook.org.inline_executor', ThreadPoolExecutor(max_workers=1)):
+        response = org.handler(apigw_event, None)
+
+    assert response['statusCode'] == 200
+    assert invoke_function.called is not inline
+    if evaluator:
+        assert evaluator.started == ([['pipeline']] if started else [])
+
+@patch('webhook.org.invoke_function')
+def test_handler_inline_mode_skips_busy_executor(invoke_function, apigw_event):
+    apigw_event['body'] = json.dumps(push_payload(['a']))
+    gh_signature(apigw_event, None)
+    slow, fast = FakeEvaluator(delay=0.5), FakeEvaluator()
+
+    with patch('webhook.org.EVAL_MODE', 'inline'), patch('webhook.org.INLINE_BUDGET', 0.1), \
+            patch('webhook.org.inline_future', None), \
+            patch('webhook.org.inline_executor', ThreadPoolExecutor(max_workers=1)), patch('webhook.org.load_evaluator', side_effect=[slow, fast]):
+        org.handler(apigw_event, None)
+        start = time.monotonic()
         org.handler(apigw_event, None)
+        elapsed = time.monotonic() - start
+
+    assert invoke_function.call_count == 2
+    assert elapsed < 0.1
+    assert slow.started == fast.started == []
+
+@patch('webhook.org.invoke_function')
+def test_handler_inline_mode_budgets_module_load(invoke_function, apigw_event):
+    apigw_event['body'] = json.dumps(push_payload(['a']))
+    gh_signature(apigw_event, None)
+    evaluator = FakeEvaluator()
+
+    def slow_load():
+        time.sleep(0.5)
+        return evaluator
+
+    with patch('webhook.org.EVAL_MODE', 'inline'), patch('webhook.org.INLINE_BUDGET', 0.1), \
+            patch('webhook.org.inline_future', None), \
+            patch('webhook.org.inline_executor', ThreadPoolExecutor(max_workers=1)), patch('webhook.org.load_evaluator', slow_load):
+        start = time.monotonic()
+        org.handler(apigw_event, None)
+        elapsed = time.monotonic() - start
+
+    assert invoke_function.called
+    assert elapsed < 0.4
+    time.sleep(0.5)
+    assert evaluator.started == []
+
+def test_load_evaluator():
+    with patch.dict(os.environ, {'S3_BUCKET': 'test-bucket', 'S3_PREFIX': 'some/prefix'}):
+        evaluator = org.load_evaluator()
+
+    assert isinstance(evaluator, types.ModuleType)
+    assert callable(evaluator.find_pipelines)
+    assert callable(evaluator.start_code_pipelines)
+
+def emitted_metrics(apigw_event, event_type, signature=None):
+    apigw_event['headers']['x-github-event'] = event_type
+    if signature:
+        apigw_event['headers']['x-hub-signature'] = signature
+    emitted = []
+    with patch('webhook.org.metrics', org.Metrics('Namespace', 'webhook', emit=emitted.append)), \
+            patch('webhook.org.lambda_client') as client:
+        client.return_value.invoke.return_value = {'StatusCode': 202}
+        org.handler(apigw_event, None)
+    return json.loads(emitted[0])
+
+def test_handler_metrics(apigw_event):
+    assert emitted_metrics(dict(apigw_event, headers=dict(apigw_event['headers'])), 'check_run')['Ignored'] == 1
+    assert emitted_metrics(dict(apigw_event, headers=dict(apigw_event['headers'])), 'push', 'sha1=' + '0' * 40)['Rejected'] == 1
 
+    record = emitted_metrics(apigw_event, 'push')
+    names = [m['Name'] for m in record['_aws']['CloudWatchMetrics'][0]['Metrics']]
+    assert names[:5] == ['Signature', 'ParsePayload', 'Serialize', 'Invoke', 'BodyBytes']
+    assert record['Service'] == 'webhook'
+    assert record['BodyBytes'] == len(apigw_event['body'])
+    assert record['InvokeAttempts'] == 1
@@ -2,46 +2,373 @@ import os
 import hmac
 from hashlib import sha1
 import json
-import boto3
+import random
+import re
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from common.clients import configure, get_client
+from common.metrics import Metrics
 
 SECRET = os.environ['GITHUB_SECRET'].encode('utf-8')
 EVAL_FUNCTION_ARN = os.environ['EVAL_FUNCTION_ARN']
+COALESCE_WINDOW = float(os.environ.get('COALESCE_WINDOW', '0'))
+COALESCE_TABLE = os.environ.get('COALESCE_TABLE')
+MAX_INVOKE_PAYLOAD = int(os.environ.get('MAX_INVOKE_PAYLOAD', str(256 * 1024)))
+OVERSIZE_FALLBACK = os.environ.get('OVERSIZE_FALLBACK', 'merge')
+SPILL_BUCKET = os.environ.get('SPILL_BUCKET')
+SPILL_PREFIX = os.environ.get('SPILL_PREFIX', 'spill')
+INVOKE_MAX_ATTEMPTS = int(os.environ.get('INVOKE_MAX_ATTEMPTS', '4'))
+INVOKE_BASE_DELAY = float(os.environ.get('INVOKE_BASE_DELAY', '0.2'))
+INVOKE_BUDGET = float(os.environ.get('INVOKE_BUDGET', '4'))
+DEAD_LETTER_QUEUE_URL = os.environ.get('DEAD_LETTER_QUEUE_URL')
+EVAL_MODE = os.environ.get('EVAL_MODE', 'async')
+INLINE_BUDGET = float(os.environ.get('INLINE_BUDGET', '3'))
+METRICS_NAMESPACE = os.environ.get('METRICS_NAMESPACE')
+RETRYABLE_INVOKE_ERRORS = [
+    'TooManyRequestsException', 'ServiceException', 'ResourceConflictException', 'ResourceNotReadyException',
+    'EC2ThrottledException', 'ENILimitReachedException', 'RequestTimeout', 'Throttling', 'ThrottlingException']
+CHANGE_TYPES = ['added', 'removed', 'modified']
+GITHUB_TIMEOUT = 10
+RESPONSE_MARGIN = 1
 
-lambdaclient = boto3.client('lambda')
+# Windows are shared through COALESCE_TABLE, a window kept in one container would never see the pushes
+# handled by the others, so coalescing is off without it. GitHub gives up on the webhook after
+# GITHUB_TIMEOUT seconds, and the window, inline evaluation and invoke retries all happen before the
+# response, so the window is shortened to what is left of that.
+def check_coalesce_window(window, table):
+    if window <= 0:
+        return 0
+    if not table:
+        print('COALESCE_WINDOW is set without COALESCE_TABLE, coalescing is disabled')
+        return 0
+    available = GITHUB_TIMEOUT - RESPONSE_MARGIN - INVOKE_BUDGET - (INLINE_BUDGET if EVAL_MODE == 'inline' else 0)
+    if window > available:
+        print(f'COALESCE_WINDOW of {window}s does not leave time to answer GitHub within {GITHUB_TIMEOUT}s, using {max(available, 0)}s')
+        return max(available, 0)
+    return window
 
+COALESCE_WINDOW = check_coalesce_window(COALESCE_WINDOW, COALESCE_TABLE)
+
+# Cheapest checks first: events without a handler are acknowledged from the headers alone, and a
+# missing or malformed signature is rejected before the HMAC over the body is computed.
 def handler(request, context):
-    if not verify_signature(request):
-        return unauthorized()
+    try:
+        github_event = extract_event(request)
+        if github_event not in EVENT_MAP:
+            metrics.count('Ignored')
+            return success()
+        with metrics.timer('Signature'):
+            verified = verify_signature(request)
+        if not verified:
+            metrics.count('Rejected')
+            return unauthorized()
 
-    return handle_event(request)
+        return EVENT_MAP[github_event](request)
+    finally:
+        metrics.flush()
 
 def handle_push_event(request):
-    payload = json.loads(request['body'])
+    with metrics.timer('ParsePayload'):
+        payload = project_push(json.loads(request['body']))
+    metrics.count('BodyBytes', len(request['body']))
+    metrics.count('Commits', len(payload['commits']))
+    if COALESCE_WINDOW > 0:
+        with metrics.timer('Coalesce'):
+            payload = get_coalescer().submit(payload)
+        if payload is None:
+            metrics.count('Coalesced')
+            return success()
+    if EVAL_MODE == 'inline':
+        with metrics.timer('InlineEval'):
+            evaluated = evaluate_inline(payload)
+        if evaluated:
+            return success()
     print(f'Invoking eval function {EVAL_FUNCTION_ARN}')
-    invoke_function(EVAL_FUNCTION_ARN, json.dumps(payload))
+    with metrics.timer('Serialize'):
+        data = serialize_push(payload)
+    metrics.count('InvokePayloadBytes', len(data))
+    with metrics.timer('Invoke'):
+        invoke_function(EVAL_FUNCTION_ARN, data)
     return success()
 
+# Only the fields the eval function reads are forwarded, GitHub sends hundreds of KB of URL templates,
+# author details and the like on big pushes.
+def project_push(payload):
+    return {
+        'ref': payload.get('ref'),
+        'before': payload.get('before'),
+        'after': payload.get('after'),
+        'repository': {'name': payload.get('repository', {}).get('name')},
+        'commits': [{i: commit.get(i, []) for i in CHANGE_TYPES} for commit in payload.get('commits', [])]
+    }
+
+# Runs the eval function's matching in this process, skipping the extra Lambda hop. Configs stay
+# cached in the warm container. Loading the module, which reads the config snapshot on its first
+# import, matching and the pipeline starts all run on the inline worker and have to finish within
+# INLINE_BUDGET seconds, otherwise the push is handed to the eval function as usual and the background
+# work only warms the cache. Pushes arriving while such work is still running go to the eval function
+# straight away instead of queueing behind it. When a start fails or runs past the budget the push is
+# handed over too, the eval function reuses the request tokens of the pipelines that did start.
+def evaluate_inline(payload):
+    global inline_future
+    if inline_future is not None and not inline_future.done():
+        print('A timed out inline evaluation is still running, falling back to the eval function')
+        metrics.count('InlineFallbacks')
+        return False
+    deadline = time.monotonic() + INLINE_BUDGET
+    future = inline_future = inline_executor.submit(run_inline, payload, deadline)
+    try:
+        summary = future.result(timeout=INLINE_BUDGET)
+    except TimeoutError:
+        print(f'Inline evaluation exceeded {INLINE_BUDGET}s, falling back to the eval function')
+        metrics.count('InlineFallbacks')
+        return False
+    except Exception as e:
+        print(f'Inline evaluation failed, falling back to the eval function: {e!r}')
+        metrics.count('InlineFallbacks')
+        return False
+    if summary is None:
+        return False
+    if any(result['Error'] for result in summary):
+        print('Inline pipeline starts failed, falling back to the eval function')
+        metrics.count('InlineFallbacks')
+        return False
+    return True
+
+# Matching that ends after the deadline leaves the starts to the eval function the push was handed to
+def run_inline(payload, deadline):
+    evaluator = load_evaluator()
+    if evaluator is None:
+        return None
+    try:
+        names = evaluator.find_pipelines(payload)
+        if time.monotonic() >= deadline:
+            return None
+        return evaluator.start_code_pipelines(names, push=payload)
+    finally:
+        evaluator.metrics.flush()
+
+inline_executor = ThreadPoolExecutor(max_workers=1)
+inline_future = None
+
+def load_evaluator():
+    try:
+        import filter as evaluator
+    except ImportError:
+        try:
+            from eval import filter as evaluator
+        except (ImportError, KeyError) as e:
+            print(f'Eval module is not packaged or configured with the webhook, using the eval function: {e!r}')
+            return None
+    return evaluator
+
+# Compact JSON for the invoke. When it is still above MAX_INVOKE_PAYLOAD, OVERSIZE_FALLBACK=merge
+# collapses the commits into one with the unique changed paths, OVERSIZE_FALLBACK=spill does the same
+# and, if that is still too big, writes the paths to SPILL_BUCKET and sends a pointer to them.
+# OVERSIZE_FALLBACK=none sends it as is.
+def serialize_push(payload):
+    data = json.dumps(payload, separators=(',', ':'))
+    if len(data) <= MAX_INVOKE_PAYLOAD:
+        return data
+    print(f'Push payload of {len(data)} bytes is above {MAX_INVOKE_PAYLOAD}, fallback {OVERSIZE_FALLBACK}')
+    if OVERSIZE_FALLBACK in ('merge', 'spill'):
+        paths = push_paths(payload)
+        data = json.dumps(coalesced_event(payload, paths), separators=(',', ':'))
+        if len(data) > MAX_INVOKE_PAYLOAD and OVERSIZE_FALLBACK == 'spill' and SPILL_BUCKET:
+            data = json.dumps(spill_push(payload, paths), separators=(',', ':'))
+        elif len(data) > MAX_INVOKE_PAYLOAD:
+            print(f'Merged push payload of {len(data)} bytes is still above {MAX_INVOKE_PAYLOAD}')
+    return data
+
+# Spilled pushes are JSON lines, a header with ref and repository followed by one changed path per
+# line, so the eval function can read them incrementally
+def spill_push(payload, paths):
+    header = {'ref': payload['ref'], 'before': payload.get('before'), 'after': payload.get('after'),
+              'repository': {'name': payload['repository']['name']}}
+    key = f'{SPILL_PREFIX}/{header["repository"]["name"]}/{uuid.uuid4()}.jsonl'
+    lines = [json.dumps(header, separators=(',', ':'))] + [json.dumps(path) for path in paths]
+    get_client('s3').put_object(Bucket=SPILL_BUCKET, Key=key, Body='\n'.join(lines).encode(), ContentType='application/x-ndjson')
+    print(f'Spilled {len(paths)} changed paths to s3://{SPILL_BUCKET}/{key}')
+    return dict(header, PayloadLocation={'Bucket': SPILL_BUCKET, 'Key': key})
+
+# Event invocations retried with jittered exponential backoff while throttled, within INVOKE_BUDGET
+# seconds so GitHub still gets an answer. Connection errors and timeouts are retried too, a timed out
+# invoke may still have been queued but the eval function starts pipelines idempotently. Payloads that
+# could not be delivered go to the dead letter queue, or raise when there is none so the delivery shows
+# as failed in GitHub.
 def invoke_function(arn, payload):
-    response = lambdaclient.invoke_async(FunctionName=arn, InvokeArgs=payload)
-    if response['Status'] != 202:
-        print(f'Ack! Invoke failed: {response}')
+    from botocore.exceptions import BotoCoreError, ClientError
+    deadline = time.monotonic() + INVOKE_BUDGET
+    for attempt in range(1, INVOKE_MAX_ATTEMPTS + 1):
+        metrics.count('InvokeAttempts')
+        try:
+            response = lambda_client().invoke(FunctionName=arn, InvocationType='Event', Payload=payload)
+            if response['StatusCode'] == 202:
+                return True
+            error = RuntimeError(f'Unexpected invoke status {response["StatusCode"]}')
+        except ClientError as e:
+            error = e
+            if e.response['Error']['Code'] not in RETRYABLE_INVOKE_ERRORS:
+                break
+        except BotoCoreError as e:
+            error = e
+        delay = INVOKE_BASE_DELAY * 2 ** (attempt - 1) * random.uniform(0.5, 1)
+        if attempt == INVOKE_MAX_ATTEMPTS or time.monotonic() + delay > deadline:
+            break
+        print(f'Invoke attempt {attempt} failed with {error!r}, retrying in {delay:.2f}s')
+        time.sleep(delay)
+    print(f'Ack! Invoke failed after {attempt} attempts: {error!r}')
+    metrics.count('InvokeFailures')
+    if not dead_letter(arn, payload, error):
+        raise error
+    return False
+
+def dead_letter(arn, payload, error):
+    if not DEAD_LETTER_QUEUE_URL:
+        return False
+    try:
+        get_client('sqs').send_message(QueueUrl=DEAD_LETTER_QUEUE_URL, MessageBody=payload, MessageAttributes={
+            'FunctionName': {'DataType': 'String', 'StringValue': arn},
+            'Error': {'DataType': 'String', 'StringValue': repr(error)[:1024]}})
+    except Exception as e:
+        print(f'Unable to dead letter payload for {arn}: {e!r}')
+        return False
+    print(f'Dead lettered payload for {arn} to {DEAD_LETTER_QUEUE_URL}')
+    metrics.count('DeadLettered')
+    return True
+
+# Debounces pushes to the same repo/branch. The first push opens a window and waits for it to close,
+# pushes arriving meanwhile only add their changed paths, and the opener then sends one event with the
+# merged paths so each matching pipeline is started once per window. The window has to stay well
+# inside the time GitHub waits for the webhook to answer.
+class Coalescer:
+    def __init__(self, store, window, clock=time.time, sleep=time.sleep):
+        self.store = store
+        self.window = window
+        self.clock = clock
+        self.sleep = sleep
+
+    def submit(self, payload):
+        key = push_key(payload)
+        paths = push_paths(payload)
+        if not paths:
+            return payload
+        try:
+            now = self.clock()
+            if not self.store.open_or_merge(key, paths, now, now + self.window):
+                print(f'Coalesced push to {key} into the open window')
+                return None
+            self.sleep(self.window)
+            merged = self.store.take(key)
+        except Exception as e:
+            print(f'Unable to coalesce push to {key}, sending it on its own: {e!r}')
+            return payload
+        if not merged:
+            return None
+        print(f'Sending {len(merged)} coalesced paths for {key}')
+        return coalesced_event(payload, merged)
+
+def push_key(payload):
+    return f'{payload["repository"]["name"]}/{payload["ref"]}'
+
+def push_paths(payload):
+    paths = dict.fromkeys(p for commit in payload.get('commits', []) for i in CHANGE_TYPES for p in commit[i])
+    return list(paths)
+
+def coalesced_event(payload, paths):
+    return {
+        'ref': payload['ref'],
+        'before': payload.get('before'),
+        'after': payload.get('after'),
+        'repository': {'name': payload['repository']['name']},
+        'commits': [{'added': sorted(paths), 'removed': [], 'modified': []}]
+    }
+
+# Windows are considered abandoned once they are this many seconds past their deadline, e.g. when the
+# invocation that opened one timed out, and the next push takes them over along with their paths.
+COALESCE_GRACE = 30
+
+# Same behaviour as DynamoDBWindowStore within one process, used by the tests
+class MemoryWindowStore:
+    def __init__(self, grace=COALESCE_GRACE):
+        self.grace = grace
+        self.windows = {}
+        self.lock = threading.Lock()
+
+    def open_or_merge(self, key, paths, now, deadline):
+        with self.lock:
+            window = self.windows.get(key)
+            if window and now <= window['deadline'] + self.grace:
+                window['paths'].update(paths)
+                return False
+            carried = window['paths'] if window else set()
+            self.windows[key] = {'deadline': deadline, 'paths': carried | set(paths)}
+            return True
+
+    def take(self, key):
+        with self.lock:
+            window = self.windows.pop(key, None)
+        return sorted(window['paths']) if window else []
+
+class DynamoDBWindowStore:
+    def __init__(self, table, client, grace=COALESCE_GRACE):
+        self.table = table
+        self.client = client
+        self.grace = grace
+
+    def open_or_merge(self, key, paths, now, deadline):
+        values = {':paths': {'SS': paths}, ':expired': {'N': str(now - self.grace)}}
+        try:
+            self.client.update_item(
+                TableName=self.table, Key={'Key': {'S': key}},
+                UpdateExpression='ADD Paths :paths',
+                ConditionExpression='Deadline >= :expired',
+                ExpressionAttributeValues=values)
+            return False
+        except self.client.exceptions.ConditionalCheckFailedException:
+            pass
+        try:
+            self.client.update_item(
+                TableName=self.table, Key={'Key': {'S': key}},
+                UpdateExpression='SET Deadline = :deadline, Expires = :expires ADD Paths :paths',
+                ConditionExpression='attribute_not_exists(Deadline) OR Deadline < :expired',
+                ExpressionAttributeValues=dict(values, **{
+                    ':deadline': {'N': str(deadline)},
+                    ':expires': {'N': str(int(deadline + self.grace * 10))}}))
+            return True
+        except self.client.exceptions.ConditionalCheckFailedException:
+            # Another push opened the window first and our paths were not written, merge into it
+            return self.open_or_merge(key, paths, now, deadline)
+
+    def take(self, key):
+        response = self.client.delete_item(TableName=self.table, Key={'Key': {'S': key}}, ReturnValues='ALL_OLD')
+        return sorted(response.get('Attributes', {}).get('Paths', {}).get('SS', []))
+
+coalescer = None
+def get_coalescer():
+    global coalescer
+    if not coalescer:
+        coalescer = Coalescer(DynamoDBWindowStore(COALESCE_TABLE, get_client('dynamodb')), COALESCE_WINDOW)
+    return coalescer
 
 EVENT_MAP = {
     'push': handle_push_event
 }
 
-def handle_event(request):
-    github_event = extract_event(request)
-    return EVENT_MAP[github_event](request) if github_event in EVENT_MAP else success()
-
 def extract_event(request):
-    return request['headers']['x-github-event']
+    return request['headers'].get('x-github-event')
+
+SIGNATURE_FORMAT = re.compile(r'\s*sha1\s*=\s*([0-9a-fA-F]{40})\s*')
 
 def verify_signature(request):
-    sent = request['headers']['x-hub-signature'].split('=')[-1].strip()
+    found = SIGNATURE_FORMAT.fullmatch(request['headers'].get('x-hub-signature', ''))
+    if not found:
+        print('HMAC signature header missing or malformed')
+        return False
     calculated = hmac.new(SECRET, msg=request['body'].encode('utf-8'), digestmod=sha1).hexdigest()
-    print(f'HMAC SIGNATURE sent={sent} calculated={calculated}')
-    return hmac.compare_digest(calculated, sent)
+    return hmac.compare_digest(calculated, found.group(1).lower())
 
 def success():
     return {
@@ -54,3 +381,16 @@ def unauthorized():
         'statusCode': 403,
         'body': json.dumps('Unauthorized')
     }
+
+metrics = Metrics(METRICS_NAMESPACE, 'webhook')
+
+def lambda_client():
+    return get_client('lambda')
+
+# Inline pipeline starts happen before GitHub gets its response, so they make a single short attempt
+# and a failed start is left to the eval function
+configure('codepipeline', retries={'total_max_attempts': 1}, connect_timeout=1, read_timeout=2)
+
+# The invoker does its own retries within INVOKE_BUDGET, so botocore makes a single attempt that times
+# out early enough to leave time for another one
+configure('lambda', retries={'total_max_attempts': 1}, connect_timeout=min(1, INVOKE_BUDGET / 4), read_timeout=INVOKE_BUDGET / 2)